@@ -1,86 +1,3457 @@
-import random
 import re
+import sqlite3
+import secrets
+import signal
 from datetime import datetime
 from abc import ABC, abstractmethod
+import argparse
+import asyncio
+import bisect
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import csv
+import gc
+from contextlib import ExitStack, contextmanager, redirect_stdout
+from array import array
+import functools
+import gzip
+import heapq
+import io
+import itertools
+import json
+import math
+import mmap
 import os
+import struct
+import sys
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:  # interest accrual falls back to plain Python
+    np = None
+
+try:
+    import fcntl
+except ImportError:  # no flock on Windows, file locks then only hold within a process
+    fcntl = None
+
+def synchronized(method):
+    # Runs the method while holding self.lock (per account, or the single writer of a store)
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def try_file_lock(path):
+    # Exclusive lock on path held until the returned file is closed (or the
+    # process exits), None while another holder has it
+    file = open(path, "a")
+    if fcntl is not None:
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return None
+    return file
+
+@contextmanager
+def file_lock(path):
+    # Exclusive lock on path across processes, for read-modify-write of a
+    # shared file. The lock file is separate because the guarded file is
+    # replaced, not rewritten in place.
+    with open(path, "a") as file:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        yield
+
+class Metrics:
+    # Per operation call counts, latency histograms, bytes read/written and
+    # file opens. Off by default: instrumented() then costs one flag check
+    # per call, and I/O sites check metrics.enabled before working out a
+    # byte count (getsize, tell) for add_io(). I/O is charged to every
+    # instrumented operation running on the thread, so transfer_funds
+    # includes the writes of its storage calls.
+    BUCKETS = [1e-6 * 2 ** (i / 2) for i in range(56)]  # upper bounds, 1us to ~3 minutes
+    PERCENTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.audit_hooked = False
+        self.operations = {}
+        # Cache name -> function returning its counters, exported with the operations
+        self.caches = {}
+
+    def enable(self):
+        if not self.audit_hooked:
+            # Audit hooks cannot be removed, so it is only installed once metrics are wanted
+            sys.addaudithook(self.audit)
+            self.audit_hooked = True
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def register_cache(self, name, stats):
+        self.caches[name] = stats
+
+    @synchronized
+    def reset(self):
+        self.operations = {}
+
+    def operation(self, name):
+        stats = self.operations.get(name)
+        if stats is None:
+            stats = self.operations[name] = {'count': 0, 'seconds': 0.0, 'buckets': [0] * (len(self.BUCKETS) + 1),
+                                             'bytes_read': 0, 'bytes_written': 0, 'file_opens': 0}
+        return stats
+
+    def running(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    @synchronized
+    def observe(self, name, seconds):
+        stats = self.operation(name)
+        stats['count'] += 1
+        stats['seconds'] += seconds
+        stats['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    def add_io(self, read=0, written=0, opens=0):
+        if not self.enabled:
+            return
+        stack = self.running()
+        if not stack:
+            return
+        with self.lock:
+            for name in set(stack):
+                stats = self.operation(name)
+                stats['bytes_read'] += read
+                stats['bytes_written'] += written
+                stats['file_opens'] += opens
+
+    def audit(self, event, args):
+        if event == "open" and self.enabled:
+            self.add_io(opens=1)
+
+    def percentile(self, stats, fraction):
+        # Upper bound of the bucket holding the fraction-th call
+        rank = stats['count'] * fraction
+        seen = 0
+        for bound, count in zip(self.BUCKETS, stats['buckets']):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return float('inf') if stats['buckets'][-1] else 0.0
+
+    @synchronized
+    def summary(self):
+        rows = []
+        for name, stats in sorted(self.operations.items()):
+            row = {'operation': name, 'count': stats['count'],
+                   'mean': stats['seconds'] / stats['count'] if stats['count'] else 0.0}
+            for fraction in self.PERCENTILES:
+                row[f"p{round(fraction * 100)}"] = self.percentile(stats, fraction)
+            row.update(bytes_read=stats['bytes_read'], bytes_written=stats['bytes_written'],
+                       file_opens=stats['file_opens'])
+            rows.append(row)
+        return rows
+
+    def to_json(self):
+        return json.dumps({'enabled': self.enabled, 'operations': self.summary(),
+                           'caches': {name: stats() for name, stats in sorted(self.caches.items())}}, indent=2)
+
+    @synchronized
+    def to_prometheus(self):
+        lines = ["# TYPE bank_operation_seconds histogram"]
+        for name, stats in sorted(self.operations.items()):
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, stats['buckets']):
+                cumulative += count
+                lines.append(f'bank_operation_seconds_bucket{{operation="{name}",le="{bound:.9g}"}} {cumulative}')
+            lines.append(f'bank_operation_seconds_bucket{{operation="{name}",le="+Inf"}} {stats["count"]}')
+            lines.append(f'bank_operation_seconds_sum{{operation="{name}"}} {stats["seconds"]:.9g}')
+            lines.append(f'bank_operation_seconds_count{{operation="{name}"}} {stats["count"]}')
+        for metric, key in (("bank_operation_bytes_read_total", 'bytes_read'),
+                            ("bank_operation_bytes_written_total", 'bytes_written'),
+                            ("bank_operation_file_opens_total", 'file_opens')):
+            lines.append(f"# TYPE {metric} counter")
+            for name, stats in sorted(self.operations.items()):
+                lines.append(f'{metric}{{operation="{name}"}} {stats[key]}')
+        for name, stats in sorted(self.caches.items()):
+            for key, value in sorted(stats().items()):
+                lines.append(f'bank_cache_{key}{{cache="{name}"}} {value:.9g}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, path, format="json"):
+        text = self.to_prometheus() if format == "prometheus" else self.to_json()
+        with open(path, "w") as file:
+            file.write(text)
+
+metrics = Metrics()
+
+def instrumented(name):
+    # Records the call in metrics under name when metrics are enabled
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return method(*args, **kwargs)
+            stack = metrics.running()
+            stack.append(name)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                metrics.observe(name, time.perf_counter() - start)
+                stack.pop()
+        return wrapper
+    return decorate
+
+ACCOUNT_TYPES = ("Checking", "Savings", "Loan")
+ACCOUNT_FIELDS = ['account_id', 'account_type', 'balance', 'interest_rate', 'credit_limit', 'overdraft_fee']
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def drop_torn_line(path):
+    # A crash mid-write can leave part of a row at the end of an append-only
+    # file, and rows appended after it would run on from it
+    try:
+        file = open(path, "rb+")
+    except FileNotFoundError:
+        return
+    with file:
+        end = file.seek(0, os.SEEK_END)
+        if end == 0:
+            return
+        file.seek(end - 1)
+        if file.read(1) == b"\n":
+            return
+        start = max(0, end - 64 * 1024)
+        file.seek(start)
+        cut = file.read().rfind(b"\n")
+        file.truncate(start + cut + 1 if cut >= 0 else 0)
+
+class ChangeTracker:
+    # Tells the store's own writes apart from files changed by another
+    # process. The store calls written() after each write to a watched file;
+    # check() bumps the generation when a file differs from what was recorded.
+    def __init__(self, paths):
+        self.paths = paths
+        self.recorded = {path: file_signature(path) for path in paths}
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def written(self, path):
+        with self.lock:
+            self.recorded[path] = file_signature(path)
+
+    def check(self):
+        with self.lock:
+            current = {path: file_signature(path) for path in self.paths}
+            if current != self.recorded:
+                self.recorded = current
+                self.generation += 1
+            return self.generation
+
+class Deferral:
+    # Whether writes are deferred, per thread: true on a thread between
+    # enter() and its matching exit(), and blocks on one thread nest. Other
+    # threads keep writing through; active() tells if any thread defers.
+    def __init__(self):
+        self.local = threading.local()
+        self.threads = 0
+        self.lock = threading.Lock()
+
+    def __bool__(self):
+        return getattr(self.local, "depth", 0) > 0
+
+    def enter(self):
+        depth = getattr(self.local, "depth", 0)
+        if depth == 0:
+            with self.lock:
+                self.threads += 1
+        self.local.depth = depth + 1
+
+    def exit(self):
+        depth = getattr(self.local, "depth", 0)
+        if depth == 0:
+            return
+        self.local.depth = depth - 1
+        if depth == 1:
+            with self.lock:
+                self.threads -= 1
+
+    def active(self):
+        return self.threads > 0
+
+class AccountStore:
+    # Keeps every account row in memory keyed by (account_id, account_type).
+    # A balance change is appended to the update log instead of rewriting
+    # accounts.csv; compact() folds the log back into a fresh accounts.csv.
+    # Accounts that are not stored yet are appended to accounts.csv itself.
+    # Paged (see page()), rows only holds the rows newer than accounts.csv,
+    # the ones in the log or staged, and the others are read on demand at
+    # their byte offset in accounts.csv.
+    def __init__(self, path="accounts.csv", log_path="accounts.log", compact_every=10000, durability="flush"):
+        self.path = path
+        self.log_path = log_path
+        self.compact_every = compact_every
+        # As TransactionJournal: "fsync" forces every write to disk
+        self.durability = durability
+        self.rows = {}
+        self.pending_updates = 0
+        self.loaded = False
+        self.log_file = None
+        self.log_writer = None
+        # On a deferring thread, updates are only buffered until flush()
+        self.deferred = Deferral()
+        self.buffer = []
+        self.new_rows = []
+        # Called with the path after every write (see ChangeTracker)
+        self.on_write = None
+        self.paged = False
+        # Paged: (account_id, account_type) -> offset of its row in accounts.csv
+        self.offsets = {}
+        self.header = ACCOUNT_FIELDS
+        # Paged: kept open for positioned reads, replaced by compact()
+        self.fd = None
+        self.line_buffer = io.StringIO()
+        self.line_writer = csv.writer(self.line_buffer)
+        self.lock = threading.RLock()
+
+    @synchronized
+    def page(self):
+        # Reads rows on demand from now on instead of holding them all (the
+        # customer cache); called before the store is used
+        self.paged = True
+        self.unload()
+
+    @synchronized
+    def load(self):
+        self.rows = {}
+        self.pending_updates = 0
+        if os.path.exists(self.path):
+            with open(self.path, "r", newline='') as file:
+                header = next(csv.reader([file.readline()]), None)
+                for line in file:
+                    if not line.endswith("\n"):
+                        break  # torn row from a crash mid-write
+                    values = next(csv.reader([line]))
+                    if header == ACCOUNT_FIELDS:
+                        row = dict(zip(ACCOUNT_FIELDS, values))
+                    else:
+                        # Older files may lack some of the columns
+                        row = dict(zip(header, values))
+                        row = {field: row.get(field) or '' for field in ACCOUNT_FIELDS}
+                    self.rows[(row['account_id'], row['account_type'])] = row
+        self.read_log()
+        self.loaded = True
+
+    @synchronized
+    def index(self):
+        # Paged load: only the offsets of accounts.csv rows, and the log
+        self.close_fd()
+        self.rows = {}
+        self.offsets = {}
+        self.pending_updates = 0
+        for row, offset in self.scan():
+            # One string per account type across the keys
+            self.offsets[(row['account_id'], sys.intern(row['account_type']))] = offset
+        self.read_log()
+        self.loaded = True
+
+    def scan(self):
+        # Paged: (row, byte offset) of every complete row of accounts.csv
+        self.header = ACCOUNT_FIELDS
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as file:
+            line = file.readline()
+            self.header = next(csv.reader([line.decode("utf-8")]), None) or ACCOUNT_FIELDS
+            offset = len(line)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break  # torn row from a crash mid-write
+                yield self.parse_row(line), offset
+                offset += len(line)
+
+    def parse_row(self, line):
+        # As load() does, with the header scan() last read
+        values = next(csv.reader([line.decode("utf-8")]))
+        if self.header == ACCOUNT_FIELDS:
+            return dict(zip(ACCOUNT_FIELDS, values))
+        row = dict(zip(self.header, values))
+        return {field: row.get(field) or '' for field in ACCOUNT_FIELDS}
+
+    def read_log(self):
+        # Replay updates that were not compacted yet
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r", newline='') as file:
+                for line in file:
+                    if not line.endswith("\n"):
+                        break  # torn record from a crash mid-write
+                    values = next(csv.reader([line]))
+                    if len(values) != len(ACCOUNT_FIELDS):
+                        continue
+                    row = dict(zip(ACCOUNT_FIELDS, values))
+                    self.rows[(row['account_id'], row['account_type'])] = row
+                    self.pending_updates += 1
+        if metrics.enabled:
+            metrics.add_io(read=sum(os.path.getsize(path) for path in (self.path, self.log_path)
+                                    if os.path.exists(path)))
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            (self.index if self.paged else self.load)()
+
+    @synchronized
+    def unload(self):
+        # Read again on next use; anything staged has to be flushed first
+        self.rows = {}
+        self.offsets = {}
+        self.close_fd()
+        self.loaded = False
+
+    def close_fd(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    @synchronized
+    def replace_rows(self, rows):
+        # State that was loaded elsewhere (the snapshot), with nothing pending
+        self.rows = {(row['account_id'], row['account_type']): row for row in rows}
+        self.pending_updates = 0
+        self.buffer = []
+        self.new_rows = []
+        self.loaded = True
+
+    def get(self, account_id, account_type):
+        self.ensure_loaded()
+        row = self.rows.get((account_id, account_type))
+        if row is None and self.paged:
+            return self.read_row((account_id, account_type))
+        return row
+
+    @synchronized
+    def read_row(self, key):
+        # Paged: under the lock, so compact() cannot move the row meanwhile
+        row = self.rows.get(key)
+        offset = self.offsets.get(key)
+        if row is not None or offset is None:
+            return row
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        data = b""
+        while b"\n" not in data:
+            chunk = os.pread(self.fd, 512, offset + len(data))
+            if not chunk:
+                break
+            data += chunk
+        if metrics.enabled:
+            metrics.add_io(read=len(data))
+        return self.parse_row(data.split(b"\n", 1)[0])
+
+    @synchronized
+    def all_rows(self):
+        # Every row; paged, read from accounts.csv for the pass and not kept
+        self.ensure_loaded()
+        if not self.paged:
+            return list(self.rows.values())
+        return [row for _, row in self.merged_rows()]
+
+    def merged_rows(self):
+        # Paged: (key, row) of every account, accounts.csv streamed with the
+        # newer rows in place of the ones offsets points at, then new ones
+        newer = dict(self.rows)
+        for row, offset in self.scan():
+            key = (row['account_id'], row['account_type'])
+            if self.offsets.get(key) == offset:
+                yield key, newer.pop(key, row)
+        yield from newer.items()
+
+    @synchronized
+    def rows_by_customer(self):
+        groups = {}
+        for row in self.all_rows():
+            groups.setdefault(row['account_id'], []).append(row)
+        return groups
+
+    def stage(self, row):
+        key = (row['account_id'], row['account_type'])
+        (self.buffer if key in self.rows or key in self.offsets else self.new_rows).append(row)
+        self.rows[key] = row
+
+    @synchronized
+    def save(self, row):
+        self.ensure_loaded()
+        self.stage(row)
+        if not self.deferred:
+            self.flush()
+
+    @synchronized
+    def save_many(self, rows):
+        self.stage_many(rows)
+        if not self.deferred:
+            self.flush()
+
+    @synchronized
+    def stage_many(self, rows):
+        # Written by the next flush, whoever calls it
+        self.ensure_loaded()
+        for row in rows:
+            self.stage(row)
+
+    @synchronized
+    def flush(self):
+        if self.new_rows:
+            self.append_new_rows()
+        if not self.buffer:
+            return
+        if self.log_file is None:
+            # Appending after a torn record would join the next one onto it
+            drop_torn_line(self.log_path)
+            self.log_file = open(self.log_path, "a", newline='')
+            self.log_writer = csv.writer(self.log_file)
+        start = self.log_file.tell() if metrics.enabled else 0
+        self.log_writer.writerows([row[field] for field in ACCOUNT_FIELDS] for row in self.buffer)
+        self.log_file.flush()
+        if self.durability == "fsync":
+            os.fsync(self.log_file.fileno())
+        if metrics.enabled:
+            metrics.add_io(written=self.log_file.tell() - start)
+        if self.on_write is not None:
+            self.on_write(self.log_path)
+        self.pending_updates += len(self.buffer)
+        self.buffer = []
+        if self.pending_updates >= self.compact_every:
+            self.compact()
+
+    def append_new_rows(self):
+        # Nothing to fold in later, so a bulk import never triggers compaction.
+        # A file with an older column layout gets them through the log instead.
+        drop_torn_line(self.path)
+        try:
+            with open(self.path, "r", newline='') as file:
+                header = next(csv.reader(file), None)
+        except FileNotFoundError:
+            header = None
+        if header is not None and header != ACCOUNT_FIELDS:
+            self.buffer[:0] = self.new_rows
+            self.new_rows = []
+            return
+        with open(self.path, "a", newline='') as file:
+            start = file.tell()
+            writer = csv.writer(file)
+            if header is None:
+                writer.writerow(ACCOUNT_FIELDS)
+            if self.paged:
+                # Read back from accounts.csv from now on
+                self.write_paged(file, [((row['account_id'], row['account_type']), row) for row in self.new_rows],
+                                 self.offsets)
+                for row in self.new_rows:
+                    key = (row['account_id'], row['account_type'])
+                    if self.rows.get(key) is row:
+                        del self.rows[key]
+            else:
+                writer.writerows([row[field] for field in ACCOUNT_FIELDS] for row in self.new_rows)
+            if metrics.enabled:
+                metrics.add_io(written=file.tell() - start)
+            if self.durability == "fsync":
+                file.flush()
+                os.fsync(file.fileno())
+        if self.on_write is not None:
+            self.on_write(self.path)
+        self.new_rows = []
+
+    @synchronized
+    def compact(self):
+        self.ensure_loaded()
+        # Buffered rows are already part of self.rows
+        self.buffer = []
+        self.new_rows = []
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+            self.log_writer = None
+        # Write to a temp file first so a crash never leaves a half written accounts.csv
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(ACCOUNT_FIELDS)
+            if self.paged:
+                offsets = {}
+                self.write_paged(file, self.merged_rows(), offsets)
+            else:
+                for row in self.rows.values():
+                    writer.writerow([row[field] for field in ACCOUNT_FIELDS])
+            if self.durability == "fsync":
+                file.flush()
+                os.fsync(file.fileno())
+        self.close_fd()
+        os.replace(tmp_path, self.path)
+        self.header = ACCOUNT_FIELDS
+        if self.paged:
+            # Every row is in accounts.csv now
+            self.offsets = offsets
+            self.rows = {}
+        if metrics.enabled:
+            metrics.add_io(written=os.path.getsize(self.path))
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        if self.on_write is not None:
+            self.on_write(self.path)
+            self.on_write(self.log_path)
+        self.pending_updates = 0
+
+    def write_paged(self, file, rows, offsets):
+        # Writes (key, row) pairs to file, recording where each row starts
+        offset = file.tell()
+        for key, row in rows:
+            self.line_buffer.seek(0)
+            self.line_buffer.truncate()
+            self.line_writer.writerow([row[field] for field in ACCOUNT_FIELDS])
+            line = self.line_buffer.getvalue()
+            file.write(line)
+            offsets[key] = offset
+            offset += len(line.encode("utf-8"))
+
+    @synchronized
+    def close(self):
+        if self.loaded and (self.pending_updates or self.buffer or self.new_rows or self.log_file is not None):
+            self.compact()
+        self.close_fd()
+
+TRANSACTION_FIELDS = [
+    'account_id', 'transaction_type', 'amount', 'timestamp',
+    'balance_after', 'interest_earned', 'overdraft_fee',
+    'loan_duration', 'related_account', 'interest_charged', 'account_type'
+]
+
+def parse_ledger_line(line):
+    # Ledger lines are plain comma separated unless a value needed quoting
+    text = line.decode("utf-8")
+    if '"' in text:
+        return next(csv.reader([text]))
+    return text.rstrip("\r\n").split(",")
+
+class TransactionIndex:
+    # Sidecar index for transactions.csv mapping account_id to the byte
+    # offsets of its rows. Each line of transactions.idx is
+    # "account_id,offset,length"; the last entry tells how much of the ledger
+    # is covered, so a stale index only has to catch up on the tail.
+    def __init__(self, ledger_path="transactions.csv", path="transactions.idx"):
+        self.ledger_path = ledger_path
+        self.path = path
+        self.offsets = {}
+        self.covered = 0
+        self.pending = []
+        self.loaded = False
+
+    def load(self):
+        self.offsets = {}
+        self.covered = 0
+        self.pending = []
+        ledger_size = os.path.getsize(self.ledger_path) if os.path.exists(self.ledger_path) else 0
+        if os.path.exists(self.path):
+            with open(self.path, "r", newline='') as file:
+                for values in csv.reader(file):
+                    if len(values) != 3:
+                        continue  # torn record from a crash mid-write
+                    offset, length = int(values[1]), int(values[2])
+                    self.offsets.setdefault(values[0], array('q')).append(offset)
+                    self.covered = offset + length
+        self.loaded = True
+        if self.covered > ledger_size:
+            self.rebuild()
+        elif self.covered < ledger_size:
+            self.catch_up()
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def reset(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.loaded = False
+
+    def rebuild(self):
+        self.offsets = {}
+        self.covered = 0
+        self.pending = []
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.catch_up()
+
+    def catch_up(self):
+        if not os.path.exists(self.ledger_path):
+            return
+        with open(self.ledger_path, "rb") as file:
+            offset = self.covered
+            file.seek(offset)
+            if offset == 0:
+                offset = len(file.readline())  # header
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break  # partially written last row
+                self.add(parse_ledger_line(line)[0], offset, len(line))
+                offset += len(line)
+            if self.covered == 0:
+                self.covered = offset
+        self.flush()
+
+    def follow(self, end):
+        # Rows another process appended up to end. That process indexed them
+        # in transactions.idx already, so they are only added in memory.
+        # Returns their lines.
+        with open(self.ledger_path, "rb") as file:
+            file.seek(self.covered)
+            lines = file.read(end - self.covered).splitlines(keepends=True)
+        offset = self.covered
+        if offset == 0 and lines:
+            offset = len(lines.pop(0))  # header
+        for line in lines:
+            self.offsets.setdefault(parse_ledger_line(line)[0], array('q')).append(offset)
+            offset += len(line)
+        self.covered = offset
+        return lines
+
+    def add(self, account_id, offset, length):
+        self.offsets.setdefault(account_id, array('q')).append(offset)
+        self.pending.append(f"{account_id},{offset},{length}\n")
+        self.covered = offset + length
+
+    def flush(self):
+        if self.pending:
+            text = "".join(self.pending)
+            with open(self.path, "a", newline='') as file:
+                file.write(text)
+            if metrics.enabled:
+                metrics.add_io(written=len(text))
+            self.pending = []
+
+    def lookup(self, account_id, offset=0, limit=None):
+        # Newest first
+        offsets = self.offsets.get(account_id, ())
+        end = len(offsets) - offset
+        start = 0 if limit is None else max(end - limit, 0)
+        return [offsets[i] for i in range(end - 1, start - 1, -1)]
+
+class LedgerAggregates:
+    # Running totals over the ledger, updated as each row is posted: count and
+    # amount per transaction_type, overdraft fees and interest, per account
+    # (account_id, then account_type, as AccountStore keys balances) and
+    # bank-wide, plus bank-wide per-day buckets. covered is how far into the
+    # ledger the saved totals reach (a byte offset of transactions.csv, a row
+    # id in SQLite), so a stale copy only has to replay the tail.
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    @synchronized
+    def reset(self):
+        self.covered = 0
+        self.segment = None  # active ledger segment covered refers to (CSV)
+        self.bank = self.new_totals()
+        self.accounts = {}
+        self.days = {}
+        self.dirty = True
+
+    @staticmethod
+    def new_totals():
+        return {'types': {}, 'overdraft_fees': 0.0, 'interest_earned': 0.0, 'interest_charged': 0.0}
+
+    @staticmethod
+    def number(value):
+        # Fields read back from the ledger are text, and empty when unused
+        if not value:
+            return 0.0
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return 0.0
+
+    def add(self, transaction_data):
+        # Called once per posted row, so only the fields a row carries are converted
+        get = transaction_data.get
+        transaction_type = get('transaction_type') or ''
+        amount = self.number(get('amount'))
+        account_id = str(get('account_id', ''))
+        account_type = str(get('account_type') or '')
+        day = str(get('timestamp') or '')[:10]
+        with self.lock:
+            accounts = self.accounts.get(account_id)
+            if accounts is None:
+                accounts = self.accounts[account_id] = {}
+            account = accounts.get(account_type)
+            if account is None:
+                account = accounts[account_type] = self.new_totals()
+            types = self.days.get(day)
+            if types is None:
+                types = self.days[day] = {}
+            for types in (self.bank['types'], account['types'], types):
+                bucket = types.get(transaction_type)
+                if bucket is None:
+                    bucket = types[transaction_type] = [0, 0.0]
+                bucket[0] += 1
+                bucket[1] += amount
+            for field in ('overdraft_fee', 'interest_earned', 'interest_charged'):
+                value = get(field)
+                if value:
+                    value = self.number(value)
+                    key = 'overdraft_fees' if field == 'overdraft_fee' else field
+                    self.bank[key] += value
+                    account[key] += value
+            self.dirty = True
+
+    @synchronized
+    def totals(self, account_id=None, account_type=None):
+        # A copy of the bank-wide totals, of one account's, or of all the
+        # accounts of account_id added up when account_type is None
+        if account_id is None:
+            totals = self.bank
+        elif account_type is not None:
+            totals = self.accounts.get(account_id, {}).get(account_type, self.new_totals())
+        else:
+            totals = self.new_totals()
+            for account in self.accounts.get(account_id, {}).values():
+                self.merge_totals(totals, account)
+        return dict(totals, types={name: list(bucket) for name, bucket in totals['types'].items()})
+
+    @synchronized
+    def account_types(self, account_id):
+        # The account types of account_id that have postings, ledger rows
+        # written before rows carried a type come last under ''
+        rank = {account_type: i for i, account_type in enumerate(ACCOUNT_TYPES)}
+        return sorted(self.accounts.get(account_id, {}), key=lambda account_type: rank.get(account_type, len(rank)))
+
+    @synchronized
+    def by_day(self, start=None, end=None):
+        # {transaction_type: [count, amount]} over the inclusive YYYY-MM-DD range
+        combined = {}
+        for day, types in self.days.items():
+            if (start and day < start) or (end and day > end):
+                continue
+            for transaction_type, (count, amount) in types.items():
+                bucket = combined.setdefault(transaction_type, [0, 0.0])
+                bucket[0] += count
+                bucket[1] += amount
+        return combined
+
+    @staticmethod
+    def merge_types(target, types):
+        for transaction_type, (count, amount) in types.items():
+            bucket = target.setdefault(transaction_type, [0, 0.0])
+            bucket[0] += count
+            bucket[1] += amount
+
+    def merge_totals(self, target, totals):
+        self.merge_types(target['types'], totals['types'])
+        for key in ('overdraft_fees', 'interest_earned', 'interest_charged'):
+            target[key] += totals[key]
+
+    @synchronized
+    def merge(self, other):
+        # Adds the totals of another ledger, e.g. of another shard
+        with other.lock:
+            self.merge_totals(self.bank, other.bank)
+            for account_id, accounts in other.accounts.items():
+                target = self.accounts.setdefault(account_id, {})
+                for account_type, totals in accounts.items():
+                    self.merge_totals(target.setdefault(account_type, self.new_totals()), totals)
+            for day, types in other.days.items():
+                self.merge_types(self.days.setdefault(day, {}), types)
+        self.dirty = True
+
+    @synchronized
+    def dumps(self):
+        return json.dumps({'covered': self.covered, 'segment': self.segment, 'bank': self.bank,
+                           'account_totals': self.accounts, 'days': self.days})
+
+    @synchronized
+    def loads(self, text):
+        data = json.loads(text)
+        self.covered = int(data['covered'])
+        self.segment = data.get('segment')
+        self.bank = data['bank']
+        # Files saved before totals were split by account type have no
+        # account_totals: the KeyError makes the caller replay the ledger
+        self.accounts = data['account_totals']
+        self.days = data['days']
+        self.dirty = False
+
+class SegmentWriter:
+    # Writes a closed ledger segment as gzip members of BLOCK_ROWS lines
+    # each (concatenated they are still one valid .csv.gz) plus a
+    # <month>.blocks.json sidecar mapping every account to the blocks holding
+    # its rows, so account history only decompresses those blocks.
+    BLOCK_ROWS = 256
+
+    def __init__(self, path, blocks_path, entry, header):
+        self.path = path
+        self.blocks_path = blocks_path
+        self.entry = entry
+        self.fields = parse_ledger_line(header)
+        self.file = open(path + ".tmp", "wb")
+        self.lines = [header]
+        self.offsets = []
+        self.accounts = {}
+
+    def write(self, account_id, timestamp, line):
+        block = len(self.offsets)
+        blocks = self.accounts.get(account_id)
+        if blocks is None:
+            self.accounts[account_id] = [block]
+        elif blocks[-1] != block:
+            blocks.append(block)
+        self.lines.append(line)
+        LedgerSegments.track(self.entry, timestamp)
+        if len(self.lines) >= self.BLOCK_ROWS:
+            self.flush_block()
+
+    def flush_block(self):
+        if self.lines:
+            self.offsets.append(self.file.tell())
+            self.file.write(gzip.compress(b"".join(self.lines), compresslevel=6))
+            self.lines = []
+
+    def close(self):
+        # The sidecar goes first, a segment on disk always has one. A closed
+        # month is never written over.
+        if os.path.exists(self.path):
+            self.abort()
+            raise FileExistsError(f"ledger segment {self.path} already exists")
+        self.flush_block()
+        if metrics.enabled:
+            metrics.add_io(written=self.file.tell())
+        self.file.close()
+        with open(self.blocks_path + ".tmp", "w") as file:
+            json.dump({'fields': self.fields, 'offsets': self.offsets, 'accounts': self.accounts}, file)
+        os.replace(self.blocks_path + ".tmp", self.blocks_path)
+        os.replace(self.path + ".tmp", self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.path + ".tmp")
+
+class LedgerSegments:
+    # transactions.csv only holds the active month. When a posting for a
+    # later month arrives, the active file is compressed into
+    # <directory>/<YYYY-MM>.csv.gz (see SegmentWriter) and a fresh
+    # transactions.csv is started. manifest.json lists the closed segments
+    # (oldest first) with the first and last day they contain, so date-range
+    # reads only open the overlapping ones. A ledger written before segments
+    # existed is split by month the first time it is opened.
+    def __init__(self, ledger_path="transactions.csv", directory="ledger"):
+        self.ledger_path = ledger_path
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self.segments = []
+        self.active = None  # month of the rows in transactions.csv
+        self.block_indexes = {}
+        self.loaded = False
+        # manifest.json as last read or written here (see reload)
+        self.signature = None
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def month_of(timestamp):
+        month = str(timestamp or '')[:7]
+        return month if re.fullmatch(r"\d{4}-\d{2}", month) else None
+
+    @staticmethod
+    def track(entry, timestamp):
+        day = str(timestamp or '')[:10]
+        if day:
+            entry['first'] = min(entry['first'] or day, day)
+            entry['last'] = max(entry['last'] or day, day)
+        entry['rows'] += 1
+
+    def ensure_loaded(self):
+        # True when transactions.csv was rewritten (its offsets moved)
+        if self.loaded:
+            return False
+        os.makedirs(self.directory, exist_ok=True)
+        migrated = False
+        if os.path.exists(self.manifest_path):
+            self.read_manifest()
+        else:
+            migrated = self.migrate()
+        self.adopt_orphans()
+        self.save()
+        self.loaded = True
+        return migrated
+
+    def read_manifest(self):
+        with open(self.manifest_path, "r") as file:
+            manifest = json.load(file)
+        self.segments = manifest['segments']
+        self.active = manifest['active']
+        self.signature = file_signature(self.manifest_path)
+
+    def reload(self):
+        # True when another process sharing the ledger rotated it since.
+        # Called under the ledger lock (see TransactionJournal.commit).
+        if file_signature(self.manifest_path) == self.signature:
+            return False
+        self.read_manifest()
+        return True
+
+    def save(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({'active': self.active, 'segments': self.segments}, file, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+        self.signature = file_signature(self.manifest_path)
+
+    def new_entry(self, month):
+        return {'month': month, 'file': f"{month}.csv.gz", 'first': None, 'last': None, 'rows': 0}
+
+    def path_of(self, entry):
+        return os.path.join(self.directory, entry['file'])
+
+    def blocks_path_of(self, entry):
+        return os.path.join(self.directory, f"{entry['month']}.blocks.json")
+
+    def writer(self, entry, header):
+        return SegmentWriter(self.path_of(entry), self.blocks_path_of(entry), entry, header)
+
+    def has_rows(self):
+        with open(self.ledger_path, "rb") as file:
+            file.readline()
+            return bool(file.readline())
+
+    def migrate(self):
+        # Every month but the latest becomes a closed segment. Segments are
+        # written before transactions.csv is replaced, so a crash in between
+        # only repeats the split on the next start.
+        self.segments = []
+        self.active = None
+        if not os.path.exists(self.ledger_path) or os.path.getsize(self.ledger_path) == 0:
+            return False
+        with open(self.ledger_path, "r", newline='') as file:
+            months = {self.month_of(row.get('timestamp')) for row in csv.DictReader(file)}
+        months.discard(None)
+        if not months:
+            return False
+        self.active = max(months)
+        if len(months) == 1:
+            return False
+        line_buffer = io.StringIO()
+        line_writer = csv.writer(line_buffer)
+
+        def format_line(values):
+            line_buffer.seek(0)
+            line_buffer.truncate()
+            line_writer.writerow(values)
+            return line_buffer.getvalue().encode("utf-8")
+
+        header = format_line(TRANSACTION_FIELDS)
+        writers = {}
+        tmp_path = self.ledger_path + ".tmp"
+        try:
+            with open(self.ledger_path, "r", newline='') as file, open(tmp_path, "wb") as active:
+                active.write(header)
+                for row in csv.DictReader(file):
+                    line = format_line([row.get(field) or '' for field in TRANSACTION_FIELDS])
+                    month = self.month_of(row.get('timestamp'))
+                    if month is None or month == self.active:
+                        active.write(line)
+                        continue
+                    writer = writers.get(month)
+                    if writer is None:
+                        writer = writers[month] = self.writer(self.new_entry(month), header)
+                    writer.write(row.get('account_id') or '', row.get('timestamp'), line)
+        except BaseException:
+            for writer in writers.values():
+                writer.abort()
+            raise
+        for month in sorted(writers):
+            writers[month].close()
+            self.segments.append(writers[month].entry)
+        os.replace(tmp_path, self.ledger_path)
+        return True
+
+    def scan(self, month):
+        entry = self.new_entry(month)
+        for row in self.read(entry):
+            self.track(entry, row.get('timestamp'))
+        return entry
+
+    def adopt_orphans(self):
+        # Segments written by a rotation or migration that crashed before the
+        # manifest was saved
+        listed = {entry['file'] for entry in self.segments}
+        for name in sorted(os.listdir(self.directory)):
+            month = self.month_of(name[:7])
+            if month is None or name != f"{month}.csv.gz" or name in listed:
+                continue
+            if month == self.active:
+                if self.has_rows():
+                    # transactions.csv was not replaced yet, the rotation runs again
+                    os.remove(os.path.join(self.directory, name))
+                    continue
+                self.active = None
+            self.segments.append(self.scan(month))
+        self.segments.sort(key=lambda entry: entry['month'])
+
+    def close_active(self, next_month):
+        # Compress the active month and start transactions.csv over.
+        # The caller has closed its handle on it.
+        entry = self.new_entry(self.active)
+        with open(self.ledger_path, "rb") as source:
+            writer = self.writer(entry, source.readline())
+            try:
+                for line in source:
+                    if not line.endswith(b"\n"):
+                        break  # partially written last row
+                    values = parse_ledger_line(line)
+                    writer.write(values[0], values[3] if len(values) > 3 else '', line)
+            except BaseException:
+                writer.abort()
+                raise
+        writer.close()
+        header_path = self.ledger_path + ".tmp"
+        with open(header_path, "w", newline='') as file:
+            csv.writer(file).writerow(TRANSACTION_FIELDS)
+        os.replace(header_path, self.ledger_path)
+        self.segments.append(entry)
+        self.active = next_month
+        self.save()
+
+    def overlapping(self, start=None, end=None):
+        # Closed segments holding days in the inclusive YYYY-MM-DD range, oldest first
+        return [entry for entry in self.segments
+                if not (start and entry['last'] and entry['last'] < start)
+                and not (end and entry['first'] and entry['first'] > end)]
+
+    def read(self, entry, until=None):
+        # until: byte offset in the month's file before it was compressed
+        path = self.path_of(entry)
+        if metrics.enabled:
+            metrics.add_io(read=os.path.getsize(path))
+        with gzip.open(path, "rb") as file:
+            yield from _transactions_from_lines(file if until is None else _lines_before(file, until))
+
+    def block_index(self, entry):
+        blocks = self.block_indexes.get(entry['month'])
+        if blocks is None:
+            try:
+                with open(self.blocks_path_of(entry), "r") as file:
+                    blocks = json.load(file)
+            except (OSError, ValueError):
+                return None
+            self.block_indexes[entry['month']] = blocks
+        return blocks
+
+    def account_rows(self, entry, account_id):
+        # Rows of one account in ledger order, decompressing only its blocks
+        blocks = self.block_index(entry)
+        if blocks is None:
+            return [row for row in self.read(entry) if row.get('account_id') == account_id]
+        offsets = blocks['offsets']
+        prefix = account_id.encode("utf-8") + b","
+        rows = []
+        with open(self.path_of(entry), "rb") as file:
+            for block in blocks['accounts'].get(account_id, ()):
+                file.seek(offsets[block])
+                data = file.read(offsets[block + 1] - offsets[block]) if block + 1 < len(offsets) else file.read()
+                if metrics.enabled:
+                    metrics.add_io(read=len(data))
+                for line in gzip.decompress(data).splitlines(keepends=True):
+                    # Quoted lines cannot be told apart by their prefix
+                    if line.startswith(prefix) or line.startswith(b'"'):
+                        values = parse_ledger_line(line)
+                        if values[0] == account_id:
+                            rows.append(dict(zip(blocks['fields'], values)))
+        return rows
+
+class TransactionJournal:
+    # Keeps transactions.csv open and writes postings in groups. A group is
+    # written when batch_size rows are buffered, when flush_interval seconds
+    # passed since the last write (on the next posting, or by a timer if none
+    # comes), or when commit() is called explicitly.
+    # durability="flush" hands each group to the OS, "fsync" also forces it to disk.
+    # Older months live in compressed segments (LedgerSegments), the offset
+    # index only covers the active month.
+    def __init__(self, path="transactions.csv", batch_size=64, flush_interval=1.0, durability="flush",
+                 index_path="transactions.idx", aggregates_path="transactions.agg", segments_dir="ledger"):
+        if durability not in ("flush", "fsync"):
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.index = TransactionIndex(path, index_path)
+        self.segments = LedgerSegments(path, segments_dir)
+        # Saved on close and checkpoint, caught up from the ledger on open
+        self.aggregates = LedgerAggregates()
+        self.aggregates_path = aggregates_path
+        self.aggregates_loaded = False
+        # On a deferring thread, rows are only written by an explicit commit()
+        self.deferred = Deferral()
+        self.buffer = []
+        self.lock = threading.RLock()
+        self.file = None
+        self.last_commit = time.monotonic()
+        # Started by a posting that leaves rows buffered. Runs timed_commit,
+        # or commit() when it is None (CSVStorage also settles its writes).
+        self.timer = None
+        self.timed_commit = None
+        self.line_buffer = io.StringIO()
+        self.line_writer = csv.writer(self.line_buffer)
+        self.header_length = len(self.format_line(TRANSACTION_FIELDS))
+        # Rows written so far; with len(buffer), how many were appended
+        self.written = 0
+        # (entries, month, offset): where the buffer's first entries end, so
+        # positions() only walks what was buffered since
+        self.tail = None
+
+    def format_line(self, values):
+        self.line_buffer.seek(0)
+        self.line_buffer.truncate()
+        self.line_writer.writerow(values)
+        return self.line_buffer.getvalue().encode("utf-8")
+
+    def upgrade_header(self):
+        # Older ledgers were written with fewer columns, rewrite them once
+        # so that appended rows line up with the header
+        with open(self.path, "r", newline='') as file:
+            reader = csv.DictReader(file)
+            if reader.fieldnames is None or reader.fieldnames == TRANSACTION_FIELDS:
+                return
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", newline='') as out:
+                writer = csv.writer(out)
+                writer.writerow(TRANSACTION_FIELDS)
+                for row in reader:
+                    writer.writerow([row.get(field) or '' for field in TRANSACTION_FIELDS])
+        os.replace(tmp_path, self.path)
+        # Every offset moved
+        self.index.reset()
+        if os.path.exists(self.aggregates_path):
+            os.remove(self.aggregates_path)
+
+    @synchronized
+    def open(self):
+        if self.file is None:
+            if self.segments.ensure_loaded():
+                self.index.reset()
+            if os.path.exists(self.path):
+                self.upgrade_header()
+                drop_torn_line(self.path)
+            self.file = open(self.path, "ab")
+            if self.file.tell() == 0:
+                self.file.write(self.format_line(TRANSACTION_FIELDS))
+                self.file.flush()
+            self.index.ensure_loaded()
+        if not self.aggregates_loaded:
+            self.load_aggregates()
+
+    def load_aggregates(self):
+        self.aggregates.reset()
+        if os.path.exists(self.aggregates_path):
+            try:
+                with open(self.aggregates_path, "r") as file:
+                    self.aggregates.loads(file.read())
+            except (ValueError, KeyError, TypeError):
+                self.aggregates.reset()  # unreadable, replay the whole ledger
+        if self.aggregates.covered > os.path.getsize(self.path) or self.aggregates.segment != self.segments.active:
+            self.aggregates.reset()  # the ledger was replaced or rotated since
+        self.aggregates_loaded = True
+        self.catch_up_aggregates()
+
+    def catch_up_aggregates(self):
+        # Rows already on disk past the watermark. Called before anything is buffered.
+        if self.aggregates.covered == 0:
+            # Starting over, the closed segments count too
+            for entry in self.segments.segments:
+                for transaction in self.segments.read(entry):
+                    self.aggregates.add(transaction)
+        self.aggregates.segment = self.segments.active
+        with open(self.path, "rb") as file:
+            offset = self.aggregates.covered
+            file.seek(offset)
+            if offset == 0:
+                offset = len(file.readline())  # header
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break  # partially written last row
+                self.aggregates.add(dict(zip(TRANSACTION_FIELDS, parse_ledger_line(line))))
+                offset += len(line)
+            self.aggregates.covered = offset
+
+    @synchronized
+    def save_aggregates(self):
+        self.commit()
+        if not self.aggregates_loaded or not self.aggregates.dirty:
+            return
+        self.aggregates.covered = self.file.tell()
+        tmp_path = self.aggregates_path + ".tmp"
+        text = self.aggregates.dumps()
+        with open(tmp_path, "w") as file:
+            file.write(text)
+        if metrics.enabled:
+            metrics.add_io(written=len(text))
+        os.replace(tmp_path, self.aggregates_path)
+        self.aggregates.dirty = False
+
+    @synchronized
+    def rebuild_aggregates(self):
+        self.commit()
+        self.open()
+        self.aggregates.reset()
+        self.catch_up_aggregates()
+        self.save_aggregates()
+        return self.aggregates
+
+    @synchronized
+    def append(self, transaction_data):
+        if not self.aggregates_loaded:
+            self.open()
+        self.aggregates.add(transaction_data)
+        line = self.format_line([transaction_data.get(field, '') for field in TRANSACTION_FIELDS])
+        self.buffer.append((str(transaction_data.get('account_id', '')),
+                            LedgerSegments.month_of(transaction_data.get('timestamp')), line))
+        self.commit_when_due()
+
+    @synchronized
+    def format_rows(self, transactions):
+        # One csv pass for the whole group, split back into lines for the index
+        self.line_buffer.seek(0)
+        self.line_buffer.truncate()
+        self.line_writer.writerows([row.get(field, '') for field in TRANSACTION_FIELDS] for row in transactions)
+        lines = self.line_buffer.getvalue().encode("utf-8").splitlines(keepends=True)
+        if len(lines) != len(transactions):
+            # A quoted field spans lines, format row by row instead
+            lines = [self.format_line([row.get(field, '') for field in TRANSACTION_FIELDS]) for row in transactions]
+        return lines
+
+    def buffer_lines(self, transactions, lines):
+        if not self.aggregates_loaded:
+            self.open()
+        for transaction_data in transactions:
+            self.aggregates.add(transaction_data)
+        self.buffer.extend((str(row.get('account_id', '')), LedgerSegments.month_of(row.get('timestamp')), line)
+                           for row, line in zip(transactions, lines))
+
+    @synchronized
+    def append_many(self, transactions):
+        self.buffer_lines(transactions, self.format_rows(transactions))
+        if not self.deferred:
+            self.commit()
+
+    @synchronized
+    def append_formatted(self, transactions, lines):
+        # Rows already formatted by format_rows(), group committed like append()
+        self.buffer_lines(transactions, lines)
+        self.commit_when_due()
+
+    def commit_when_due(self):
+        if self.deferred:
+            return
+        if len(self.buffer) >= self.batch_size or time.monotonic() - self.last_commit >= self.flush_interval:
+            self.commit()
+        elif self.timer is None:
+            self.start_timer()
+
+    def start_timer(self):
+        self.timer = threading.Timer(self.flush_interval, self.on_timer)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def on_timer(self):
+        # Also writes what deferring threads buffered so far, which only
+        # writes their rows early
+        with self.lock:
+            self.timer = None
+        (self.timed_commit or self.commit)()
+
+    @synchronized
+    def stop_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    @synchronized
+    def commit(self):
+        if self.buffer:
+            self.open()
+            # Other processes may append to the same ledger, and rotate it
+            with file_lock(self.path + ".lock"):
+                self.follow()
+                group = []
+                for entry in self.buffer:
+                    month = entry[1]
+                    if month and (self.segments.active is None or month > self.segments.active):
+                        self.write_group(group)
+                        group = []
+                        self.rotate(month)
+                    group.append(entry)
+                self.write_group(group)
+            self.written += len(self.buffer)
+            self.buffer = []
+            self.tail = None
+        self.last_commit = time.monotonic()
+
+    def follow(self):
+        # Catches up with what other processes wrote since this one last
+        # held the ledger lock. A rotation replaced transactions.csv (this
+        # handle still points at the old file) and its index; appended rows
+        # only move the end. Buffered rows are counted in the aggregates
+        # already and are added back after a replay.
+        if self.segments.reload():
+            self.file.close()
+            self.file = open(self.path, "ab")
+            self.index.loaded = False
+            self.index.ensure_loaded()
+            self.aggregates.reset()
+            self.catch_up_aggregates()
+            for _, _, line in self.buffer:
+                self.aggregates.add(dict(zip(TRANSACTION_FIELDS, parse_ledger_line(line))))
+            return
+        end = self.file.seek(0, os.SEEK_END)
+        if end > self.index.covered:
+            for line in self.index.follow(end):
+                self.aggregates.add(dict(zip(TRANSACTION_FIELDS, parse_ledger_line(line))))
+
+    def write_group(self, group):
+        if not group:
+            return
+        offset = self.file.tell()
+        for account_id, _, line in group:
+            self.index.add(account_id, offset, len(line))
+            offset += len(line)
+        data = b"".join(line for _, _, line in group)
+        self.file.write(data)
+        if metrics.enabled:
+            metrics.add_io(written=len(data))
+        self.file.flush()
+        if self.durability == "fsync":
+            os.fsync(self.file.fileno())
+        # The index is written after the ledger so it never points past it
+        self.index.flush()
+
+    def rotate(self, month):
+        # First posting of a later month: the active month becomes a closed segment
+        if self.segments.active is not None and self.segments.has_rows():
+            self.file.close()
+            self.file = None
+            self.index.reset()
+            self.segments.close_active(month)
+            self.file = open(self.path, "ab")
+            self.index.ensure_loaded()
+            self.aggregates.covered = self.file.tell()
+        else:
+            self.segments.active = month
+            self.segments.save()
+        self.aggregates.segment = month
+        self.aggregates.dirty = True
+
+    @synchronized
+    def place(self, transactions, lines):
+        # Buffers formatted lines without committing them and returns the
+        # (month, byte offset) at which each will be written, walking the
+        # buffer the way commit() does: a later month starts a fresh file
+        # after the header. The offset stays valid once the month is
+        # compressed (see close_active). settle() then counts and commits
+        # them, unplace() takes them back; the caller holds the lock across.
+        if not self.aggregates_loaded:
+            self.open()
+        if self.tail is None:
+            self.open()
+            self.tail = (0, self.segments.active, self.file.tell())
+        walked, month, offset = self.tail
+        buffer = self.buffer
+        for _, entry_month, line in itertools.islice(buffer, walked, None):
+            month, offset = self.next_position(entry_month, month, offset)
+            offset += len(line)
+        positions = []
+        for row, line in zip(transactions, lines):
+            entry_month = LedgerSegments.month_of(row.get('timestamp'))
+            month, offset = self.next_position(entry_month, month, offset)
+            positions.append((month, offset))
+            offset += len(line)
+            buffer.append((str(row.get('account_id', '')), entry_month, line))
+        self.tail = (len(buffer), month, offset)
+        return positions
+
+    @synchronized
+    def unplace(self, count):
+        del self.buffer[len(self.buffer) - count:]
+        self.tail = None
+
+    @synchronized
+    def settle(self, transactions):
+        for transaction_data in transactions:
+            self.aggregates.add(transaction_data)
+        self.commit_when_due()
+
+    def next_position(self, entry_month, month, offset):
+        # Where commit() writes a line of entry_month after a line ending at (month, offset)
+        if entry_month and (month is None or entry_month > month):
+            if month is not None and offset > self.header_length:
+                offset = self.header_length
+            month = entry_month
+        return month, offset
+
+    @synchronized
+    def holds(self, position, line):
+        # Whether line was written at a position from positions()
+        self.open()
+        month, offset = position
+        if month is None or month == self.segments.active:
+            opener, path = open, self.path
+        else:
+            entry = next((entry for entry in self.segments.segments if entry['month'] == month), None)
+            if entry is None:
+                return False
+            opener, path = gzip.open, self.segments.path_of(entry)
+        with opener(path, "rb") as file:
+            file.seek(offset)
+            return file.read(len(line)) == line
+
+    @synchronized
+    def mark(self):
+        # Where the ledger ends now: the active month and the size of its file.
+        # Reads given until=mark leave out every row appended after it.
+        self.commit()
+        self.open()
+        return (self.segments.active, self.file.tell())
+
+    @synchronized
+    def history(self, account_id, offset=0, limit=None, start=None, end=None, until=None):
+        # Rows of one account, newest first, optionally only those dated
+        # start..end (inclusive YYYY-MM-DD days) and posted before the mark until
+        self.commit()
+        self.open()
+        rows = self.newest_first(account_id, offset, start, end, until)
+        try:
+            return list(itertools.islice(rows, limit))
+        finally:
+            rows.close()
+
+    def newest_first(self, account_id, offset, start, end, until=None):
+        # The active month is read by seeking to indexed offsets, older months
+        # come from the closed segments overlapping the range
+        month, size = until or (None, None)
+        positions = self.index.lookup(account_id)
+        if until is not None:
+            # A later month has begun since the mark when the active month differs
+            positions = [position for position in positions
+                         if self.segments.active == month and position < size]
+        if not (start or end):
+            # Rows that are skipped anyway need not be read
+            skipped = min(offset, len(positions))
+            positions = positions[skipped:]
+            offset -= skipped
+
+        def active_rows():
+            with open(self.path, "rb") as file:
+                for position in positions:
+                    file.seek(position)
+                    line = file.readline()
+                    if metrics.enabled:
+                        metrics.add_io(read=len(line))
+                    yield dict(zip(TRANSACTION_FIELDS, parse_ledger_line(line)))
+
+        for transaction in filter_transactions(active_rows(), None, None, start, end):
+            if offset:
+                offset -= 1
+                continue
+            yield transaction
+        for entry in reversed(self.segments.overlapping(start, end)):
+            if until is None or entry['month'] < month:
+                rows = self.segments.account_rows(entry, account_id)
+            elif entry['month'] == month:
+                # The marked month was closed since, so offsets need the whole file
+                rows = [row for row in self.segments.read(entry, size) if row.get('account_id') == account_id]
+            else:
+                continue
+            rows = list(filter_transactions(rows, None, None, start, end))
+            if offset >= len(rows):
+                offset -= len(rows)
+                continue
+            rows.reverse()
+            yield from rows[offset:]
+            offset = 0
+
+    def iter_transactions(self, use_mmap=False, start=None, end=None, until=None):
+        # The whole ledger oldest first, skipping closed segments outside start..end
+        # and, given a mark() as until, the rows appended after it
+        self.commit()
+        self.open()
+        month, size = until or (None, None)
+        for entry in self.segments.overlapping(start, end):
+            if until is None:
+                yield from self.segments.read(entry)
+            elif month is not None and entry['month'] <= month:
+                # The marked month may have been closed since
+                yield from self.segments.read(entry, size if entry['month'] == month else None)
+        if until is None or self.segments.active == month:
+            yield from read_transactions(self.path, use_mmap, size)
+
+    @synchronized
+    def ledger_sources(self):
+        self.commit()
+        self.open()
+        return ([("gzip", self.segments.path_of(entry)) for entry in self.segments.segments]
+                + [("csv", self.path)])
+
+    @synchronized
+    def close(self):
+        self.stop_timer()
+        self.save_aggregates()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.tail = None
+
+# Streaming transaction pipeline: read -> filter -> format -> write.
+# Every stage is a generator, so memory stays flat whatever the ledger size.
+def read_transactions(path="transactions.csv", use_mmap=False, until=None):
+    # until: stop at that byte offset, as if the file ended there
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    if metrics.enabled:
+        metrics.add_io(read=os.path.getsize(path) if until is None else min(until, os.path.getsize(path)))
+    with open(path, "rb") as file:
+        if use_mmap:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                lines = iter(mapped.readline, b"")
+                yield from _transactions_from_lines(lines if until is None else _lines_before(lines, until))
+        else:
+            yield from _transactions_from_lines(file if until is None else _lines_before(file, until))
+
+def _lines_before(lines, until):
+    # Lines starting before byte offset until, header included
+    offset = 0
+    for line in lines:
+        if offset >= until:
+            return
+        offset += len(line)
+        yield line
+
+def _transactions_from_lines(lines):
+    # The header comes from the file itself so older ledgers stream too
+    fieldnames = parse_ledger_line(next(lines, b""))
+    for line in lines:
+        if not line.endswith(b"\n"):
+            break  # partially written last row
+        yield dict(zip(fieldnames, parse_ledger_line(line)))
+
+def filter_transactions(transactions, account_id=None, transaction_types=None, start=None, end=None):
+    # start and end are inclusive YYYY-MM-DD dates, timestamps sort as text
+    for transaction in transactions:
+        if account_id is not None and transaction['account_id'] != account_id:
+            continue
+        if transaction_types and transaction['transaction_type'] not in transaction_types:
+            continue
+        day = transaction['timestamp'][:10]
+        if start and day < start:
+            continue
+        if end and day > end:
+            continue
+        yield transaction
+
+def format_transaction(transaction):
+    lines = [f"Account: {transaction['account_id']} | "
+             f"Type: {transaction['transaction_type']} | "
+             f"Amount: {transaction['amount']} | "
+             f"Time: {transaction['timestamp']}"]
+    if transaction.get('interest_earned') and float(transaction['interest_earned']) > 0:
+        lines.append(f"  Interest Earned: {transaction['interest_earned']}")
+    if transaction.get('overdraft_fee') and float(transaction['overdraft_fee']) > 0:
+        lines.append(f"  Overdraft Fee: {transaction['overdraft_fee']}")
+    if transaction.get('loan_duration'):
+        lines.append(f"  Loan Duration: {transaction['loan_duration']} months")
+    if transaction.get('related_account'):
+        lines.append(f"  Related Account: {transaction['related_account']}")
+    lines.append("-" * 50)
+    return "\n".join(lines) + "\n"
+
+def format_transactions(transactions):
+    for transaction in transactions:
+        yield format_transaction(transaction)
+
+def write_buffered(chunks, out, buffer_size=64 * 1024):
+    # Collects text chunks and hands them to out in large writes
+    buffer = []
+    size = 0
+    count = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        count += 1
+        if size >= buffer_size:
+            out.write("".join(buffer))
+            buffer = []
+            size = 0
+    if buffer:
+        out.write("".join(buffer))
+    out.flush()
+    return count
+
+class TransferLog:
+    # Intent records of transfers (transfers.log). One CSV line holds where
+    # each leg's ledger line will land in its journal (month and byte offset,
+    # see TransactionJournal.positions), both new account rows and both
+    # ledger lines as the journal formatted them, and is appended before
+    # either leg is applied. A torn last line means the transfer never took
+    # effect. Complete lines are replayed by recover_transfers() and dropped
+    # once both legs are written.
+    #
+    # Each process writes its own log: the first of transfers.log,
+    # transfers.log.1, ... whose .lock it can flock, held until close(). A
+    # log whose lock is free belongs to no live process, so only those are
+    # replayed (see unowned()).
+    RECORD_LENGTH = 4 + 2 * len(ACCOUNT_FIELDS) + 2 * len(TRANSACTION_FIELDS)
+
+    def __init__(self, path="transfers.log", durability="flush"):
+        self.base_path = path
+        self.durability = durability
+        # Claimed on first use
+        self.path = None
+        self.owner = None
+        self.file = None
+        self.pending = False
+        self.lock = threading.RLock()
+        self.line_buffer = io.StringIO()
+        self.line_writer = csv.writer(self.line_buffer)
+
+    def slot_paths(self):
+        # Every log next to the base one, claimed or not, base first
+        directory, name = os.path.split(self.base_path)
+        pattern = re.compile(re.escape(name) + r"\.(\d+)$")
+        numbers = sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(directory or "."))
+                         if match)
+        return [self.base_path] + [f"{self.base_path}.{number}" for number in numbers]
+
+    def take(self, path, owner):
+        self.path = path
+        self.owner = owner
+        self.pending = os.path.exists(path) and os.path.getsize(path) > 0
+
+    @synchronized
+    def claim(self):
+        if self.path is not None:
+            return
+        for number in itertools.count():
+            path = self.base_path if number == 0 else f"{self.base_path}.{number}"
+            owner = try_file_lock(path + ".lock")
+            if owner is not None:
+                self.take(path, owner)
+                return
+
+    @synchronized
+    def unowned(self):
+        # This process's log, then a TransferLog for each other log no live
+        # process holds, claimed until the caller closes it
+        self.claim()
+        logs = [self]
+        for path in self.slot_paths():
+            if path == self.path or not os.path.exists(path):
+                continue
+            owner = try_file_lock(path + ".lock")
+            if owner is not None:
+                log = TransferLog(self.base_path, self.durability)
+                log.take(path, owner)
+                logs.append(log)
+        return logs
+
+    def format_line(self, values):
+        self.line_buffer.seek(0)
+        self.line_buffer.truncate()
+        self.line_writer.writerow(values)
+        return self.line_buffer.getvalue().encode("utf-8")
+
+    @synchronized
+    def append(self, rows, positions, lines):
+        if self.file is None:
+            self.claim()
+            self.file = open(self.path, "ab")
+        (month, offset), (other_month, other_offset) = positions
+        values = [month or '', offset, other_month or '', other_offset]
+        for row in rows:
+            values += map(row.__getitem__, ACCOUNT_FIELDS)
+        # Ledger lines are complete csv lines (ending in \r\n), so joined with
+        # commas they stay one record
+        data = b",".join((self.format_line(values)[:-2], lines[0][:-2], lines[1][:-2])) + b"\r\n"
+        self.file.write(data)
+        self.file.flush()
+        if self.durability == "fsync":
+            os.fsync(self.file.fileno())
+        if metrics.enabled:
+            metrics.add_io(written=len(data))
+        self.pending = True
+
+    @synchronized
+    def records(self):
+        # (rows, positions, transactions, lines) of every complete record,
+        # values as text. The lines are formatted again, byte for byte as the
+        # journal wrote them.
+        records = []
+        if self.path is None or not os.path.exists(self.path):
+            return records
+        accounts = len(ACCOUNT_FIELDS)
+        with open(self.path, "r", newline='') as file:
+            for line in file:
+                values = next(csv.reader([line]), [])
+                if not line.endswith("\n") or len(values) != self.RECORD_LENGTH:
+                    break  # torn record from a crash mid-write
+                positions = [(values[0] or None, int(values[1])), (values[2] or None, int(values[3]))]
+                rows = [dict(zip(ACCOUNT_FIELDS, values[4:4 + accounts])),
+                        dict(zip(ACCOUNT_FIELDS, values[4 + accounts:4 + 2 * accounts]))]
+                ledger = values[4 + 2 * accounts:]
+                postings = [ledger[:len(TRANSACTION_FIELDS)], ledger[len(TRANSACTION_FIELDS):]]
+                records.append((rows, positions, [dict(zip(TRANSACTION_FIELDS, posting)) for posting in postings],
+                                [self.format_line(posting) for posting in postings]))
+        return records
+
+    @synchronized
+    def truncate(self):
+        if not self.pending:
+            return
+        if self.file is not None:
+            # Opened for appending, so later writes still start at offset 0
+            self.file.truncate(0)
+        else:
+            open(self.path, "wb").close()
+        self.pending = False
+
+    @synchronized
+    def close(self):
+        # Gives up the claim, whatever the log still holds
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.owner is not None:
+            self.owner.close()
+            self.owner = None
+        self.path = None
+        self.pending = False
+
+def log_transfer(transfers, legs, rows, transactions, lines):
+    # Appends a transfer to transfers and buffers each leg's ledger line in
+    # the journal of its storage (legs: the CSVStorage of each leg). Those
+    # journals stay locked from placing the lines until they are counted,
+    # so nothing commits them before the record is written and they land
+    # where it says. The account rows are staged after.
+    if legs[0] is legs[1]:
+        groups = [(legs[0], rows, transactions, lines)]
+    else:
+        # Locked in a fixed order
+        groups = sorted([(legs[leg], rows[leg:leg + 1], transactions[leg:leg + 1], lines[leg:leg + 1])
+                         for leg in (0, 1)], key=lambda group: group[0].root)
+    for storage, *_ in groups:
+        storage.journal.lock.acquire()
+    try:
+        placed = []
+        try:
+            positions = []
+            for storage, _, own_transactions, own_lines in groups:
+                positions += storage.journal.place(own_transactions, own_lines)
+                placed.append((storage.journal, len(own_lines)))
+            if groups[0][0] is not legs[0]:
+                positions.reverse()  # back in leg order
+            transfers.append(rows, positions, lines)
+        except BaseException:
+            for journal, count in placed:
+                journal.unplace(count)
+            raise
+        for storage, _, own_transactions, _ in groups:
+            storage.journal.settle(own_transactions)
+            storage.transfer_horizon = storage.journal.written + len(storage.journal.buffer)
+    finally:
+        for storage, *_ in reversed(groups):
+            storage.journal.lock.release()
+    for storage, own_rows, *_ in groups:
+        storage.account_store.stage_many(own_rows)
+
+def recover_transfers(records, storage_for):
+    # Completes logged transfers, always both legs: a complete record is a
+    # committed transfer. A leg whose ledger line is not at the position
+    # logged for it was never written, and neither was anything buffered
+    # after it in that journal, so the missing lines are appended in log
+    # order. Then every account involved takes the balance after its newest
+    # ledger row, whichever of its account rows the crash let through.
+    # storage_for(account_id) is the CSVStorage holding the account.
+    legs = [(storage_for(row['account_id']), row, position, transaction_data, line)
+            for rows, positions, transactions, lines in records
+            for row, position, transaction_data, line in zip(rows, positions, transactions, lines)]
+    missing = [leg for leg in legs if not leg[0].journal.holds(leg[2], leg[4])]
+    for storage, _, _, transaction_data, line in missing:
+        storage.journal.append_formatted([transaction_data], [line])
+    accounts = {(row['account_id'], row['account_type']): (storage, row) for storage, row, *_ in legs}
+    for storage, row in accounts.values():
+        storage.roll_forward(row)
+
+def recover_logs(storage, transfers, storage_for):
+    # Replays this process's transfer log and those left by processes that
+    # died; logs of running processes are theirs to write. Returns how many
+    # transfers were replayed.
+    replayed = 0
+    for log in transfers.unowned():
+        records = log.records()
+        if records:
+            recover_transfers(records, storage_for)
+        storage.commit()
+        if log is not transfers:
+            log.truncate()
+            log.close()
+        replayed += len(records)
+    return replayed
+
+@contextmanager
+def gc_paused():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+class Snapshot:
+    # Binary image of customers.csv and accounts.csv for fast startup.
+    # Layout: header, a NUL separated string table, then fixed width
+    # records stored as typed arrays (string table indexes and floats).
+    MAGIC = b"BANKSNP1"
+    HEADER = struct.Struct("<8sQQQQ")
+    CUSTOMER_FIELDS = ['customer_id', 'password', 'first_name', 'last_name', 'address']
+    FLOAT_FIELDS = ['balance', 'interest_rate', 'credit_limit', 'overdraft_fee']
+
+    def __init__(self, path="bank.snapshot"):
+        self.path = path
+
+    def is_fresh(self, sources):
+        # Only trusted when strictly newer than every source file that exists
+        if not os.path.exists(self.path):
+            return False
+        snapshot_mtime = os.stat(self.path).st_mtime_ns
+        return all(os.stat(source).st_mtime_ns < snapshot_mtime for source in sources if os.path.exists(source))
+
+    def write(self, customers, account_rows):
+        strings = {}
+
+        def intern(value):
+            index = strings.get(value)
+            if index is None:
+                index = strings[value] = len(strings)
+            return index
+
+        customer_refs = array('Q')
+        for customer in customers:
+            customer_refs.extend((intern(customer.id), intern(customer.password), intern(customer.first_name),
+                                  intern(customer.last_name), intern(customer.address)))
+        account_refs = array('Q')
+        values = array('d')
+        for row in account_rows:
+            account_refs.extend((intern(row['account_id']), intern(row['account_type'])))
+            values.extend(float(row[field]) if row[field] else math.nan for field in self.FLOAT_FIELDS)
+        table = "\0".join(strings).encode("utf-8")
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(self.HEADER.pack(self.MAGIC, len(table), len(customer_refs) // 5, len(account_refs) // 2, len(strings)))
+            file.write(table)
+            file.write(customer_refs.tobytes())
+            file.write(account_refs.tobytes())
+            file.write(values.tobytes())
+            if metrics.enabled:
+                metrics.add_io(written=file.tell())
+        os.replace(tmp_path, self.path)
+
+    def read(self):
+        with open(self.path, "rb") as file:
+            data = file.read()
+        if metrics.enabled:
+            metrics.add_io(read=len(data))
+        magic, table_size, customer_count, account_count, string_count = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC:
+            raise ValueError("not a banking snapshot")
+        position = self.HEADER.size
+        strings = data[position:position + table_size].decode("utf-8").split("\0") if string_count else []
+        position += table_size
+
+        def take(typecode, count):
+            nonlocal position
+            values = array(typecode)
+            values.frombytes(data[position:position + count * values.itemsize])
+            position += count * values.itemsize
+            return values
+
+        customer_refs = take('Q', customer_count * 5)
+        account_refs = take('Q', account_count * 2)
+        values = take('d', account_count * 4)
+
+        names = [strings[ref] for ref in customer_refs]
+        customers = [tuple(names[i:i + 5]) for i in range(0, len(names), 5)]
+        keys = [strings[ref] for ref in account_refs]
+        texts = ['' if value != value else str(value) for value in values]  # NaN marks an empty field
+        account_rows = [
+            {'account_id': keys[i * 2], 'account_type': keys[i * 2 + 1], 'balance': texts[i * 4],
+             'interest_rate': texts[i * 4 + 1], 'credit_limit': texts[i * 4 + 2], 'overdraft_fee': texts[i * 4 + 3]}
+            for i in range(account_count)
+        ]
+        return customers, account_rows
+
+class CustomerIndex:
+    # Byte offset of every customer's row in customers.csv, so that one
+    # customer can be read without loading the file. The file only grows;
+    # rows past the indexed end are picked up when a lookup misses.
+    def __init__(self, path="customers.csv"):
+        self.path = path
+        self.offsets = {}
+        self.header = None
+        self.end = 0
+        # Kept open for positioned reads, appended rows are visible through it
+        self.fd = None
+        self.lock = threading.RLock()
+
+    @synchronized
+    def catch_up(self):
+        if not os.path.exists(self.path):
+            return
+        if os.path.getsize(self.path) < self.end:
+            # Replaced by a shorter file, start over
+            self.close()
+            self.offsets = {}
+            self.end = 0
+        with open(self.path, "rb") as file:
+            if self.end == 0:
+                line = file.readline()
+                self.header = next(csv.reader([line.decode("utf-8")]), None)
+                self.end = len(line)
+            file.seek(self.end)
+            offset = self.end
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break  # still being written
+                self.offsets[line.split(b",", 1)[0].strip(b'"').decode("utf-8")] = offset
+                offset += len(line)
+            if metrics.enabled:
+                metrics.add_io(read=offset - self.end)
+            self.end = offset
+
+    def read(self, customer_id):
+        # Cache misses call this from server and posting threads at once. The
+        # lock covers opening fd and the read, so a catch_up that replaces
+        # the file cannot close fd (or reset offsets) under another reader.
+        with self.lock:
+            offset = self.offsets.get(customer_id)
+            if offset is None:
+                self.catch_up()
+                offset = self.offsets.get(customer_id)
+                if offset is None:
+                    return None
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDONLY)
+            header = self.header
+            data = b""
+            while b"\n" not in data:
+                chunk = os.pread(self.fd, 512, offset + len(data))
+                if not chunk:
+                    break
+                data += chunk
+        line = data.split(b"\n", 1)[0]
+        if metrics.enabled:
+            metrics.add_io(read=len(data))
+        row = dict(zip(header, next(csv.reader([line.decode("utf-8")]))))
+        return tuple(row.get(field) or '' for field in Snapshot.CUSTOMER_FIELDS)
+
+    @synchronized
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class Storage(ABC):
+    # Persistence behind Account, Customer and BankingSystem. Rows are dicts
+    # laid out like the CSV files (ACCOUNT_FIELDS, TRANSACTION_FIELDS) and
+    # customers are (customer_id, password, first_name, last_name, address).
+    @abstractmethod
+    def load(self, use_snapshot=True):
+        # Returns (customer tuples, {account_id: [account rows]})
+        pass
+
+    @abstractmethod
+    def get_account(self, account_id, account_type):
+        pass
+
+    @abstractmethod
+    def get_customer(self, customer_id):
+        # The customer tuple, None for an unknown id
+        pass
+
+    @abstractmethod
+    def save_account(self, row):
+        pass
+
+    @abstractmethod
+    def save_customer(self, customer):
+        pass
+
+    @abstractmethod
+    def append_transaction(self, transaction_data):
+        pass
+
+    @abstractmethod
+    def reserve_ids(self, name, count, floor=1):
+        # Reserves count consecutive ids of the named sequence, none below
+        # floor, and returns the first. Persisted before it returns.
+        pass
+
+    @abstractmethod
+    def transaction_history(self, account_id, offset=0, limit=None, start=None, end=None, until=None):
+        # Newest first, start and end are inclusive YYYY-MM-DD days.
+        # until is a ledger_mark(): rows posted after it are left out.
+        pass
+
+    @abstractmethod
+    def iter_transactions(self, use_mmap=False, start=None, end=None, until=None):
+        # Whole ledger, oldest first, as a stream. start/end let the storage
+        # skip data outside the range; callers still filter the rows.
+        pass
+
+    @abstractmethod
+    def ledger_mark(self):
+        # Opaque position of the end of the ledger after committing what is
+        # buffered, for the until argument of the two reads above
+        pass
+
+    @abstractmethod
+    def ledger_sources(self):
+        # Committed ledger as (kind, path) pairs, oldest first, that another
+        # process can read: "gzip" and "csv" files or a "sqlite" database
+        pass
+
+    @abstractmethod
+    def ledger_aggregates(self):
+        # LedgerAggregates covering every posted row
+        pass
+
+    @abstractmethod
+    def rebuild_aggregates(self):
+        # Recomputes the aggregates from the full ledger
+        pass
+
+    @abstractmethod
+    def load_admin_password(self):
+        pass
+
+    @abstractmethod
+    def save_admin_password(self, password):
+        pass
+
+    @abstractmethod
+    def set_deferred(self, deferred):
+        pass
+
+    @abstractmethod
+    def commit(self):
+        pass
+
+    @abstractmethod
+    def checkpoint(self, customers):
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+    def data_version(self):
+        # Changes when another process changed the stored customers or
+        # accounts; the store's own writes leave it alone. None when the
+        # store cannot tell, callers then have to reload.
+        return None
+
+    def iter_accounts(self):
+        # Every stored account row
+        _, accounts_by_customer = self.load(use_snapshot=False)
+        for rows in accounts_by_customer.values():
+            yield from rows
+
+    def iter_customers(self):
+        # Every stored customer tuple
+        customers, _ = self.load(use_snapshot=False)
+        return customers
+
+    def customer_accounts(self, customer_id):
+        # Account rows of one customer
+        rows = (self.get_account(customer_id, account_type) for account_type in ACCOUNT_TYPES)
+        return [row for row in rows if row]
+
+    def reload(self):
+        # Drops rows kept in memory, so later reads see other processes' writes
+        pass
+
+    def save_accounts(self, rows):
+        for row in rows:
+            self.save_account(row)
+
+    def save_customers(self, customers):
+        for customer in customers:
+            self.save_customer(customer)
+
+    def append_transactions(self, transactions):
+        for transaction_data in transactions:
+            self.append_transaction(transaction_data)
+
+    def commit_transfer(self, rows, transactions):
+        # Both legs of a transfer as one unit: the two new account rows and
+        # the two ledger rows
+        with self.atomic():
+            self.save_accounts(rows)
+            self.append_transactions(transactions)
+
+    def recover(self):
+        # Completes transfers a crash interrupted, returns how many were
+        # replayed. Called once at startup, before load().
+        return 0
+
+    def page_accounts(self):
+        # With the customer cache: account rows are read when asked for
+        # instead of all being held in memory. Called before recover().
+        pass
+
+    @contextmanager
+    def atomic(self):
+        # Groups the writes of one logical operation (e.g. both legs of a transfer)
+        yield
+
+    @contextmanager
+    def deferred(self):
+        # Writes are buffered until the block ends. Blocks nest and may
+        # overlap on other threads; how far the deferral reaches depends on
+        # the engine (see set_deferred).
+        self.set_deferred(True)
+        try:
+            yield
+        finally:
+            self.set_deferred(False)
+            self.commit()
+
+class CSVStorage(Storage):
+    # customers.csv, accounts.csv (+ accounts.log), transactions.csv
+    # (+ transactions.idx), transfers.log, admin.csv and bank.snapshot inside root
+    def __init__(self, root=".", durability="flush"):
+        self.root = root
+        self.customers_path = os.path.join(root, "customers.csv")
+        self.admin_path = os.path.join(root, "admin.csv")
+        self.sequences_path = os.path.join(root, "sequences.json")
+        self.durability = durability
+        self.account_store = AccountStore(os.path.join(root, "accounts.csv"), os.path.join(root, "accounts.log"),
+                                          durability=durability)
+        self.journal = TransactionJournal(os.path.join(root, "transactions.csv"), durability=durability,
+                                          index_path=os.path.join(root, "transactions.idx"),
+                                          aggregates_path=os.path.join(root, "transactions.agg"),
+                                          segments_dir=os.path.join(root, "ledger"))
+        self.snapshot = Snapshot(os.path.join(root, "bank.snapshot"))
+        self.transfers = TransferLog(os.path.join(root, "transfers.log"), durability)
+        self.transfer_lock = threading.Lock()
+        # One deferral for the store and the journal
+        self.deferral = Deferral()
+        self.account_store.deferred = self.deferral
+        self.journal.deferred = self.deferral
+        # Journal rows written once the last logged transfer is (see log_transfer)
+        self.transfer_horizon = 0
+        self.customer_lock = threading.Lock()
+        self.customer_index = CustomerIndex(self.customers_path)
+        self.changes = ChangeTracker([self.customers_path, self.account_store.path, self.account_store.log_path])
+        self.account_store.on_write = self.changes.written
+        self.journal.timed_commit = self.commit
+
+    def load(self, use_snapshot=True):
+        # The binary snapshot is used when it is newer than the CSV files
+        sources = [self.customers_path, self.account_store.path, self.account_store.log_path]
+        if use_snapshot and self.snapshot.is_fresh(sources):
+            try:
+                customers, account_rows = self.snapshot.read()
+                self.account_store.replace_rows(account_rows)
+                return customers, self.account_store.rows_by_customer()
+            except Exception as e:
+                print(f"Error loading snapshot, falling back to CSV files: {e}")
+        self.account_store.load()
+        return self.read_customers(), self.account_store.rows_by_customer()
+
+    def read_customers(self):
+        customers = []
+        if os.path.exists(self.customers_path):
+            with open(self.customers_path, "r", newline='') as file:
+                reader = csv.DictReader(file)
+                for row in reader:
+                    customers.append((row['customer_id'], row['password'], row['first_name'],
+                                      row['last_name'], row['address']))
+            if metrics.enabled:
+                metrics.add_io(read=os.path.getsize(self.customers_path))
+        return customers
+
+    def get_account(self, account_id, account_type):
+        return self.account_store.get(account_id, account_type)
+
+    def get_customer(self, customer_id):
+        return self.customer_index.read(customer_id)
+
+    def iter_accounts(self):
+        return self.account_store.all_rows()
+
+    def iter_customers(self):
+        return self.read_customers()
+
+    def reload(self):
+        self.account_store.unload()
+
+    def save_account(self, row):
+        self.account_store.save(row)
+
+    def save_accounts(self, rows):
+        self.account_store.save_many(rows)
+
+    def save_customer(self, customer):
+        self.save_customers([customer])
+
+    def save_customers(self, customers):
+        with self.customer_lock:
+            file_exists = os.path.exists(self.customers_path)
+            with open(self.customers_path, "a", newline='') as file:
+                writer = csv.writer(file)
+                if not file_exists:
+                    writer.writerow(Snapshot.CUSTOMER_FIELDS)
+                writer.writerows(customers)
+            self.changes.written(self.customers_path)
+
+    def reserve_ids(self, name, count, floor=1):
+        # sequences.json holds the next free id of every sequence. It is read
+        # again on each reservation, under a lock on sequences.json.lock, so
+        # processes sharing the files never hand out the same block.
+        with self.customer_lock, file_lock(self.sequences_path + ".lock"):
+            sequences = {}
+            if os.path.exists(self.sequences_path):
+                with open(self.sequences_path, "r") as file:
+                    sequences = json.load(file)
+            start = max(sequences.get(name, floor), floor)
+            sequences[name] = start + count
+            tmp_path = self.sequences_path + ".tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(sequences, file)
+                if self.durability == "fsync":
+                    file.flush()
+                    os.fsync(file.fileno())
+            os.replace(tmp_path, self.sequences_path)
+            return start
+
+    def data_version(self):
+        return self.changes.check()
+
+    def append_transaction(self, transaction_data):
+        self.journal.append(transaction_data)
+        self.settle_transfers(blocking=False)
+
+    def append_transactions(self, transactions):
+        self.journal.append_many(transactions)
+        self.settle_transfers(blocking=False)
+
+    def commit_transfer(self, rows, transactions):
+        # The one append to transfers.log is what makes the transfer durable.
+        # Its rows then go out with the next group commit.
+        with self.transfer_lock:
+            lines = self.journal.format_rows(transactions)
+            if self.account_store.deferred:
+                self.stage_transfer(rows, transactions, lines)
+            else:
+                self.write_deferred()
+                log_transfer(self.transfers, [self, self], rows, transactions, lines)
+                self.flush_transferred()
+            if self.transfers_written():
+                self.transfers.truncate()
+
+    def stage_transfer(self, rows, transactions, lines):
+        # Not logged: while deferred, postings before it may still be
+        # buffered, and a replay of the transfer alone would apply it to
+        # balances that never reached the files. It is written, or lost,
+        # with them.
+        self.journal.append_formatted(transactions, lines)
+        self.account_store.stage_many(rows)
+
+    def flush_transferred(self):
+        if self.journal.written >= self.transfer_horizon and not self.account_store.deferred:
+            # The journal wrote the lines of every logged transfer, the account rows follow
+            self.account_store.flush()
+
+    def transfers_written(self):
+        # Every logged transfer is in the files: its lines are past the
+        # journal's buffer and no account row is staged
+        return (self.journal.written >= self.transfer_horizon
+                and not (self.account_store.buffer or self.account_store.new_rows))
+
+    def settle_transfers(self, blocking=True):
+        # Empties transfers.log once every logged transfer is in the files.
+        # After a write it is only tried: a transfer being logged settles it
+        # itself.
+        if not self.transfers.pending or not self.transfer_lock.acquire(blocking):
+            return
+        try:
+            self.flush_transferred()
+            if self.transfers_written():
+                self.transfers.truncate()
+        finally:
+            self.transfer_lock.release()
+
+    def recover(self):
+        return recover_logs(self, self.transfers, lambda account_id: self)
+
+    def page_accounts(self):
+        self.account_store.page()
+
+    def roll_forward(self, row):
+        # Recovery: the account takes the balance after its newest ledger row
+        for transaction_data in self.journal.history(row['account_id']):
+            if transaction_data.get('account_type') == row['account_type']:
+                stored = self.get_account(row['account_id'], row['account_type']) or row
+                balance = float(transaction_data['balance_after'])
+                if not same_balance(float(stored['balance']), balance):
+                    self.save_account(dict(stored, balance=str(balance)))
+                return
+
+    def transaction_history(self, account_id, offset=0, limit=None, start=None, end=None, until=None):
+        return self.journal.history(account_id, offset, limit, start, end, until)
+
+    def iter_transactions(self, use_mmap=False, start=None, end=None, until=None):
+        return self.journal.iter_transactions(use_mmap, start, end, until)
+
+    def ledger_mark(self):
+        return self.journal.mark()
+
+    def ledger_sources(self):
+        return self.journal.ledger_sources()
+
+    def ledger_aggregates(self):
+        self.journal.open()
+        return self.journal.aggregates
+
+    def rebuild_aggregates(self):
+        return self.journal.rebuild_aggregates()
+
+    def load_admin_password(self):
+        if os.path.exists(self.admin_path):
+            with open(self.admin_path, "r") as file:
+                reader = csv.DictReader(file)
+                for row in reader:
+                    return row['password']
+        return None
+
+    def save_admin_password(self, password):
+        with open(self.admin_path, "w", newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=['password'])
+            writer.writeheader()
+            writer.writerow({'password': password})
+
+    def set_deferred(self, deferred):
+        # Only the calling thread defers, other sessions keep logging
+        # their transfers
+        if deferred:
+            self.deferral.enter()
+        else:
+            self.deferral.exit()
+
+    def write_deferred(self):
+        # Rows deferring threads buffered, written before a transfer is
+        # logged: a replay of the transfer must not outrun them
+        if self.deferral.active():
+            self.journal.commit()
+            self.account_store.flush()
+
+    @instrumented("commit")
+    def commit(self):
+        self.account_store.flush()
+        self.journal.commit()
+        self.settle_transfers()
+
+    @instrumented("checkpoint")
+    def checkpoint(self, customers):
+        # Compact first so the snapshot is newer than accounts.csv
+        self.journal.save_aggregates()
+        self.account_store.compact()
+        self.settle_transfers()
+        self.snapshot.write(customers, self.account_store.all_rows())
+
+    def close(self):
+        self.journal.close()
+        self.account_store.close()
+        self.settle_transfers()
+        self.transfers.close()
+        self.customer_index.close()
+
+class SQLiteStorage(Storage):
+    # One sqlite3 database in WAL mode. Statements use fixed SQL text so
+    # sqlite3's statement cache keeps them prepared. Outside deferred mode
+    # every write commits on its own; atomic() wraps a block in one
+    # transaction (a savepoint when one is already open).
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS customers (customer_id TEXT NOT NULL, password TEXT, "
+        "first_name TEXT, last_name TEXT, address TEXT)",
+        "CREATE INDEX IF NOT EXISTS customers_by_id ON customers (customer_id)",
+        "CREATE TABLE IF NOT EXISTS accounts (account_id TEXT NOT NULL, account_type TEXT NOT NULL, "
+        "balance REAL, interest_rate REAL, credit_limit REAL, overdraft_fee REAL, "
+        "PRIMARY KEY (account_id, account_type))",
+        "CREATE TABLE IF NOT EXISTS transactions (id INTEGER PRIMARY KEY, "
+        + ", ".join(TRANSACTION_FIELDS) + ")",
+        "CREATE INDEX IF NOT EXISTS transactions_by_account ON transactions (account_id, id)",
+        "CREATE TABLE IF NOT EXISTS admin (password TEXT)",
+        "CREATE TABLE IF NOT EXISTS aggregates (covered INTEGER, data TEXT)",
+        "CREATE TABLE IF NOT EXISTS sequences (name TEXT PRIMARY KEY, next_id INTEGER)",
+    ]
+    SELECT_ACCOUNTS = "SELECT " + ", ".join(ACCOUNT_FIELDS) + " FROM accounts"
+    # rowid order is the order accounts were opened in, as in accounts.csv
+    ACCOUNT_ORDER = " ORDER BY rowid"
+    # An upsert rather than INSERT OR REPLACE, which would give an updated
+    # account a new rowid and move it to the end
+    SAVE_ACCOUNT = ("INSERT INTO accounts (" + ", ".join(ACCOUNT_FIELDS) + ") VALUES ("
+                    + ", ".join("?" * len(ACCOUNT_FIELDS)) + ") ON CONFLICT (account_id, account_type) DO UPDATE SET "
+                    + ", ".join(f"{field} = excluded.{field}" for field in ACCOUNT_FIELDS[2:]))
+    SAVE_CUSTOMER = "INSERT INTO customers VALUES (?, ?, ?, ?, ?)"
+    APPEND_TRANSACTION = ("INSERT INTO transactions (" + ", ".join(TRANSACTION_FIELDS) + ") VALUES ("
+                          + ", ".join("?" * len(TRANSACTION_FIELDS)) + ")")
+    SELECT_TRANSACTIONS = "SELECT " + ", ".join(TRANSACTION_FIELDS) + " FROM transactions"
+    # Timestamps sort as text; an end day covers every time on that day
+    IN_RANGE = "timestamp >= ? AND timestamp <= ?"
+
+    def __init__(self, path="bank.db", durability="flush"):
+        self.path = path
+        # One connection shared by all threads, guarded by self.lock
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=" + ("FULL" if durability == "fsync" else "NORMAL"))
+        for statement in self.SCHEMA:
+            self.connection.execute(statement)
+        # Databases created before a ledger column existed get it added
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(transactions)")}
+        for field in TRANSACTION_FIELDS:
+            if field not in columns:
+                self.connection.execute(f"ALTER TABLE transactions ADD COLUMN {field}")
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.deferrals = 0  # open deferred blocks
+        # Rows of the open transaction reach the aggregates only once it commits
+        self.aggregates = LedgerAggregates()
+        self.pending = []
+        self.load_aggregates()
+
+    @staticmethod
+    def to_text(value):
+        return '' if value is None else str(value)
+
+    @staticmethod
+    def to_number(value):
+        return None if value == '' or value is None else float(value)
+
+    def account_values(self, row):
+        return (row['account_id'], row['account_type']) + tuple(self.to_number(row[field]) for field in ACCOUNT_FIELDS[2:])
+
+    def transaction_values(self, transaction_data):
+        return tuple(transaction_data.get(field, '') for field in TRANSACTION_FIELDS)
+
+    def account_row(self, values):
+        return dict(zip(ACCOUNT_FIELDS, (self.to_text(value) for value in values)))
+
+    def transaction_row(self, values):
+        return dict(zip(TRANSACTION_FIELDS, (self.to_text(value) for value in values)))
+
+    @synchronized
+    def load(self, use_snapshot=True):
+        customers = self.iter_customers()
+        accounts_by_customer = {}
+        for values in self.connection.execute(self.SELECT_ACCOUNTS + self.ACCOUNT_ORDER):
+            row = self.account_row(values)
+            accounts_by_customer.setdefault(row['account_id'], []).append(row)
+        return customers, accounts_by_customer
+
+    @synchronized
+    def get_account(self, account_id, account_type):
+        values = self.connection.execute(self.SELECT_ACCOUNTS + " WHERE account_id = ? AND account_type = ?",
+                                         (account_id, account_type)).fetchone()
+        return self.account_row(values) if values else None
+
+    @synchronized
+    def get_customer(self, customer_id):
+        values = self.connection.execute("SELECT * FROM customers WHERE customer_id = ?", (customer_id,)).fetchone()
+        return tuple(self.to_text(value) for value in values) if values else None
+
+    @synchronized
+    def iter_customers(self):
+        return [tuple(self.to_text(value) for value in row)
+                for row in self.connection.execute("SELECT * FROM customers ORDER BY rowid")]
+
+    @synchronized
+    def customer_accounts(self, customer_id):
+        return [self.account_row(values)
+                for values in self.connection.execute(self.SELECT_ACCOUNTS + " WHERE account_id = ?" + self.ACCOUNT_ORDER,
+                                                      (customer_id,))]
+
+    @synchronized
+    def data_version(self):
+        # Only commits made through other connections change it
+        return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    @synchronized
+    def iter_accounts(self):
+        return [self.account_row(values) for values in self.connection.execute(self.SELECT_ACCOUNTS + self.ACCOUNT_ORDER)]
+
+    @synchronized
+    def save_account(self, row):
+        self.connection.execute(self.SAVE_ACCOUNT, self.account_values(row))
+
+    @synchronized
+    def save_accounts(self, rows):
+        with self.atomic():
+            self.connection.executemany(self.SAVE_ACCOUNT, map(self.account_values, rows))
+
+    @synchronized
+    def save_customer(self, customer):
+        self.connection.execute(self.SAVE_CUSTOMER, tuple(customer))
+
+    @synchronized
+    def save_customers(self, customers):
+        with self.atomic():
+            self.connection.executemany(self.SAVE_CUSTOMER, map(tuple, customers))
+
+    @synchronized
+    def reserve_ids(self, name, count, floor=1):
+        with self.atomic():
+            row = self.connection.execute("SELECT next_id FROM sequences WHERE name = ?", (name,)).fetchone()
+            start = max(row[0] if row else floor, floor)
+            self.connection.execute("INSERT OR REPLACE INTO sequences VALUES (?, ?)", (name, start + count))
+        return start
+
+    @synchronized
+    def append_transaction(self, transaction_data):
+        self.connection.execute(self.APPEND_TRANSACTION, self.transaction_values(transaction_data))
+        self.record([transaction_data])
+
+    @synchronized
+    def append_transactions(self, transactions):
+        with self.atomic():
+            self.connection.executemany(self.APPEND_TRANSACTION, map(self.transaction_values, transactions))
+            self.record(transactions)
+
+    def record(self, transactions):
+        if self.connection.in_transaction:
+            self.pending.extend(transactions)
+        else:
+            for transaction_data in transactions:
+                self.aggregates.add(transaction_data)
+
+    def fold_pending(self):
+        for transaction_data in self.pending:
+            self.aggregates.add(transaction_data)
+        self.pending = []
+
+    def last_transaction_id(self):
+        return self.connection.execute("SELECT max(id) FROM transactions").fetchone()[0] or 0
+
+    @synchronized
+    def load_aggregates(self):
+        self.aggregates.reset()
+        row = self.connection.execute("SELECT covered, data FROM aggregates LIMIT 1").fetchone()
+        if row:
+            try:
+                self.aggregates.loads(row[1])
+            except (ValueError, KeyError, TypeError):
+                self.aggregates.reset()
+        if self.aggregates.covered > self.last_transaction_id():
+            self.aggregates.reset()
+        self.catch_up_aggregates()
+
+    def catch_up_aggregates(self):
+        covered = self.aggregates.covered
+        for values in self.connection.execute(self.SELECT_TRANSACTIONS + " WHERE id > ? ORDER BY id", (covered,)):
+            self.aggregates.add(self.transaction_row(values))
+        self.aggregates.covered = self.last_transaction_id()
+
+    @synchronized
+    def save_aggregates(self):
+        # Only between transactions, when every committed row has been folded in
+        if self.connection.in_transaction or not self.aggregates.dirty:
+            return
+        self.aggregates.covered = self.last_transaction_id()
+        with self.atomic():
+            self.connection.execute("DELETE FROM aggregates")
+            self.connection.execute("INSERT INTO aggregates VALUES (?, ?)",
+                                    (self.aggregates.covered, self.aggregates.dumps()))
+        self.aggregates.dirty = False
+
+    def ledger_sources(self):
+        if self.path == ":memory:":
+            raise ValueError("An in-memory database cannot be read by other processes")
+        self.commit()
+        return [("sqlite", self.path)]
+
+    @synchronized
+    def ledger_aggregates(self):
+        return self.aggregates
+
+    @synchronized
+    def rebuild_aggregates(self):
+        self.commit()
+        self.aggregates.reset()
+        self.catch_up_aggregates()
+        self.save_aggregates()
+        return self.aggregates
+
+    @staticmethod
+    def day_range(start, end):
+        return (start or '', (end or '9999-12-31') + '~')
+
+    def ledger_conditions(self, start, end, until):
+        # WHERE terms and parameters for a day range and a ledger_mark()
+        conditions, parameters = [], []
+        if start or end:
+            conditions.append(self.IN_RANGE)
+            parameters.extend(self.day_range(start, end))
+        if until is not None:
+            conditions.append("id <= ?")
+            parameters.append(until)
+        return conditions, parameters
+
+    @synchronized
+    def transaction_history(self, account_id, offset=0, limit=None, start=None, end=None, until=None):
+        limit = -1 if limit is None else limit
+        conditions, parameters = self.ledger_conditions(start, end, until)
+        query = (self.SELECT_TRANSACTIONS + " WHERE " + " AND ".join(["account_id = ?"] + conditions)
+                 + " ORDER BY id DESC LIMIT ? OFFSET ?")
+        cursor = self.connection.execute(query, (account_id, *parameters, limit, offset))
+        return [self.transaction_row(values) for values in cursor]
+
+    def iter_transactions(self, use_mmap=False, start=None, end=None, until=None):
+        self.commit()
+        return self.stream_transactions(start, end, until)
+
+    @synchronized
+    def ledger_mark(self):
+        self.commit()
+        return self.connection.execute("SELECT coalesce(max(id), 0) FROM transactions").fetchone()[0]
+
+    def stream_transactions(self, start=None, end=None, until=None):
+        if self.path == ":memory:":
+            yield from self.page_transactions(start, end, until)
+            return
+        # A separate connection so a long scan does not hold the shared one
+        connection = sqlite3.connect(self.path)
+        try:
+            conditions, parameters = self.ledger_conditions(start, end, until)
+            query = self.SELECT_TRANSACTIONS
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            cursor = connection.execute(query + " ORDER BY id", parameters)
+            for values in cursor:
+                yield self.transaction_row(values)
+        finally:
+            connection.close()
+
+    def page_transactions(self, start=None, end=None, until=None, page_size=10000):
+        # An in-memory database is only reachable through the shared
+        # connection, so it is read a page at a time under the lock
+        if until is None:
+            until = self.ledger_mark()
+        conditions, parameters = self.ledger_conditions(start, end, until)
+        query = ("SELECT id, " + ", ".join(TRANSACTION_FIELDS) + " FROM transactions WHERE "
+                 + " AND ".join(conditions + ["id > ?"]) + " ORDER BY id LIMIT ?")
+        last = 0
+        while True:
+            with self.lock:
+                page = self.connection.execute(query, (*parameters, last, page_size)).fetchall()
+            for values in page:
+                yield self.transaction_row(values[1:])
+            if len(page) < page_size:
+                return
+            last = page[-1][0]
+
+    @synchronized
+    def load_admin_password(self):
+        row = self.connection.execute("SELECT password FROM admin LIMIT 1").fetchone()
+        return row[0] if row else None
+
+    @synchronized
+    def save_admin_password(self, password):
+        with self.atomic():
+            self.connection.execute("DELETE FROM admin")
+            self.connection.execute("INSERT INTO admin VALUES (?)", (password,))
+
+    @contextmanager
+    def atomic(self):
+        with self.lock:
+            savepoint = None
+            if self.connection.in_transaction:
+                savepoint = f"sp{self.depth}"
+                self.connection.execute(f"SAVEPOINT {savepoint}")
+            else:
+                self.connection.execute("BEGIN IMMEDIATE")
+            pending = len(self.pending)
+            self.depth += 1
+            try:
+                yield
+            except BaseException:
+                if savepoint:
+                    self.connection.execute(f"ROLLBACK TO {savepoint}")
+                    self.connection.execute(f"RELEASE {savepoint}")
+                else:
+                    self.connection.execute("ROLLBACK")
+                del self.pending[pending:]
+                raise
+            finally:
+                self.depth -= 1
+            if savepoint:
+                self.connection.execute(f"RELEASE {savepoint}")
+            else:
+                self.connection.execute("COMMIT")
+                self.fold_pending()
+
+    @synchronized
+    def set_deferred(self, deferred):
+        # The connection is shared, so a deferred block holds one transaction
+        # for every thread; it commits once the last open block ends
+        if deferred:
+            if not self.connection.in_transaction:
+                self.connection.execute("BEGIN")
+            self.deferrals += 1
+        elif self.deferrals:
+            self.deferrals -= 1
+
+    @instrumented("commit")
+    @synchronized
+    def commit(self):
+        if self.connection.in_transaction and self.depth == 0 and not self.deferrals:
+            self.connection.execute("COMMIT")
+            self.fold_pending()
+
+    @instrumented("checkpoint")
+    @synchronized
+    def checkpoint(self, customers):
+        self.commit()
+        self.save_aggregates()
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    @synchronized
+    def close(self):
+        self.commit()
+        self.save_aggregates()
+        self.connection.close()
+
+def load_shard(root, use_snapshot=True):
+    # Runs in a worker process. Account rows go back as value lists, which
+    # pickle far smaller than dicts.
+    customers, accounts_by_customer = CSVStorage(root).load(use_snapshot)
+    return customers, [[row[field] for field in ACCOUNT_FIELDS] for rows in accounts_by_customer.values()
+                       for row in rows]
+
+class ShardedStorage(Storage):
+    # The CSV layout split into shards by a hash of the customer id: each
+    # <root>/NN directory is a complete CSVStorage holding its customers,
+    # their accounts and their postings, so writes for different customers
+    # touch different files and locks. manifest.json fixes the shard count;
+    # admin.csv and sequences.json live in shard 00, transfers.log (which
+    # may span two shards) in root. Startup loads the shards in worker
+    # processes.
+    def __init__(self, root="shards", shards=8, durability="flush", load_workers=None):
+        self.root = root
+        manifest_path = os.path.join(root, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as file:
+                shards = json.load(file)['shards']
+        else:
+            os.makedirs(root, exist_ok=True)
+            with open(manifest_path, "w") as file:
+                json.dump({'shards': shards}, file)
+        self.shards = [CSVStorage(os.path.join(root, f"{number:02d}"), durability) for number in range(shards)]
+        for shard in self.shards:
+            os.makedirs(shard.root, exist_ok=True)
+        self.load_workers = load_workers or min(shards, os.cpu_count() or 1)
+        self.transfers = TransferLog(os.path.join(root, "transfers.log"), durability)
+        self.transfer_lock = threading.Lock()
+        for shard in self.shards:
+            shard.journal.timed_commit = functools.partial(self.timed_commit, shard)
+
+    def timed_commit(self, shard):
+        shard.commit()
+        self.settle_transfers()
+
+    def shard_for(self, customer_id):
+        return self.shards[ledger_partition(str(customer_id).encode("utf-8"), len(self.shards))]
+
+    def group(self, items, customer_id):
+        # (shard, items) for every shard, keeping the order of the items within each
+        groups = [[] for _ in self.shards]
+        for item in items:
+            groups[ledger_partition(str(customer_id(item)).encode("utf-8"), len(self.shards))].append(item)
+        return zip(self.shards, groups)
+
+    def load(self, use_snapshot=True):
+        customers = []
+        accounts_by_customer = {}
+        if self.load_workers <= 1:
+            for shard in self.shards:
+                shard_customers, shard_accounts = shard.load(use_snapshot)
+                customers.extend(shard_customers)
+                accounts_by_customer.update(shard_accounts)
+            return customers, accounts_by_customer
+        roots = [shard.root for shard in self.shards]
+        with ProcessPoolExecutor(max_workers=self.load_workers) as pool:
+            results = list(pool.map(load_shard, roots, itertools.repeat(use_snapshot)))
+        for shard, (shard_customers, account_values) in zip(self.shards, results):
+            rows = [dict(zip(ACCOUNT_FIELDS, values)) for values in account_values]
+            # The parent's store serves get_account and later writes
+            shard.account_store.replace_rows(rows)
+            customers.extend(shard_customers)
+            for row in rows:
+                accounts_by_customer.setdefault(row['account_id'], []).append(row)
+        return customers, accounts_by_customer
+
+    def get_account(self, account_id, account_type):
+        return self.shard_for(account_id).get_account(account_id, account_type)
+
+    def get_customer(self, customer_id):
+        return self.shard_for(customer_id).get_customer(customer_id)
+
+    def customer_accounts(self, customer_id):
+        return self.shard_for(customer_id).customer_accounts(customer_id)
+
+    def iter_accounts(self):
+        return [row for shard in self.shards for row in shard.iter_accounts()]
+
+    def iter_customers(self):
+        return [customer for shard in self.shards for customer in shard.iter_customers()]
+
+    def reload(self):
+        for shard in self.shards:
+            shard.reload()
+
+    def save_account(self, row):
+        self.shard_for(row['account_id']).save_account(row)
+
+    def save_accounts(self, rows):
+        for shard, shard_rows in self.group(rows, lambda row: row['account_id']):
+            if shard_rows:
+                shard.save_accounts(shard_rows)
+
+    def save_customer(self, customer):
+        self.shard_for(customer[0]).save_customer(customer)
+
+    def save_customers(self, customers):
+        for shard, shard_customers in self.group(customers, lambda customer: customer[0]):
+            if shard_customers:
+                shard.save_customers(shard_customers)
+
+    def reserve_ids(self, name, count, floor=1):
+        return self.shards[0].reserve_ids(name, count, floor)
+
+    def data_version(self):
+        return tuple(shard.data_version() for shard in self.shards)
+
+    def append_transaction(self, transaction_data):
+        self.shard_for(transaction_data.get('account_id', '')).append_transaction(transaction_data)
+        self.settle_transfers(blocking=False)
+
+    def append_transactions(self, transactions):
+        for shard, shard_transactions in self.group(transactions, lambda row: row.get('account_id', '')):
+            if shard_transactions:
+                shard.append_transactions(shard_transactions)
+        self.settle_transfers(blocking=False)
+
+    def commit_transfer(self, rows, transactions):
+        # As CSVStorage.commit_transfer, with each leg in its own shard
+        with self.transfer_lock:
+            legs = [self.shard_for(row['account_id']) for row in rows]
+            lines = legs[0].journal.format_rows(transactions)
+            if any(shard.account_store.deferred for shard in legs):
+                for shard, row, transaction_data, line in zip(legs, rows, transactions, lines):
+                    shard.stage_transfer([row], [transaction_data], [line])
+            else:
+                for shard in set(legs):
+                    shard.write_deferred()
+                log_transfer(self.transfers, legs, rows, transactions, lines)
+                for shard in set(legs):
+                    shard.flush_transferred()
+            if self.transfers_written():
+                self.transfers.truncate()
+
+    def transfers_written(self):
+        return all(shard.transfers_written() for shard in self.shards)
+
+    def settle_transfers(self, blocking=True):
+        # As CSVStorage.settle_transfers, for the log spanning the shards
+        if not self.transfers.pending or not self.transfer_lock.acquire(blocking):
+            return
+        try:
+            for shard in self.shards:
+                shard.flush_transferred()
+            if self.transfers_written():
+                self.transfers.truncate()
+        finally:
+            self.transfer_lock.release()
+
+    def recover(self):
+        return recover_logs(self, self.transfers, self.shard_for)
+
+    def page_accounts(self):
+        for shard in self.shards:
+            shard.page_accounts()
+
+    def transaction_history(self, account_id, offset=0, limit=None, start=None, end=None, until=None):
+        number = ledger_partition(str(account_id).encode("utf-8"), len(self.shards))
+        mark = None if until is None else until[number]
+        return self.shards[number].transaction_history(account_id, offset, limit, start, end, mark)
+
+    def iter_transactions(self, use_mmap=False, start=None, end=None, until=None):
+        # Each shard is in posting order, merged on the timestamp
+        marks = until or (None,) * len(self.shards)
+        return heapq.merge(*(shard.iter_transactions(use_mmap, start, end, mark)
+                             for shard, mark in zip(self.shards, marks)),
+                           key=lambda transaction: transaction.get('timestamp') or '')
+
+    def ledger_mark(self):
+        # One mark per shard; settled first like commit()
+        self.commit()
+        return tuple(shard.ledger_mark() for shard in self.shards)
+
+    def ledger_sources(self):
+        # All rows of an account are in one shard, so its chain stays in order
+        return [source for shard in self.shards for source in shard.ledger_sources()]
+
+    def ledger_aggregates(self):
+        aggregates = LedgerAggregates()
+        for shard in self.shards:
+            aggregates.merge(shard.ledger_aggregates())
+        return aggregates
+
+    def rebuild_aggregates(self):
+        aggregates = LedgerAggregates()
+        for shard in self.shards:
+            aggregates.merge(shard.rebuild_aggregates())
+        return aggregates
+
+    def load_admin_password(self):
+        return self.shards[0].load_admin_password()
+
+    def save_admin_password(self, password):
+        self.shards[0].save_admin_password(password)
+
+    def set_deferred(self, deferred):
+        for shard in self.shards:
+            shard.set_deferred(deferred)
+
+    def commit(self):
+        for shard in self.shards:
+            shard.commit()
+        self.settle_transfers()
+
+    def checkpoint(self, customers):
+        for shard, shard_customers in self.group(customers, lambda customer: customer.id):
+            shard.checkpoint(shard_customers)
+        self.settle_transfers()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.settle_transfers()
+        self.transfers.close()
+
+def migrate_storage(source, target):
+    # Copies customers, accounts, the ledger and the admin password between engines
+    customers, accounts_by_customer = source.load(use_snapshot=False)
+    with target.deferred():
+        for customer in customers:
+            target.save_customer(customer)
+        for rows in accounts_by_customer.values():
+            for row in rows:
+                target.save_account(row)
+        transactions = 0
+        for transaction_data in source.iter_transactions():
+            target.append_transaction(transaction_data)
+            transactions += 1
+        password = source.load_admin_password()
+        if password is not None:
+            target.save_admin_password(password)
+        # New ids must not reuse the ones issued by the source
+        issued = [int(customer[0]) for customer in customers if customer[0].isdigit()]
+        if issued:
+            target.reserve_ids("customer", 0, max(max(issued) + 1, CUSTOMER_ID_FLOOR))
+    accounts = sum(len(rows) for rows in accounts_by_customer.values())
+    return len(customers), accounts, transactions
+
+# Balance reconciliation: every account's postings are replayed in ledger
+# order, checking that each balance_after follows from the one before, and
+# the last one is compared with the stored balance.
+POSTING_SIGNS = {
+    'deposit': 1, 'deposit_with_interest': 1, 'transfer_in': 1, 'interest_accrual': 1,
+    'withdrawal': -1, 'withdrawal_overdraft': -1, 'transfer_out': -1,
+    'loan_disbursement': -1, 'loan_interest': -1,
+}
+# Charged or credited on top of the amount
+POSTING_EXTRAS = {
+    'deposit_with_interest': 'interest_earned',
+    'withdrawal_overdraft': 'overdraft_fee',
+    'loan_disbursement': 'interest_charged',
+}
+BALANCE_TOLERANCE = 1e-6
+
+def posting_delta(transaction):
+    # Balance change of one ledger row, None when it cannot be told
+    transaction_type = transaction.get('transaction_type')
+    sign = POSTING_SIGNS.get(transaction_type)
+    if sign is None:
+        return None
+    try:
+        change = float(transaction.get('amount'))
+        extra = POSTING_EXTRAS.get(transaction_type)
+        if extra:
+            change += LedgerAggregates.number(transaction.get(extra))
+    except (TypeError, ValueError):
+        return None
+    return sign * change
+
+def same_balance(a, b):
+    return math.isclose(a, b, rel_tol=1e-9, abs_tol=BALANCE_TOLERANCE)
+
+def ledger_partition(account_id, partitions):
+    # account_id as UTF-8 bytes; stable across processes, unlike hash()
+    return zlib.crc32(account_id) % partitions
+
+def partition_rows(kind, path, partition, partitions):
+    # Ledger rows of the accounts in one partition, oldest first. Other
+    # accounts are skipped on their raw id, before the line is parsed.
+    if kind == "sqlite":
+        connection = sqlite3.connect(path)
+        connection.create_function("ledger_partition", 1,
+                                   lambda account_id: ledger_partition(str(account_id).encode("utf-8"), partitions),
+                                   deterministic=True)
+        try:
+            cursor = connection.execute(SQLiteStorage.SELECT_TRANSACTIONS
+                                        + " WHERE ledger_partition(account_id) = ? ORDER BY id", (partition,))
+            for values in cursor:
+                yield dict(zip(TRANSACTION_FIELDS, (SQLiteStorage.to_text(value) for value in values)))
+        finally:
+            connection.close()
+        return
+    if not os.path.exists(path):
+        return
+    # Every worker scans every line, so the skip path is kept short: a
+    # BufferedReader iterates the gzip stream in C, and the partition of an
+    # id is computed once
+    owners = {}
+    with (io.BufferedReader(gzip.open(path, "rb")) if kind == "gzip" else open(path, "rb")) as file:
+        fieldnames = parse_ledger_line(file.readline())
+        for line in file:
+            account_id = line[:line.find(b",")]
+            owner = owners.get(account_id)
+            if owner is None:
+                # A quoted id is only known once the line is parsed
+                owner = partition if line.startswith(b'"') else ledger_partition(account_id, partitions)
+                owners[account_id] = owner
+            if owner != partition:
+                continue
+            if not line.endswith(b"\n"):
+                break  # partially written last row
+            values = parse_ledger_line(line)
+            if line.startswith(b'"') and ledger_partition(values[0].encode("utf-8"), partitions) != partition:
+                continue
+            yield dict(zip(fieldnames, values))
+
+def reconcile_partition(sources, partition, partitions, balances):
+    # Runs in a worker process. balances maps (account_id, account_type) to
+    # the stored balance of every account in the partition.
+    report = {'rows': 0, 'skipped': 0, 'accounts': 0, 'unposted': 0,
+              'mismatches': [], 'breaks': [], 'unknown_accounts': []}
+    replayed = {}
+    for kind, path in sources:
+        for transaction in partition_rows(kind, path, partition, partitions):
+            report['rows'] += 1
+            key = (transaction.get('account_id'), transaction.get('account_type'))
+            try:
+                recorded = float(transaction.get('balance_after'))
+            except (TypeError, ValueError):
+                recorded = None
+            if not key[1] or recorded is None:
+                # Rows written before postings carried their account type
+                report['skipped'] += 1
+                continue
+            previous = replayed.get(key)
+            delta = posting_delta(transaction)
+            if previous is not None and delta is not None and not same_balance(previous + delta, recorded):
+                report['breaks'].append({'account_id': key[0], 'account_type': key[1],
+                                         'timestamp': transaction.get('timestamp'),
+                                         'transaction_type': transaction.get('transaction_type'),
+                                         'expected': previous + delta, 'recorded': recorded})
+            # The chain goes on from the recorded balance so one bad row is one break
+            replayed[key] = recorded
+    for key, stored in balances.items():
+        balance = replayed.pop(key, None)
+        if balance is None:
+            report['unposted'] += 1
+            continue
+        report['accounts'] += 1
+        if not same_balance(balance, stored):
+            report['mismatches'].append({'account_id': key[0], 'account_type': key[1],
+                                         'stored': stored, 'replayed': balance})
+    for key, balance in replayed.items():
+        report['unknown_accounts'].append({'account_id': key[0], 'account_type': key[1], 'replayed': balance})
+    return report
+
+def reconcile_ledger(storage, workers=None):
+    # Accounts are split into one partition per worker by ledger_partition().
+    # Each worker reads the ledger itself and fully parses only its own rows,
+    # so only the stored balances and the reports cross process boundaries.
+    workers = max(1, workers or os.cpu_count() or 1)
+    storage.commit()
+    sources = storage.ledger_sources()
+    balances = [{} for _ in range(workers)]
+    for row in storage.iter_accounts():
+        try:
+            balance = float(row['balance'])
+        except (TypeError, ValueError):
+            continue
+        partition = ledger_partition(row['account_id'].encode("utf-8"), workers)
+        balances[partition][(row['account_id'], row['account_type'])] = balance
+    if workers == 1:
+        reports = [reconcile_partition(sources, 0, 1, balances[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            reports = list(pool.map(reconcile_partition, itertools.repeat(sources), range(workers),
+                                    itertools.repeat(workers), balances))
+    report = reports[0]
+    for other in reports[1:]:
+        for field, value in other.items():
+            report[field] += value
+    # Stable sorts, the breaks of one account stay in ledger order
+    for field in ('mismatches', 'breaks', 'unknown_accounts'):
+        report[field].sort(key=lambda item: (item['account_id'], item['account_type']))
+    report['workers'] = workers
+    return report
+
+def print_reconciliation(report, limit=20):
+    print("\n--- BALANCE RECONCILIATION ---")
+    print(f"Replayed {report['rows']} ledger rows for {report['accounts']} accounts "
+          f"({report['workers']} worker processes)")
+    if report['skipped']:
+        print(f"{report['skipped']} rows without an account type were not replayed")
+    if report['unposted']:
+        print(f"{report['unposted']} accounts have no postings to replay")
+    for label, field in (("Balance mismatches", 'mismatches'), ("Breaks in the balance chain", 'breaks'),
+                         ("Postings for unknown accounts", 'unknown_accounts')):
+        items = report[field]
+        if not items:
+            continue
+        print(f"{label}: {len(items)}")
+        for item in items[:limit]:
+            if field == 'mismatches':
+                print(f"  {item['account_id']} {item['account_type']}: stored {item['stored']:.2f}, "
+                      f"ledger {item['replayed']:.2f}")
+            elif field == 'breaks':
+                print(f"  {item['account_id']} {item['account_type']} at {item['timestamp']} "
+                      f"({item['transaction_type']}): expected {item['expected']:.2f}, recorded {item['recorded']:.2f}")
+            else:
+                print(f"  {item['account_id']} {item['account_type']}: ledger {item['replayed']:.2f}")
+        if len(items) > limit:
+            print(f"  ... and {len(items) - limit} more")
+    if not (report['mismatches'] or report['breaks'] or report['unknown_accounts']):
+        print("All balances reconcile with the ledger.")
+
+class ReadView:
+    # Balances as they were when the view opened, plus the ledger_mark() taken
+    # at that moment. Nothing is copied up front: a posting copies the old
+    # balance into every open view before changing it (see Account.balance).
+    __slots__ = ('mark', 'customers', 'saved')
+
+    def __init__(self, mark, customers=None):
+        self.mark = mark
+        self.customers = customers  # the customer list then; None when they are hydrated on demand
+        self.saved = {}
+
+    def preserve(self, account):
+        # Keyed by id and type, so an account dropped from the customer cache
+        # and read again still finds its saved balance
+        self.saved.setdefault((account.id, account.account_type), account._balance)
+
+    def balance(self, account):
+        # The live value is read first: if a posting changed it since, the
+        # saved value is already there
+        balance = account._balance
+        return self.saved.get((account.id, account.account_type), balance)
+
+class ReadViewThread(threading.local):
+    # The view in use on each thread. A class default, since a missing
+    # attribute on a threading.local is slow to look up.
+    view = None
+
+class ReadViews:
+    # The open read views and the gate every posting passes. A view opens
+    # only between postings, so its balances and ledger mark agree. A posting
+    # marks its thread busy in depths, then checks opening; an opener sets
+    # opening, then waits until no thread is busy. Under the GIL one always
+    # sees the other, so postings take no lock unless a view is opening.
+    def __init__(self):
+        self.views = ()  # replaced, never changed in place: Account.balance reads it unlocked
+        self.depths = {}  # thread ident -> posting depth (postings nest)
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.opening = False
+        self.local = ReadViewThread()
+
+    def step_back(self, ident):
+        # A posting that found a view opening waits until it is open
+        self.depths[ident] = 0
+        with self.lock:
+            self.condition.notify_all()
+            while self.opening:
+                self.condition.wait()
+            self.depths[ident] = 1
+
+    def wake_opener(self):
+        with self.lock:
+            self.condition.notify_all()
+
+    def open(self, create):
+        # create() builds the view while no posting is under way
+        def register():
+            view = create()
+            self.views += (view,)
+            return view
+        return self.between_postings(register)
+
+    def between_postings(self, run):
+        # Returns run(), called while no posting is under way; postings that
+        # start meanwhile wait for it
+        if self.depths.get(threading.get_ident()):
+            raise RuntimeError("cannot wait for postings inside a posting")
+        with self.lock:
+            while self.opening:
+                self.condition.wait()
+            self.opening = True
+            try:
+                # Idle threads are dropped. One that starts a posting now
+                # sees opening and steps back, so losing its entry is harmless.
+                for ident, depth in list(self.depths.items()):
+                    if not depth:
+                        self.depths.pop(ident, None)
+                while any(list(self.depths.values())):
+                    self.condition.wait()
+                return run()
+            finally:
+                self.opening = False
+                self.condition.notify_all()
+
+    def close(self, view):
+        with self.lock:
+            self.views = tuple(other for other in self.views if other is not view)
+
+    def current(self):
+        return self.local.view
+
+    @contextmanager
+    def using(self, view, close=False):
+        # Reads on this thread see view until the block ends
+        previous = self.current()
+        self.local.view = view
+        try:
+            yield view
+        finally:
+            self.local.view = previous
+            if close:
+                self.close(view)
+
+read_views = ReadViews()
+
+def posting(method):
+    # Runs the method as one posting: a read view opens before or after it,
+    # never during. The busy mark is set inline, this is on every posting.
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        ident = threading.get_ident()
+        depths = read_views.depths
+        depth = depths.get(ident, 0)
+        depths[ident] = depth + 1
+        if read_views.opening and not depth:
+            read_views.step_back(ident)
+        try:
+            return method(*args, **kwargs)
+        finally:
+            depths[ident] = depth
+            if read_views.opening and not depth:
+                read_views.wake_opener()
+    return wrapper
 
 class Account(ABC):
+    # __slots__ keeps millions of hydrated accounts small (no per-instance __dict__)
+    __slots__ = ('id', 'account_type', '_balance', 'lock')
     next_account_id = 1
+    storage = CSVStorage()
     
     def __init__(self, id, account_type, balance):
         self.id = id
         self.account_type = account_type
-        self.balance = float(balance)
-        self.transactions = []
+        # Not through the setter: a new or re-read account has nothing for views to keep
+        self._balance = float(balance)
+        self.lock = threading.RLock()
 
-    def save_account_info(self):
-        try:
-            # Read existing accounts
-            accounts = []
-            if os.path.exists("accounts.csv"):
-                with open("accounts.csv", "r", newline='') as file:
-                    reader = csv.DictReader(file)
-                    accounts = list(reader)
-            
-            # Update or add account with ALL details
-            account_found = False
-            for acc in accounts:
-                if acc['account_id'] == self.id and acc['account_type'] == self.account_type:
-                    acc['balance'] = str(self.balance)
-                    # ADDED: Extra fields based on account type
-                    if isinstance(self, SavingsAccount):
-                        acc['interest_rate'] = str(self.interest_rate)
-                    elif isinstance(self, CheckingAccount):
-                        acc['credit_limit'] = str(self.credit_limit)
-                        acc['overdraft_fee'] = str(self.overdraft_fee)
-                    elif isinstance(self, LoanAccount):
-                        acc['interest_rate'] = str(self.interest_rate)
-                    account_found = True
-                    break
-            
-            if not account_found:
-                new_account = {
-                    'account_id': self.id,
-                    'account_type': self.account_type,
-                    'balance': str(self.balance)
-                }
-                # ADDED: Extra fields
-                if isinstance(self, SavingsAccount):
-                    new_account['interest_rate'] = str(self.interest_rate)
-                elif isinstance(self, CheckingAccount):
-                    new_account['credit_limit'] = str(self.credit_limit)
-                    new_account['overdraft_fee'] = str(self.overdraft_fee)
-                elif isinstance(self, LoanAccount):
-                    new_account['interest_rate'] = str(self.interest_rate)
-                
-                accounts.append(new_account)
-            
-            # Write back to CSV with ALL fields
-            with open("accounts.csv", "w", newline='') as file:
-                # DYNAMIC FIELDNAMES - sab fields include karo
-                fieldnames = ['account_id', 'account_type', 'balance', 'interest_rate', 'credit_limit', 'overdraft_fee']
-                writer = csv.DictWriter(file, fieldnames=fieldnames)
-                writer.writeheader()
-                for acc in accounts:
-                    # Ensure all fields have values
-                    for field in fieldnames:
-                        if field not in acc:
-                            acc[field] = ''  # Empty for missing fields
-                    writer.writerow(acc)
-                    
+    @property
+    def balance(self):
+        # On a thread using a read view, the balance when the view opened
+        if read_views.views:
+            view = read_views.current()
+            if view is not None:
+                return view.balance(self)
+        return self._balance
+
+    @balance.setter
+    def balance(self, value):
+        # Copy on write: every open view keeps the value it saw
+        for view in read_views.views:
+            view.preserve(self)
+        self._balance = value
+
+    def to_row(self):
+        return {
+            'account_id': self.id,
+            'account_type': self.account_type,
+            'balance': str(self.balance),
+            'interest_rate': '',
+            'credit_limit': '',
+            'overdraft_fee': ''
+        }
+
+    @instrumented("save_account_info")
+    def save_account_info(self):
+        try:
+            self.storage.save_account(self.to_row())
         except Exception as e:
             print(f"Error saving account info: {e}")
 
+    @instrumented("deposit")
+    @posting
+    @synchronized
     def deposit(self, amount):
         try:
             amount = float(amount)
         except ValueError:
             print("Please Enter amount in digits")
-            return
+            return False
         
         self.balance += amount
-        self.save_account_info()
         
         # Save transaction
         transaction_data = {
@@ -91,88 +3462,102 @@ class Account(ABC):
             'balance_after': self.balance
         }
         self.save_transaction(transaction_data)
+        self.save_account_info()
         print(f"Deposited {amount} successfully. New balance: {self.balance}")
+        return True
 
     @abstractmethod
     def withdraw(self, amount):
         pass
 
+    @instrumented("save_transaction")
     def save_transaction(self, transaction_data):
+        # The type tells a customer's Checking, Savings and Loan postings apart
+        transaction_data.setdefault('account_type', self.account_type)
         try:
-            file_exists = os.path.exists("transactions.csv")
-            
-            # COMPLETE FIELDNAMES - sab possible fields
-            fieldnames = [
-                'account_id', 'transaction_type', 'amount', 'timestamp', 
-                'balance_after', 'interest_earned', 'overdraft_fee', 
-                'loan_duration', 'related_account'
-            ]
-            
-            with open("transactions.csv", "a", newline='') as file:
-                writer = csv.DictWriter(file, fieldnames=fieldnames)
-                
-                if not file_exists:
-                    writer.writeheader()
-                
-                # Ensure all fields are present in transaction_data
-                for field in fieldnames:
-                    if field not in transaction_data:
-                        transaction_data[field] = ''
-                
-                writer.writerow(transaction_data)
+            self.storage.append_transaction(transaction_data)
         except Exception as e:
             print(f"Error saving transaction: {e}")
 
+    def describe(self):
+        return f"{self.account_type} Account: Balance: {self.balance}"
+
     def balance_enquiry(self):
         print(f"Account Type: {self.account_type}")
         print(f"Balance: {self.balance}")
 
+    @instrumented("transfer_funds")
+    @posting
     def transfer_funds(self, recipient_account, amount):
-        try:
-            amount = float(amount)
-            if self.balance >= amount:
-                self.balance -= amount
-                recipient_account.balance += amount
-                
-                self.save_account_info()
-                recipient_account.save_account_info()
-                
-                # Save transactions for both accounts
-                self_transaction = {
-                    'account_id': self.id,
-                    'transaction_type': 'transfer_out',
-                    'amount': amount,
-                    'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    'balance_after': self.balance,
-                    'related_account': recipient_account.id
-                }
-                recipient_transaction = {
-                    'account_id': recipient_account.id,
-                    'transaction_type': 'transfer_in',
-                    'amount': amount,
-                    'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    'balance_after': recipient_account.balance,
-                    'related_account': self.id
-                }
-                
-                self.save_transaction(self_transaction)
-                recipient_account.save_transaction(recipient_transaction)
-                
-                print(f"Transferred {amount} to {recipient_account.id} successfully!")
-                return True
-            else:
-                print("Insufficient balance.")
-                return False
-        except Exception as e:
-            print(f"Error during transfer: {e}")
+        if recipient_account is self:
+            print("Cannot transfer to the same account.")
             return False
+        # Locks are always taken in the same order so two opposite transfers cannot deadlock
+        first, second = sorted((self, recipient_account), key=lambda account: (account.id, account.account_type, id(account)))
+        with first.lock, second.lock:
+            try:
+                amount = float(amount)
+                if self.balance >= amount:
+                    before = [self.balance, recipient_account.balance]
+                    self.balance -= amount
+                    recipient_account.balance += amount
+                    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    transactions = [
+                        {
+                            'account_id': self.id,
+                            'transaction_type': 'transfer_out',
+                            'amount': amount,
+                            'timestamp': timestamp,
+                            'balance_after': self.balance,
+                            'related_account': recipient_account.id,
+                            'account_type': self.account_type
+                        },
+                        {
+                            'account_id': recipient_account.id,
+                            'transaction_type': 'transfer_in',
+                            'amount': amount,
+                            'timestamp': timestamp,
+                            'balance_after': recipient_account.balance,
+                            'related_account': self.id,
+                            'account_type': recipient_account.account_type
+                        }
+                    ]
+                    # Both legs are persisted together (see Storage.commit_transfer)
+                    try:
+                        self.storage.commit_transfer([self.to_row(), recipient_account.to_row()], transactions)
+                    except Exception:
+                        self.balance, recipient_account.balance = before
+                        raise
+
+                    print(f"Transferred {amount} to {recipient_account.id} successfully!")
+                    return True
+                else:
+                    print("Insufficient balance.")
+                    return False
+            except Exception as e:
+                print(f"Error during transfer: {e}")
+                return False
 
 class CheckingAccount(Account):
+    __slots__ = ('credit_limit', 'overdraft_fee')
+
     def __init__(self, id, balance):
         super().__init__(id, "Checking", balance)
         self.credit_limit = (self.balance * 0.5) * (-1)
         self.overdraft_fee = abs(self.balance) * 0.02
 
+    def to_row(self):
+        row = super().to_row()
+        row['credit_limit'] = str(self.credit_limit)
+        row['overdraft_fee'] = str(self.overdraft_fee)
+        return row
+
+    def describe(self):
+        return f"{super().describe()}, Credit Limit: {self.credit_limit}"
+
+    @instrumented("withdraw")
+    @posting
+    @synchronized
     def withdraw(self, amount):
         try:
             amount = float(amount)
@@ -203,16 +3588,32 @@ class CheckingAccount(Account):
                 
                 self.save_transaction(transaction_data)
                 self.save_account_info()
+                return True
             else:
                 print("Insufficient funds - exceeds credit limit")
+                return False
         except ValueError as e:
             print(f"Invalid amount: {e}")
+            return False
 
 class SavingsAccount(Account):
+    __slots__ = ('interest_rate',)
+
     def __init__(self, id, balance):
         super().__init__(id, "Savings", balance)
         self.interest_rate = 0.02  # 2% interest
 
+    def to_row(self):
+        row = super().to_row()
+        row['interest_rate'] = str(self.interest_rate)
+        return row
+
+    def describe(self):
+        return f"{super().describe()}, Interest Rate: {self.interest_rate*100}%"
+
+    @instrumented("deposit")
+    @posting
+    @synchronized
     def deposit(self, amount):
         try:
             amount = float(amount)
@@ -230,9 +3631,14 @@ class SavingsAccount(Account):
             self.save_transaction(transaction_data)
             self.save_account_info()
             print(f"Deposited {amount} with interest {interest_earned}. New balance: {self.balance}")
+            return True
         except ValueError as e:
             print(f"Invalid amount: {e}")
+            return False
 
+    @instrumented("withdraw")
+    @posting
+    @synchronized
     def withdraw(self, amount):
         try:
             amount = float(amount)
@@ -257,16 +3663,32 @@ class SavingsAccount(Account):
             return False
 
 class LoanAccount(Account):
+    __slots__ = ('interest_rate',)
+
     def __init__(self, id, balance):
         super().__init__(id, "Loan", balance)
         self.interest_rate = 0.08  # 8% annual interest
 
-    def withdraw(self, amount):
+    def to_row(self):
+        row = super().to_row()
+        row['interest_rate'] = str(self.interest_rate)
+        return row
+
+    def describe(self):
+        return f"{super().describe()}, Interest Rate: {self.interest_rate*100}%"
+
+    @instrumented("withdraw")
+    @posting
+    @synchronized
+    def withdraw(self, amount, loan_duration=None):
         try:
             amount = float(amount)
             if self.balance >= amount:
                 try:
-                    loan_duration = int(input("Enter loan duration in months: "))
+                    # Batch postings pass the duration, the menu asks for it
+                    if loan_duration is None:
+                        loan_duration = input("Enter loan duration in months: ")
+                    loan_duration = int(loan_duration)
                     if loan_duration <= 0:
                         print("Loan duration must be positive")
                         return False
@@ -305,41 +3727,58 @@ class LoanAccount(Account):
             print(f"Invalid amount: {e}")
             return False
 
+def account_from_row(row):
+    balance = float(row['balance'])
+    if row['account_type'] == "Checking":
+        account = CheckingAccount(row['account_id'], balance)
+    elif row['account_type'] == "Savings":
+        account = SavingsAccount(row['account_id'], balance)
+    elif row['account_type'] == "Loan":
+        account = LoanAccount(row['account_id'], balance)
+    else:
+        return None
+    update_account_terms(account, row)
+    return account
+
+def update_account_terms(account, row):
+    # The stored rate, limit and fee, where the row has them
+    if isinstance(account, CheckingAccount):
+        if row['credit_limit']:
+            account.credit_limit = float(row['credit_limit'])
+        if row['overdraft_fee']:
+            account.overdraft_fee = float(row['overdraft_fee'])
+    elif row['interest_rate']:
+        account.interest_rate = float(row['interest_rate'])
+
 class Customer:
+    __slots__ = ('id', 'password', 'first_name', 'last_name', 'address', 'accounts_by_type', '__weakref__')
+    storage = Account.storage
+
     def __init__(self, id, password, first_name, last_name, address):
         self.id = id
         self.password = password
         self.first_name = first_name
         self.last_name = last_name
         self.address = address
-        self.accounts = []
+        self.accounts_by_type = {}
+
+    @property
+    def accounts(self):
+        # The type map is the only container, in insertion order
+        return list(self.accounts_by_type.values())
 
     def save_customer_info(self):
         try:
-            file_exists = os.path.exists("customers.csv")
-            with open("customers.csv", "a", newline='') as file:
-                fieldnames = ['customer_id', 'password', 'first_name', 'last_name', 'address']
-                writer = csv.DictWriter(file, fieldnames=fieldnames)
-                if not file_exists:
-                    writer.writeheader()
-                writer.writerow({
-                    'customer_id': self.id,
-                    'password': self.password,
-                    'first_name': self.first_name,
-                    'last_name': self.last_name,
-                    'address': self.address
-                })
+            self.storage.save_customer((self.id, self.password, self.first_name, self.last_name, self.address))
         except Exception as e:
             print(f"Error saving customer info: {e}")
 
     def add_account(self, account):
-        self.accounts.append(account)
+        # Accounts are stored per (customer, type), a second account of the same type replaces the first
+        self.accounts_by_type[account.account_type] = account
 
     def get_account_by_type(self, account_type):
-        for account in self.accounts:
-            if account.account_type == account_type:
-                return account
-        return None
+        return self.accounts_by_type.get(account_type)
 
     def get_account_balance(self, account_type):
         account = self.get_account_by_type(account_type)
@@ -359,20 +3798,417 @@ class Customer:
             return account.withdraw(amount)
         return False
 
+# Customer report pipeline: select -> (top N) -> format or export. Entries
+# are (customer, accounts to show) and stream like the transaction pipeline.
+CUSTOMER_REPORT_FIELDS = ['customer_id', 'first_name', 'last_name', 'address',
+                          'account_type', 'balance', 'credit_limit', 'interest_rate']
+
+def select_customers(customers, account_type=None, min_balance=None, max_balance=None):
+    # Without filters every customer is listed, with all of their accounts.
+    # With filters only matching accounts are shown, and customers without any are left out.
+    filtered = account_type is not None or min_balance is not None or max_balance is not None
+    for customer in customers:
+        accounts = customer.accounts
+        if filtered:
+            accounts = [account for account in accounts
+                        if (account_type is None or account.account_type == account_type)
+                        and (min_balance is None or account.balance >= min_balance)
+                        and (max_balance is None or account.balance <= max_balance)]
+            if not accounts:
+                continue
+        yield customer, accounts
+
+def top_accounts(entries, count):
+    # The count largest balances, highest first, kept in a heap of size count instead of sorting every account
+    best = heapq.nlargest(count, ((customer, account) for customer, accounts in entries for account in accounts),
+                          key=lambda pair: pair[1].balance)
+    return [(customer, [account]) for customer, account in best]
+
+def format_customer(customer, accounts):
+    lines = [f"\nCustomer ID: {customer.id}",
+             f"Name: {customer.first_name} {customer.last_name}",
+             f"Address: {customer.address}",
+             "Accounts:"]
+    lines.extend(f"  - {account.describe()}" for account in accounts)
+    if not accounts:
+        lines.append("  No accounts")
+    lines.append("-" * 40)
+    return "\n".join(lines) + "\n"
+
+def customer_report_rows(customer, accounts):
+    # One row per account shown, a customer without accounts gets one row of their own
+    fields = [customer.id, customer.first_name, customer.last_name, customer.address]
+    if not accounts:
+        return [fields + ['', '', '', '']]
+    return [fields + [account.account_type, account.balance, getattr(account, 'credit_limit', ''),
+                      getattr(account, 'interest_rate', '')] for account in accounts]
+
+BATCH_OPERATIONS = ("deposit", "withdraw", "transfer", "loan")
+# Above every id the old random scheme (three randint values summed) could produce
+CUSTOMER_ID_FLOOR = 10011000
+IMPORT_FIELDS = ['password', 'first_name', 'last_name', 'address',
+                 'checking_balance', 'savings_balance', 'loan_balance']
+IMPORT_BATCH_SIZE = 50000
+# Accounts whose locks post_accruals holds at once
+ACCRUAL_CHUNK_SIZE = 1000
+# Sessions unused this long log out, and past the cap the oldest one does
+SESSION_IDLE_SECONDS = 30 * 60
+MAX_SESSIONS = 100000
+ACCOUNT_CLASSES = {"Checking": CheckingAccount, "Savings": SavingsAccount, "Loan": LoanAccount}
+
+def valid_password(password):
+    return len(password) >= 6 and re.search(r'\d', password) is not None
+
+class IdAllocator:
+    # Hands out increasing numeric ids from blocks reserved in the storage,
+    # so a new id needs no uniqueness check and only every block_size-th one
+    # a write. Ids left in a block at exit are skipped, never reused.
+    def __init__(self, storage, name, block_size=1000, floor=1):
+        self.storage = storage
+        self.name = name
+        self.block_size = block_size
+        self.floor = floor
+        self.next = self.end = 0
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            if self.next >= self.end:
+                self.next = self.storage.reserve_ids(self.name, self.block_size, self.floor)
+                self.end = self.next + self.block_size
+            value = self.next
+            self.next += 1
+        return str(value)
+
+    def allocate(self, count):
+        # count consecutive ids in a single reservation
+        start = self.storage.reserve_ids(self.name, count, self.floor)
+        return [str(value) for value in range(start, start + count)]
+
+class CustomerCache:
+    # Hydrated customers in least recently used order, bounded by a count,
+    # an estimate of their memory, or both. write_back(customer) runs
+    # before an entry is dropped and returns True when it had to store
+    # something. A dropped customer that an operation still holds is handed
+    # out again rather than hydrated a second time, so there is never more
+    # than one object (and lock) per account.
+    CUSTOMER_BYTES = 160  # object, account map and cache slot (tracemalloc, without the strings)
+    ACCOUNT_BYTES = 260
+
+    def __init__(self, capacity=None, max_bytes=None, write_back=None):
+        if capacity is None and max_bytes is None:
+            raise ValueError("A customer cache needs a capacity or a memory cap")
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.write_back = write_back
+        # customer_id -> (customer, estimated bytes)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.live = weakref.WeakValueDictionary()
+        self.hits = self.misses = self.evictions = self.flushes = 0
+        self.lock = threading.RLock()
+
+    @classmethod
+    def entry_bytes(cls, customer):
+        strings = (customer.id, customer.password, customer.first_name, customer.last_name, customer.address)
+        return (cls.CUSTOMER_BYTES + sum(sys.getsizeof(value) for value in strings)
+                + cls.ACCOUNT_BYTES * len(customer.accounts_by_type))
+
+    @synchronized
+    def get(self, customer_id, hydrate):
+        entry = self.entries.get(customer_id)
+        if entry is not None:
+            self.entries.move_to_end(customer_id)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        customer = self.live.get(customer_id) or hydrate(customer_id)
+        if customer is not None:
+            self.put(customer)
+        return customer
+
+    @synchronized
+    def peek(self, customer_id):
+        # Neither reorders nor counts, for passes over every customer
+        entry = self.entries.get(customer_id)
+        return entry[0] if entry is not None else self.live.get(customer_id)
+
+    @synchronized
+    def adopt(self, customer):
+        # A customer hydrated outside the cache: the object already handed
+        # out for that id if there is one, otherwise customer (not cached)
+        current = self.peek(customer.id)
+        if current is not None:
+            return current
+        self.live[customer.id] = customer
+        return customer
+
+    @synchronized
+    def put(self, customer):
+        old = self.entries.pop(customer.id, None)
+        if old is not None:
+            self.bytes -= old[1]
+        size = self.entry_bytes(customer)
+        self.entries[customer.id] = (customer, size)
+        self.live[customer.id] = customer
+        self.bytes += size
+        # The newest entry stays even when it alone is over the cap
+        while len(self.entries) > 1 and self.over_limit():
+            self.evict()
+
+    def over_limit(self):
+        return ((self.capacity is not None and len(self.entries) > self.capacity)
+                or (self.max_bytes is not None and self.bytes > self.max_bytes))
+
+    def evict(self):
+        customer_id, (customer, size) = next(iter(self.entries.items()))
+        if self.write_back is not None and self.write_back(customer):
+            self.flushes += 1
+        del self.entries[customer_id]
+        self.bytes -= size
+        self.evictions += 1
+
+    @synchronized
+    def clear(self):
+        # Forgets the cached entries without writing back, for when storage
+        # changed underneath. Customers an operation still holds stay in live,
+        # so none is hydrated twice (with two locks per account).
+        self.entries.clear()
+        self.bytes = 0
+
+    @synchronized
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'flushes': self.flushes,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
 class BankingSystem:
-    def __init__(self):
+    def __init__(self, storage=None, durability="flush", use_mmap=True, cache_size=None, cache_bytes=None):
         self.customers = []
+        self.customer_index = {}
+        # With a cache size or memory cap nothing is hydrated at startup:
+        # customers are loaded on first use and kept in an LRU cache, and
+        # self.customers stays empty (iter_customers() walks them all)
+        self.cache = None
+        if cache_size is not None or cache_bytes is not None:
+            self.cache = CustomerCache(cache_size, cache_bytes, self.write_back)
+            metrics.register_cache("customers", self.cache.stats)
+        self.use_mmap = use_mmap
+        self.storage = storage or CSVStorage(durability=durability)
+        if self.cache is not None:
+            self.storage.page_accounts()
+        Account.storage = self.storage
+        Customer.storage = self.storage
+        # Session token -> (customer id, last use), least recently used
+        # first. Customers stay hydrated between logins and are reloaded only
+        # when the storage's data version moves.
+        self.sessions = OrderedDict()
+        self.sessions_lock = threading.Lock()
+        self.session_lock = threading.Lock()
+        self.loaded_version = None
+        self.reports = None  # report thread, started by the first report_in_background()
+        self.customer_ids = IdAllocator(self.storage, "customer", floor=CUSTOMER_ID_FLOOR)
         self.admin_password = self.load_admin_password()
+        recovered = self.storage.recover()
+        if recovered:
+            print(f"Replayed {recovered} logged transfers interrupted by a crash")
+        self.load()
+
+    @instrumented("load")
+    def load(self):
+        # Startup may come from the binary snapshot (CSV storage).
+        # The cyclic GC is paused while millions of objects are created,
+        # otherwise it keeps rescanning the growing heap
+        if self.cache is not None:
+            self.loaded_version = self.storage.data_version()
+            return
+        with gc_paused():
+            self.rebuild(*self.storage.load())
+
+    def rebuild(self, customers, accounts_by_customer):
+        # Built aside and swapped in, so lookups from other threads never see a half-loaded bank
+        loaded = []
+        index = {}
+        for fields in customers:
+            customer = Customer(*fields)
+            loaded.append(customer)
+            index[customer.id] = customer
+            for account_row in accounts_by_customer.get(customer.id, ()):
+                account = account_from_row(account_row)
+                if account:
+                    customer.add_account(account)
+        self.customers = loaded
+        self.customer_index = index
+        self.loaded_version = self.storage.data_version()
+
+    def refresh(self, customers, accounts_by_customer):
+        # Storage changed under a loaded bank. Objects other threads may be
+        # posting through stay the live ones (a second object per account
+        # would mean a second lock): they are updated in place, and only new
+        # customers and accounts get objects.
+        loaded = []
+        index = {}
+        for fields in customers:
+            customer = self.customer_index.get(fields[0])
+            if customer is None:
+                customer = Customer(*fields)
+            else:
+                customer.password, customer.first_name, customer.last_name, customer.address = fields[1:]
+            loaded.append(customer)
+            index[customer.id] = customer
+            for account_row in accounts_by_customer.get(customer.id, ()):
+                account = customer.get_account_by_type(account_row['account_type'])
+                if account is None:
+                    account = account_from_row(account_row)
+                    if account:
+                        customer.add_account(account)
+                    continue
+                with account.lock:
+                    # Read again under the lock, the row loaded above may
+                    # predate a posting made since
+                    row = self.storage.get_account(account.id, account.account_type) or account_row
+                    account.balance = float(row['balance'])
+                    update_account_terms(account, row)
+        self.customers = loaded
+        self.customer_index = index
+        self.loaded_version = self.storage.data_version()
+
+    def save_snapshot(self):
+        try:
+            customers = self.customers
+            if self.cache is not None:
+                # The snapshot only needs the customer fields
+                customers = (Customer(*fields) for fields in self.storage.iter_customers())
+            self.storage.checkpoint(customers)
+            return True
+        except Exception as e:
+            print(f"Error saving snapshot: {e}")
+            return False
+
+    def commit(self):
+        self.storage.commit()
+
+    def deferred_persistence(self):
+        # Account and ledger writes are flushed once, when the block ends
+        return self.storage.deferred()
+
+    def shutdown(self):
+        # Compact and snapshot (CSV) or checkpoint the WAL (SQLite) before exiting
+        if self.reports is not None:
+            self.reports.shutdown()
+        self.save_snapshot()
+        self.storage.close()
+
+    def add_customer(self, customer):
+        if self.cache is not None:
+            self.cache.put(customer)
+            return
+        self.customers.append(customer)
+        self.customer_index[customer.id] = customer
+
+    def find_customer(self, customer_id):
+        if self.cache is None:
+            return self.customer_index.get(customer_id)
+        return self.cache.get(customer_id, self.hydrate_customer)
+
+    @instrumented("hydrate_customer")
+    def hydrate_customer(self, customer_id):
+        fields = self.storage.get_customer(customer_id)
+        if fields is None:
+            return None
+        customer = Customer(*fields)
+        for row in self.storage.customer_accounts(customer_id):
+            account = account_from_row(row)
+            if account:
+                customer.add_account(account)
+        return customer
+
+    def write_back(self, customer):
+        # Writes are write-through, so this only finds balances whose save
+        # failed (or that were changed without one); True if any was stored
+        rows = []
+        for account in customer.accounts:
+            with account.lock:
+                stored = self.storage.get_account(account.id, account.account_type)
+                if stored is None or float(stored['balance']) != account.balance:
+                    rows.append(account.to_row())
+        if rows:
+            self.storage.save_accounts(rows)
+        return bool(rows)
+
+    def iter_customers(self):
+        # Every customer. With the cache this is a pass over storage that
+        # hands out cached customers and hydrates the others just for the pass.
+        view = read_views.current()
+        if view is not None and view.customers is not None:
+            return iter(view.customers)
+        if self.cache is None:
+            return iter(self.customers)
+        return self.stream_customers()
+
+    def stream_customers(self):
+        accounts_by_customer = {}
+        for row in self.storage.iter_accounts():
+            accounts_by_customer.setdefault(row['account_id'], []).append(row)
+        for fields in self.storage.iter_customers():
+            customer = self.cache.peek(fields[0])
+            if customer is None:
+                customer = Customer(*fields)
+                for row in accounts_by_customer.get(customer.id, ()):
+                    account = account_from_row(row)
+                    if account:
+                        customer.add_account(account)
+                customer = self.cache.adopt(customer)
+            yield customer
 
+    def cache_stats(self):
+        return None if self.cache is None else self.cache.stats()
+
+    def open_read_view(self):
+        # Postings are held back only while the ledger is committed and
+        # marked (and the customer list copied)
+        return read_views.open(lambda: ReadView(self.storage.ledger_mark(),
+                                                list(self.customers) if self.cache is None else None))
+
+    def read_view(self):
+        # with bank.read_view(): ... -- on this thread, balances, customer
+        # reports and ledger reads stay as they were when the block started,
+        # while other threads keep posting. With the customer cache, customers
+        # registered since are listed too.
+        return read_views.using(self.open_read_view(), close=True)
+
+    def report_in_background(self, report, *args, **kwargs):
+        # Runs report(*args, **kwargs), e.g. bank.export_customer_report, on the
+        # report thread in a view opened now. Returns a Future of its result.
+        view = self.open_read_view()
+
+        def run():
+            with read_views.using(view, close=True):
+                return report(*args, **kwargs)
+        try:
+            if self.reports is None:
+                self.reports = ThreadPoolExecutor(max_workers=1, thread_name_prefix="report")
+            return self.reports.submit(run)
+        except BaseException:
+            read_views.close(view)
+            raise
+
+    def ledger_until(self):
+        # The mark of the view in use on this thread, if any
+        view = read_views.current()
+        return None if view is None else view.mark
+
+    def iter_ledger(self, start=None, end=None):
+        # Whole ledger oldest first, up to the mark of the view in use
+        return self.storage.iter_transactions(self.use_mmap, start, end, self.ledger_until())
+
+    @instrumented("load_admin_password")
     def load_admin_password(self):
         try:
-            if os.path.exists("admin.csv"):
-                with open("admin.csv", "r") as file:
-                    reader = csv.DictReader(file)
-                    for row in reader:
-                        return row['password']
+            password = self.storage.load_admin_password()
             # Default password agar file nahi hai
-            return "admin123"
+            return password if password is not None else "admin123"
         except:
             return "admin123"
 
@@ -381,11 +4217,7 @@ class BankingSystem:
         if current_pwd == self.admin_password:
             new_pwd = input("Enter new admin password: ")
             try:
-                with open("admin.csv", "w", newline='') as file:
-                    fieldnames = ['password']
-                    writer = csv.DictWriter(file, fieldnames=fieldnames)
-                    writer.writeheader()
-                    writer.writerow({'password': new_pwd})
+                self.storage.save_admin_password(new_pwd)
                 self.admin_password = new_pwd
                 print("Admin password changed successfully!")
             except Exception as e:
@@ -393,55 +4225,91 @@ class BankingSystem:
         else:
             print("Invalid current password!")
 
+    @instrumented("load_customers_from_file")
     def load_customers_from_file(self):
+        # Read state again: accounts are read once and grouped by
+        # account_id, then matched to the loaded customers in a single pass
         try:
-            if os.path.exists("customers.csv"):
-                with open("customers.csv", "r", newline='') as file:
-                    reader = csv.DictReader(file)
-                    for row in reader:
-                        customer = Customer(
-                            row['customer_id'],
-                            row['password'],
-                            row['first_name'],
-                            row['last_name'],
-                            row['address']
-                        )
-                        self.customers.append(customer)
-                        self.load_customer_accounts(customer)
+            if self.cache is not None:
+                self.cache.clear()
+                self.storage.reload()
+                self.loaded_version = self.storage.data_version()
+                return
+            with gc_paused():
+                self.refresh(*self.storage.load(use_snapshot=False))
         except Exception as e:
             print(f"Error loading customers: {e}")
 
+    @instrumented("load_customer_accounts")
     def load_customer_accounts(self, customer):
         try:
-            if os.path.exists("accounts.csv"):
-                with open("accounts.csv", "r", newline='') as file:
-                    reader = csv.DictReader(file)
-                    for row in reader:
-                        if row['account_id'] == customer.id:
-                            balance = float(row['balance'])
-                            if row['account_type'] == "Checking":
-                                account = CheckingAccount(customer.id, balance)
-                                if row['credit_limit']:
-                                    account.credit_limit = float(row['credit_limit'])
-                                if row['overdraft_fee']:
-                                    account.overdraft_fee = float(row['overdraft_fee'])
-                            elif row['account_type'] == "Savings":
-                                account = SavingsAccount(customer.id, balance)
-                                if row['interest_rate']:
-                                    account.interest_rate = float(row['interest_rate'])
-                            elif row['account_type'] == "Loan":
-                                account = LoanAccount(customer.id, balance)
-                                if row['interest_rate']:
-                                    account.interest_rate = float(row['interest_rate'])
-                            customer.add_account(account)
+            for account_type in ACCOUNT_TYPES:
+                row = self.storage.get_account(customer.id, account_type)
+                if row:
+                    account = account_from_row(row)
+                    if account:
+                        customer.add_account(account)
         except Exception as e:
             print(f"Error loading accounts for customer {customer.id}: {e}")
 
+    def refresh_if_changed(self):
+        # Reloads customers and accounts when another process changed them
+        with self.session_lock:
+            version = self.storage.data_version()
+            if version is not None and version == self.loaded_version:
+                return False
+            # Staged rows (group commit, transfers) must be on disk before it is read back
+            self.storage.commit()
+            self.load_customers_from_file()
+            return True
+
     def customer_login(self, customer_id, password):
-        self.load_customers_from_file()
-        for customer in self.customers:
-            if customer.id == customer_id and customer.password == password:
-                return customer
+        self.refresh_if_changed()
+        return self.authenticate(customer_id, password)
+
+    def open_session(self, customer_id, password):
+        # Token for later calls to session_customer(), None on bad credentials
+        customer = self.customer_login(customer_id, password)
+        if customer is None:
+            return None
+        token = secrets.token_hex(16)
+        with self.sessions_lock:
+            now = time.monotonic()
+            self.expire_sessions(now)
+            self.sessions[token] = (customer.id, now)
+        return token
+
+    def expire_sessions(self, now):
+        # Drops idle sessions, and the least recently used past the cap
+        while self.sessions:
+            token, (_, last_used) = next(iter(self.sessions.items()))
+            if now - last_used < SESSION_IDLE_SECONDS and len(self.sessions) < MAX_SESSIONS:
+                break
+            del self.sessions[token]
+
+    def session_customer(self, token):
+        # The current Customer object, so sessions survive a reload
+        with self.sessions_lock:
+            session = self.sessions.get(token)
+            if session is None:
+                return None
+            now = time.monotonic()
+            if now - session[1] >= SESSION_IDLE_SECONDS:
+                del self.sessions[token]
+                return None
+            self.sessions[token] = (session[0], now)
+            self.sessions.move_to_end(token)
+        return self.find_customer(session[0])
+
+    def close_session(self, token):
+        with self.sessions_lock:
+            return self.sessions.pop(token, None) is not None
+
+    def authenticate(self, customer_id, password):
+        # Checks credentials against the customers in memory (or the cache)
+        customer = self.find_customer(customer_id)
+        if customer and customer.password == password:
+            return customer
         return None
 
     def admin_login(self, password):
@@ -450,16 +4318,15 @@ class BankingSystem:
     def create_customer(self, password, first_name, last_name, address):
         try:
             # Password validation
-            if len(password) < 6 or not re.search(r'\d', password):
+            if not valid_password(password):
                 print("Password must be at least 6 characters long and contain a digit.")
                 return False
             
-            # Generate unique ID
-            customer_id = str(random.randint(100, 999) + random.randint(1000, 9999) + random.randint(1000000, 9999999))
+            customer_id = self.customer_ids.next_id()
             print(f'Your Customer ID is: {customer_id}')
             
             customer = Customer(customer_id, password, first_name, last_name, address)
-            self.customers.append(customer)
+            self.add_customer(customer)
             customer.save_customer_info()
             
             print("Customer registered successfully!")
@@ -493,7 +4360,7 @@ class BankingSystem:
             balance = float(input("Enter initial balance: "))
             account = CheckingAccount(customer.id, balance)
             account.save_account_info()
-            customer.accounts.append(account)
+            customer.add_account(account)
             print("Checking account created successfully!")
         except ValueError:
             print("Please enter valid amount!")
@@ -505,7 +4372,7 @@ class BankingSystem:
             balance = float(input("Enter initial balance: "))
             account = SavingsAccount(customer.id, balance)
             account.save_account_info()
-            customer.accounts.append(account)
+            customer.add_account(account)
             print("Savings account created successfully!")
         except ValueError:
             print("Please enter valid amount!")
@@ -517,95 +4384,563 @@ class BankingSystem:
             balance = float(input("Enter initial balance: "))
             account = LoanAccount(customer.id, balance)
             account.save_account_info()
-            customer.accounts.append(account)
+            customer.add_account(account)
             print("Loan account created successfully!")
         except ValueError:
             print("Please enter valid amount!")
         except Exception as e:
             print(f"Error creating loan account: {e}")
 
-    def print_all_customers_info(self):
+    def customer_report(self, account_type=None, min_balance=None, max_balance=None, top=None):
+        entries = select_customers(self.iter_customers(), account_type, min_balance, max_balance)
+        return top_accounts(entries, top) if top else entries
+
+    def print_all_customers_info(self, offset=0, limit=None, account_type=None, min_balance=None,
+                                 max_balance=None, top=None, out=None):
+        # One page of the customer report written through a single buffer.
+        # Returns the number of customers shown.
         try:
-            print("\n" + "="*60)
-            print("ALL CUSTOMERS INFORMATION")
-            print("="*60)
-            
-            if not self.customers:
-                print("No customers found!")
-                return
-                
-            for customer in self.customers:
-                print(f"\nCustomer ID: {customer.id}")
-                print(f"Name: {customer.first_name} {customer.last_name}")
-                print(f"Address: {customer.address}")
-                print("Accounts:")
-                
-                if customer.accounts:
-                    for account in customer.accounts:
-                        if isinstance(account, CheckingAccount):
-                            print(f"  - Checking Account: Balance: {account.balance}, Credit Limit: {account.credit_limit}")
-                        elif isinstance(account, SavingsAccount):
-                            print(f"  - Savings Account: Balance: {account.balance}, Interest Rate: {account.interest_rate*100}%")
-                        elif isinstance(account, LoanAccount):
-                            print(f"  - Loan Account: Balance: {account.balance}, Interest Rate: {account.interest_rate*100}%")
-                else:
-                    print("  No accounts")
-                print("-" * 40)
-                
+            stop = None if limit is None else offset + limit
+            entries = itertools.islice(self.customer_report(account_type, min_balance, max_balance, top), offset, stop)
+            chunks = (format_customer(customer, accounts) for customer, accounts in entries)
+            if out is None:
+                out = sys.stdout
+                print("\n" + "="*60)
+                print("ALL CUSTOMERS INFORMATION")
+                print("="*60)
+            first = next(chunks, None)
+            if first is None:
+                print("No more customers." if offset else "No customers found!")
+                return 0
+            return write_buffered(itertools.chain([first], chunks), out)
+
         except Exception as e:
             print(f"Error displaying customers: {e}")
+            return 0
+
+    def export_customer_report(self, path, account_type=None, min_balance=None, max_balance=None, top=None):
+        try:
+            count = 0
+            with open(path, "w", newline='', buffering=1024 * 1024) as file:
+                writer = csv.writer(file)
+                writer.writerow(CUSTOMER_REPORT_FIELDS)
+                for customer, accounts in self.customer_report(account_type, min_balance, max_balance, top):
+                    writer.writerows(customer_report_rows(customer, accounts))
+                    count += 1
+            print(f"Exported {count} customers to {path}")
+            return count
+        except Exception as e:
+            print(f"Error exporting customers: {e}")
+            return 0
 
     def select_customer_by_id(self, customer_id):
-        for customer in self.customers:
-            if customer.id == customer_id:
-                return customer
-        return None
+        return self.find_customer(customer_id)
+
+    def get_transaction_history(self, account_id, offset=0, limit=None, start=None, end=None):
+        # Newest first, served from the offset index (and the segments in range)
+        return self.storage.transaction_history(account_id, offset, limit, start, end, self.ledger_until())
 
-    def view_transaction_history(self, account_id=None):
+    def view_transaction_history(self, account_id=None, offset=0, limit=None,
+                                 transaction_types=None, start=None, end=None, out=None):
         try:
-            if not os.path.exists("transactions.csv"):
-                print("No transactions found!")
-                return
-                
-            with open("transactions.csv", "r", newline='') as file:
-                reader = csv.DictReader(file)
-                transactions = list(reader)
-                
-            if not transactions:
-                print("No transactions found!")
-                return
+            self.commit()
+            if account_id is not None:
+                transactions = filter_transactions(self.get_transaction_history(account_id, offset, limit,
+                                                                                start, end),
+                                                   None, transaction_types, start, end)
+            else:
+                transactions = filter_transactions(self.iter_ledger(start, end),
+                                                   None, transaction_types, start, end)
+            lines = format_transactions(transactions)
+
+            first = next(lines, None)
+            if first is None:
+                print("No more transactions." if offset else "No transactions found!")
+                return 0
                 
-            print("\n" + "="*80)
-            print("TRANSACTION HISTORY")
-            print("="*80)
-            
-            for transaction in transactions:
-                if account_id is None or transaction['account_id'] == account_id:
-                    print(f"Account: {transaction['account_id']} | "
-                          f"Type: {transaction['transaction_type']} | "
-                          f"Amount: {transaction['amount']} | "
-                          f"Time: {transaction['timestamp']}")
-                    if transaction['interest_earned'] and float(transaction['interest_earned']) > 0:
-                        print(f"  Interest Earned: {transaction['interest_earned']}")
-                    if transaction['overdraft_fee'] and float(transaction['overdraft_fee']) > 0:
-                        print(f"  Overdraft Fee: {transaction['overdraft_fee']}")
-                    if transaction['loan_duration']:
-                        print(f"  Loan Duration: {transaction['loan_duration']} months")
-                    if transaction['related_account']:
-                        print(f"  Related Account: {transaction['related_account']}")
-                    print("-" * 50)
+            if out is None:
+                out = sys.stdout
+                print("\n" + "="*80)
+                print("TRANSACTION HISTORY")
+                print("="*80)
+            return write_buffered(itertools.chain([first], lines), out)
                     
         except Exception as e:
             print(f"Error viewing transactions: {e}")
+            return 0
+
+    def export_transactions(self, path, account_id=None, transaction_types=None, start=None, end=None):
+        try:
+            self.commit()
+            transactions = filter_transactions(self.iter_ledger(start, end),
+                                               account_id, transaction_types, start, end)
+            count = 0
+            with open(path, "w", newline='', buffering=1024 * 1024) as file:
+                writer = csv.writer(file)
+                writer.writerow(TRANSACTION_FIELDS)
+                for transaction in transactions:
+                    writer.writerow([transaction.get(field) or '' for field in TRANSACTION_FIELDS])
+                    count += 1
+            print(f"Exported {count} transactions to {path}")
+            return count
+        except Exception as e:
+            print(f"Error exporting transactions: {e}")
+            return 0
+
+    def ledger_summary(self, account_id=None, account_type=None):
+        # Answered from the running ledger aggregates, transactions.csv is not
+        # scanned. An account id without a type prints each of its accounts.
+        try:
+            aggregates = self.storage.ledger_aggregates()
+            if account_id is not None and account_type is None:
+                account_types = aggregates.account_types(account_id)
+                if not account_types:
+                    print(f"\n--- LEDGER SUMMARY (account {account_id}) ---")
+                    print("No transactions found.")
+                return {account_type: self.ledger_summary(account_id, account_type) for account_type in account_types}
+            totals = aggregates.totals(account_id, account_type)
+            label = 'all accounts' if account_id is None else f"account {account_id} {account_type or '(untyped)'}"
+            print(f"\n--- LEDGER SUMMARY ({label}) ---")
+            if not totals['types']:
+                print("No transactions found.")
+            for transaction_type, (count, amount) in sorted(totals['types'].items()):
+                print(f"{transaction_type:<28} {count:>10} {amount:>16.2f}")
+            print(f"Overdraft fees charged: {totals['overdraft_fees']:.2f}")
+            print(f"Interest earned: {totals['interest_earned']:.2f}")
+            print(f"Interest charged: {totals['interest_charged']:.2f}")
+            if account_id is None:
+                today = datetime.now().strftime("%Y-%m-%d")
+                for label, start in (("Today", today), ("This month", today[:8] + "01")):
+                    types = aggregates.by_day(start, today)
+                    count = sum(bucket[0] for bucket in types.values())
+                    deposits = sum(bucket[1] for name, bucket in types.items() if name.startswith('deposit'))
+                    print(f"{label}: {count} transactions, {deposits:.2f} deposited")
+            return totals
+        except Exception as e:
+            print(f"Error reading ledger summary: {e}")
+            return None
+
+    def rebuild_ledger_summary(self):
+        try:
+            self.storage.rebuild_aggregates()
+            print("Ledger summary rebuilt from the transaction ledger.")
+            return True
+        except Exception as e:
+            print(f"Error rebuilding ledger summary: {e}")
+            return False
+
+    def reconcile_balances(self, workers=None):
+        try:
+            report = reconcile_ledger(self.storage, workers)
+            print_reconciliation(report)
+            return report
+        except Exception as e:
+            print(f"Error reconciling balances: {e}")
+            return None
+
+    def print_metrics(self):
+        rows = metrics.summary()
+        print(f"\n--- INSTRUMENTATION ({'enabled' if metrics.enabled else 'disabled'}) ---")
+        stats = self.cache_stats()
+        if stats is not None:
+            print(f"Customer cache: {stats['entries']} customers (~{stats['bytes'] / 1e6:.1f} MB), "
+                  f"{stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%}), "
+                  f"{stats['evictions']} evictions, {stats['flushes']} written back")
+        if not rows:
+            print("No calls recorded.")
+            return rows
+        print(f"{'Operation':<26} {'Calls':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+              f"{'Read':>12} {'Written':>12} {'Opens':>8}")
+        for row in rows:
+            print(f"{row['operation']:<26} {row['count']:>9} {row['p50'] * 1000:>9.3f} {row['p95'] * 1000:>9.3f} "
+                  f"{row['p99'] * 1000:>9.3f} {row['bytes_read']:>12} {row['bytes_written']:>12} {row['file_opens']:>8}")
+        return rows
+
+    def export_metrics(self, path, format="json"):
+        try:
+            metrics.export(path, format)
+            print(f"Metrics written to {path}")
+            return True
+        except Exception as e:
+            print(f"Error exporting metrics: {e}")
+            return False
+
+    def apply_operation(self, operation):
+        # One non-interactive posting, returns (ok, message)
+        kind = (operation.get('operation') or '').strip().lower()
+        if kind not in BATCH_OPERATIONS:
+            return False, f"unknown operation '{kind}'"
+        customer = self.select_customer_by_id(operation.get('customer_id') or '')
+        if customer is None:
+            return False, "customer not found"
+        account_type = operation.get('account_type') or ("Loan" if kind == "loan" else "")
+        account = customer.get_account_by_type(account_type)
+        if account is None:
+            return False, f"customer has no {account_type} account"
+        try:
+            amount = float(operation.get('amount'))
+        except (TypeError, ValueError):
+            return False, "invalid amount"
+        if not (math.isfinite(amount) and amount > 0):
+            return False, "amount must be positive"
+
+        if kind == "deposit":
+            ok = account.deposit(amount)
+        elif kind == "withdraw":
+            if isinstance(account, LoanAccount):
+                return False, "use the loan operation for Loan accounts"
+            ok = account.withdraw(amount)
+        elif kind == "loan":
+            if not isinstance(account, LoanAccount):
+                return False, "loan operation needs a Loan account"
+            try:
+                loan_duration = int(operation.get('loan_duration'))
+            except (TypeError, ValueError):
+                return False, "invalid loan duration"
+            if loan_duration <= 0:
+                return False, "loan duration must be positive"
+            ok = account.withdraw(amount, loan_duration)
+        else:
+            recipient = self.select_customer_by_id(operation.get('to_customer_id') or '')
+            if recipient is None:
+                return False, "recipient not found"
+            recipient_type = operation.get('to_account_type') or account_type
+            recipient_account = recipient.get_account_by_type(recipient_type)
+            if recipient_account is None:
+                return False, f"recipient has no {recipient_type} account"
+            if recipient_account is account:
+                return False, "cannot transfer to the same account"
+            ok = account.transfer_funds(recipient_account, amount)
+        return (True, "ok") if ok else (False, "insufficient funds")
+
+    def apply_operation_safely(self, operation):
+        try:
+            return self.apply_operation(operation)
+        except Exception as e:
+            return False, f"error: {e}"
+
+    def post_batch(self, operations):
+        # Applies postings without prompts or per-row output; accounts.log and
+        # transactions.csv are written once for the whole batch
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull), self.deferred_persistence():
+            return [self.apply_operation_safely(operation) for operation in operations]
+
+    def post_concurrently(self, operations, workers=4):
+        # Same as post_batch on a thread pool. Account locks keep balances
+        # consistent and the store and journal serialize their own writes.
+        # Results come back in input order.
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull), self.deferred_persistence():
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(self.apply_operation_deferred, operations))
+
+    def apply_operation_deferred(self, operation):
+        # On a pool thread: deferral is per thread, so the worker joins the
+        # batch for the operation and the batch's block writes it at the end
+        self.storage.set_deferred(True)
+        try:
+            return self.apply_operation_safely(operation)
+        finally:
+            self.storage.set_deferred(False)
+
+    def accrue_interest(self, months=1, use_numpy=None):
+        # Month-end run: Savings accounts earn and Loan accounts are charged
+        # balance * interest_rate / 12 for each month. The balances are read
+        # at one moment between postings and the interest of every account is
+        # computed from them in one pass (NumPy arrays when installed). Then
+        # the postings are written in bulk groups, see post_accruals().
+        # Returns (accounts posted, total earned, total charged).
+        if use_numpy is None:
+            use_numpy = np is not None
+        elif use_numpy and np is None:
+            raise RuntimeError("NumPy is not installed")
+        accounts = [account for customer in self.iter_customers() for account in customer.accounts
+                    if isinstance(account, (SavingsAccount, LoanAccount))]
+        factor = months / 12
+        balances = read_views.between_postings(lambda: [account.balance for account in accounts])
+        if use_numpy:
+            balances = np.array(balances, dtype=np.float64)
+            rates = np.fromiter((account.interest_rate for account in accounts), dtype=np.float64, count=len(accounts))
+            interest = balances * rates * factor
+            # Only positive balances accrue
+            eligible = np.flatnonzero((balances > 0) & (interest > 0)).tolist()
+            balances = balances.tolist()
+            interest = interest.tolist()
+        else:
+            interest = [balance * account.interest_rate * factor for account, balance in zip(accounts, balances)]
+            eligible = [i for i, (balance, amount) in enumerate(zip(balances, interest)) if balance > 0 and amount > 0]
+        return self.post_accruals([(accounts[i], balances[i], interest[i]) for i in eligible], factor)
+
+    @posting
+    def post_accruals(self, accruals, factor):
+        # (account, balance read, interest on it) for each account. Locks are
+        # taken a chunk at a time, in the order transfer_funds uses, and held
+        # until the chunk's rows are staged, so the ledger and the stored rows
+        # follow the order postings were made in. An account posted to since
+        # its balance was read has its interest worked out again. The run is
+        # one posting, so no read view opens halfway through it.
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        accruals.sort(key=lambda accrual: (accrual[0].id, accrual[0].account_type, id(accrual[0])))
+        posted = 0
+        earned = charged = 0.0
+        with self.deferred_persistence():
+            for chunk_start in range(0, len(accruals), ACCRUAL_CHUNK_SIZE):
+                with ExitStack() as stack:
+                    account_rows = []
+                    transactions = []
+                    for account, balance, amount in accruals[chunk_start:chunk_start + ACCRUAL_CHUNK_SIZE]:
+                        stack.enter_context(account.lock)
+                        if account.balance != balance:
+                            balance = account.balance
+                            amount = balance * account.interest_rate * factor
+                            if not (balance > 0 and amount > 0):
+                                continue
+                        if isinstance(account, SavingsAccount):
+                            account.balance = balance + amount
+                            earned += amount
+                            transactions.append({'account_id': account.id, 'account_type': account.account_type,
+                                                 'transaction_type': 'interest_accrual', 'amount': amount,
+                                                 'interest_earned': amount, 'timestamp': timestamp,
+                                                 'balance_after': account.balance})
+                        else:
+                            account.balance = balance - amount
+                            charged += amount
+                            transactions.append({'account_id': account.id, 'account_type': account.account_type,
+                                                 'transaction_type': 'loan_interest', 'amount': amount,
+                                                 'interest_charged': amount, 'timestamp': timestamp,
+                                                 'balance_after': account.balance})
+                        account_rows.append(account.to_row())
+                    self.storage.save_accounts(account_rows)
+                    self.storage.append_transactions(transactions)
+                    posted += len(transactions)
+        return posted, earned, charged
+
+    def process_batch_file(self, path, results_path=None):
+        try:
+            with open(path, "r", newline='') as file:
+                operations = list(csv.DictReader(file))
+            results = self.post_batch(operations)
+            if results_path:
+                with open(results_path, "w", newline='') as file:
+                    writer = csv.writer(file)
+                    writer.writerow(['line', 'operation', 'customer_id', 'status', 'message'])
+                    # Line 1 is the header
+                    for line, (operation, (ok, message)) in enumerate(zip(operations, results), start=2):
+                        writer.writerow([line, operation.get('operation'), operation.get('customer_id'),
+                                         "ok" if ok else "rejected", message])
+            applied = sum(1 for ok, _ in results if ok)
+            print(f"Applied {applied} of {len(results)} operations ({len(results) - applied} rejected)")
+            return results
+        except Exception as e:
+            print(f"Error processing batch file: {e}")
+            return []
+
+    def import_customers(self, path, results_path=None, batch_size=IMPORT_BATCH_SIZE):
+        # Registers customers and their opening accounts from a CSV with the
+        # IMPORT_FIELDS columns (an empty balance opens no account of that
+        # type). Each batch takes one id reservation, one customers.csv
+        # append and one account group. Returns (customer_id or None, message)
+        # per row, in file order.
+        try:
+            results = []
+            with open(path, "r", newline='') as file:
+                reader = csv.DictReader(file)
+                for rows in iter(lambda: list(itertools.islice(reader, batch_size)), []):
+                    results.extend(self.import_batch(rows))
+            if results_path:
+                with open(results_path, "w", newline='') as file:
+                    writer = csv.writer(file)
+                    writer.writerow(['line', 'customer_id', 'status', 'message'])
+                    # Line 1 is the header
+                    writer.writerows([line, customer_id or '', "ok" if customer_id else "rejected", message]
+                                     for line, (customer_id, message) in enumerate(results, start=2))
+            imported = sum(1 for customer_id, _ in results if customer_id)
+            print(f"Imported {imported} of {len(results)} customers ({len(results) - imported} rejected)")
+            return results
+        except Exception as e:
+            print(f"Error importing customers: {e}")
+            return []
+
+    def import_batch(self, rows):
+        results = [None] * len(rows)
+        accepted = []
+        for position, row in enumerate(rows):
+            if not valid_password(row.get('password') or ''):
+                results[position] = (None, "password must be at least 6 characters long and contain a digit")
+                continue
+            try:
+                balances = [(account_type, float(row[field])) for account_type, field in
+                            zip(ACCOUNT_TYPES, IMPORT_FIELDS[4:]) if row.get(field)]
+            except ValueError as e:
+                results[position] = (None, f"invalid balance: {e}")
+                continue
+            accepted.append((position, row, balances))
+        customers = []
+        account_rows = []
+        for (position, row, balances), customer_id in zip(accepted, self.customer_ids.allocate(len(accepted))):
+            customer = Customer(customer_id, row['password'], row.get('first_name') or '',
+                                row.get('last_name') or '', row.get('address') or '')
+            for account_type, balance in balances:
+                account = ACCOUNT_CLASSES[account_type](customer_id, balance)
+                customer.add_account(account)
+                account_rows.append(account.to_row())
+            customers.append(customer)
+            results[position] = (customer_id, "ok")
+        with self.deferred_persistence():
+            self.storage.save_customers([(customer.id, customer.password, customer.first_name, customer.last_name,
+                                          customer.address) for customer in customers])
+            self.storage.save_accounts(account_rows)
+        if self.cache is None:
+            # A cached bank hydrates them when they are first used
+            for customer in customers:
+                self.add_customer(customer)
+        return results
+
+class BankServer:
+    # Newline delimited JSON over TCP, one request object per line with an
+    # "op" field. Blocking work (postings, file I/O) runs on a thread pool so
+    # the event loop only moves bytes between sessions.
+    #   {"op": "login", "customer_id": ..., "password": ...} -> {"ok": true, "token": ...}
+    #   {"op": "deposit" | "withdraw" | "loan", "token": ..., "account_type": ..., "amount": ..., "loan_duration": ...}
+    #   {"op": "transfer", "token": ..., "account_type": ..., "amount": ..., "to_customer_id": ..., "to_account_type": ...}
+    #   {"op": "balance", "token": ...}
+    #   {"op": "history", "token": ..., "offset": 0, "limit": 20}
+    #   {"op": "logout", "token": ...}
+    def __init__(self, banking_system, host="127.0.0.1", port=8765, workers=16):
+        self.banking_system = banking_system
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.server = None
+
+    async def run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port, backlog=4096)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def serve_forever(self):
+        await self.start()
+        print(f"Serving on {self.host}:{self.port}", file=sys.stderr)
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.executor.shutdown(wait=True)
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError):
+                    # Longer than the stream limit. The rest of the line is
+                    # still unread, so the connection cannot be resynced.
+                    writer.write(json.dumps({"ok": False, "error": "request too large"}).encode("utf-8") + b"\n")
+                    await self.close_after_reply(reader, writer)
+                    break
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("request must be a JSON object")
+                    response = await self.dispatch(request)
+                except ValueError as e:
+                    response = {"ok": False, "error": f"bad request: {e}"}
+                except Exception as e:
+                    response = {"ok": False, "error": f"server error: {e}"}
+                writer.write(json.dumps(response).encode("utf-8") + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def close_after_reply(self, reader, writer, timeout=1.0):
+        # Closing with unread input makes the kernel reset the connection,
+        # which can discard the reply before the client reads it. Send EOF
+        # and drop what the client still sends, for a short while.
+        await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+
+        async def discard():
+            while await reader.read(65536):
+                pass
+        try:
+            await asyncio.wait_for(discard(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def dispatch(self, request):
+        op = request.get("op")
+        if op == "login":
+            token = await self.run_blocking(self.banking_system.open_session,
+                                            str(request.get("customer_id", "")), str(request.get("password", "")))
+            if token is None:
+                return {"ok": False, "error": "invalid customer id or password"}
+            return {"ok": True, "token": token}
+
+        if self.banking_system.cache is None:
+            customer = self.banking_system.session_customer(request.get("token"))
+        else:
+            # A cache miss reads storage (and a hit can wait on the cache
+            # lock while another thread hydrates), so not on the loop
+            customer = await self.run_blocking(self.banking_system.session_customer, request.get("token"))
+        if customer is None:
+            return {"ok": False, "error": "not logged in"}
+        if op == "logout":
+            self.banking_system.close_session(request["token"])
+            return {"ok": True}
+        if op == "balance":
+            return {"ok": True, "accounts": [{"account_type": account.account_type, "balance": account.balance}
+                                             for account in customer.accounts]}
+        if op == "history":
+            offset = int(request.get("offset", 0))
+            limit = int(request.get("limit", HISTORY_PAGE_SIZE))
+            transactions = await self.run_blocking(self.banking_system.get_transaction_history, customer.id, offset, limit)
+            return {"ok": True, "transactions": transactions}
+        if op in BATCH_OPERATIONS:
+            operation = {field: request.get(field) for field in
+                         ('account_type', 'amount', 'to_customer_id', 'to_account_type', 'loan_duration')}
+            operation['operation'] = op
+            operation['customer_id'] = customer.id
+            ok, message = await self.run_blocking(self.banking_system.apply_operation_safely, operation)
+            return {"ok": ok, "message": message}
+        return {"ok": False, "error": f"unknown op '{op}'"}
+
+def stop_on_signal(signum, frame):
+    raise KeyboardInterrupt
+
+def serve(host="127.0.0.1", port=8765, workers=16, storage=None, cache_size=None, cache_bytes=None):
+    banking_system = BankingSystem(storage, cache_size=cache_size, cache_bytes=cache_bytes)
+    server = BankServer(banking_system, host, port, workers)
+    # Treat a plain kill like Ctrl+C so the store is compacted on the way out
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    # Posting methods print for the interactive menu, keep that off the server console
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.executor.shutdown(wait=True)
+            banking_system.shutdown()
 
 # Helper function to select account
 def select_account(customer):
-    if not customer.accounts:
+    accounts = customer.accounts
+    if not accounts:
         print("No accounts found for this customer!")
         return None
 
     print("\nSelect an account:")
-    for i, account in enumerate(customer.accounts):
+    for i, account in enumerate(accounts):
         if isinstance(account, CheckingAccount):
             print(f"{i+1}. Checking Account - Balance: {account.balance}")
         elif isinstance(account, SavingsAccount):
@@ -615,8 +4950,8 @@ def select_account(customer):
     
     try:
         choice = int(input("Enter account number: ")) - 1
-        if 0 <= choice < len(customer.accounts):
-            return customer.accounts[choice]
+        if 0 <= choice < len(accounts):
+            return accounts[choice]
         else:
             print("Invalid account number!")
             return None
@@ -624,6 +4959,69 @@ def select_account(customer):
         print("Please enter a valid number!")
         return None
 
+HISTORY_PAGE_SIZE = 20
+CUSTOMER_PAGE_SIZE = 50
+
+# Pages through one customer's history, newest first
+def transaction_history_interface(banking_system, account_id, start=None, end=None):
+    # Pages are counted after the date range, which the storage applies itself
+    offset = 0
+    while True:
+        shown = banking_system.view_transaction_history(account_id, offset, HISTORY_PAGE_SIZE, start=start, end=end)
+        if shown < HISTORY_PAGE_SIZE:
+            break
+        if input("Show older transactions? (y/n): ").lower() != "y":
+            break
+        offset += shown
+
+# Optional filters for admin transaction views, blank input means no filter
+def prompt_transaction_filters(ask_types=True):
+    types = input("Transaction types (comma separated, blank for all): ").strip() if ask_types else ""
+    start = input("From date YYYY-MM-DD (blank for beginning): ").strip()
+    end = input("To date YYYY-MM-DD (blank for today): ").strip()
+    transaction_types = {t.strip() for t in types.split(",") if t.strip()} or None
+    return transaction_types, start or None, end or None
+
+def prompt_customer_filters():
+    # Blank input means no filter
+    account_type = input("Account type (Checking/Savings/Loan, blank for all): ").strip().capitalize()
+    if account_type and account_type not in ACCOUNT_TYPES:
+        raise ValueError(f"unknown account type '{account_type}'")
+    low = input("Minimum balance (blank for none): ").strip()
+    high = input("Maximum balance (blank for none): ").strip()
+    return account_type or None, float(low) if low else None, float(high) if high else None
+
+def customer_report_interface(banking_system):
+    print("\n1. View Customers")
+    print("2. Top Accounts by Balance")
+    print("3. Export Customers to File")
+    sub_choice = input("Enter choice (1-3): ")
+    if sub_choice not in ("1", "2", "3"):
+        print("Invalid choice!")
+        return
+    try:
+        account_type, min_balance, max_balance = prompt_customer_filters()
+        top = int(input("How many accounts: ")) if sub_choice == "2" else None
+    except ValueError as e:
+        print(f"Invalid filter: {e}")
+        return
+    if sub_choice == "3":
+        path = input("Enter output file name: ")
+        with banking_system.read_view():
+            banking_system.export_customer_report(path, account_type, min_balance, max_balance, top)
+        return
+    # Every page comes from the same point in time, whatever is posted meanwhile
+    with banking_system.read_view():
+        offset = 0
+        while True:
+            shown = banking_system.print_all_customers_info(offset, CUSTOMER_PAGE_SIZE, account_type,
+                                                            min_balance, max_balance, top)
+            if shown < CUSTOMER_PAGE_SIZE:
+                break
+            if input("Show more customers? (y/n): ").lower() != "y":
+                break
+            offset += shown
+
 # Decorators for UI
 def pretty_print(func):
     def wrapper(*args, **kwargs):
@@ -651,8 +5049,8 @@ def pretty_admin(func):
 
 # Main function
 @pretty_print
-def main():
-    banking_system = BankingSystem()
+def main(storage=None, cache_size=None, cache_bytes=None):
+    banking_system = BankingSystem(storage, cache_size=cache_size, cache_bytes=cache_bytes)
     
     while True:
         print("\nMAIN MENU")
@@ -670,6 +5068,7 @@ def main():
         elif choice == "3":
             admin_interface(banking_system)
         elif choice == "4":
+            banking_system.shutdown()
             print("Thank you for using our banking system! Goodbye!")
             break
         else:
@@ -749,8 +5148,9 @@ def customer_interface(banking_system, customer):
                 else:
                     print("Recipient not found!")
         elif choice == "6":
-            banking_system.view_transaction_history(customer.id)
+            transaction_history_interface(banking_system, customer.id)
         elif choice == "7":
+            banking_system.commit()
             print("Logged out successfully!")
             break
         else:
@@ -768,37 +5168,203 @@ def admin_interface(banking_system):
     
     while True:
         print("\nADMIN MENU")
-        print("1. View All Customers")
+        print("1. Customer Report")
         print("2. Create New Customer")
         print("3. View Transaction History")
         print("4. Change Admin Password")
-        print("5. Logout")
+        print("5. Save Snapshot")
+        print("6. Ledger Summary")
+        print("7. Instrumentation")
+        print("8. Logout")
         
-        choice = input("Enter your choice (1-5): ")
+        choice = input("Enter your choice (1-8): ")
         
         if choice == "1":
-            banking_system.print_all_customers_info()
+            customer_report_interface(banking_system)
         elif choice == "2":
             customer_registration_interface(banking_system)
         elif choice == "3":
             print("\n1. View All Transactions")
             print("2. View Specific Customer Transactions")
-            sub_choice = input("Enter choice (1-2): ")
+            print("3. Export Transactions to File")
+            sub_choice = input("Enter choice (1-3): ")
             if sub_choice == "1":
-                banking_system.view_transaction_history()
+                transaction_types, start, end = prompt_transaction_filters()
+                banking_system.view_transaction_history(None, transaction_types=transaction_types, start=start, end=end)
             elif sub_choice == "2":
                 customer_id = input("Enter Customer ID: ")
-                banking_system.view_transaction_history(customer_id)
+                _, start, end = prompt_transaction_filters(ask_types=False)
+                transaction_history_interface(banking_system, customer_id, start, end)
+            elif sub_choice == "3":
+                path = input("Enter output file name: ")
+                transaction_types, start, end = prompt_transaction_filters()
+                banking_system.export_transactions(path, None, transaction_types, start, end)
             else:
                 print("Invalid choice!")
         elif choice == "4":
             banking_system.change_admin_password()
         elif choice == "5":
+            if banking_system.save_snapshot():
+                print("Snapshot saved successfully!")
+        elif choice == "6":
+            print("\n1. Bank-wide Summary")
+            print("2. Account Summary")
+            print("3. Rebuild Summary from Ledger")
+            print("4. Reconcile Balances with Ledger")
+            sub_choice = input("Enter choice (1-4): ")
+            if sub_choice == "1":
+                banking_system.ledger_summary()
+            elif sub_choice == "2":
+                banking_system.ledger_summary(input("Enter Account ID: "))
+            elif sub_choice == "3":
+                banking_system.rebuild_ledger_summary()
+            elif sub_choice == "4":
+                banking_system.reconcile_balances()
+            else:
+                print("Invalid choice!")
+        elif choice == "7":
+            banking_system.print_metrics()
+            print("\n1. " + ("Disable" if metrics.enabled else "Enable") + " Instrumentation")
+            print("2. Reset Counters")
+            print("3. Export as JSON")
+            print("4. Export as Prometheus Text")
+            print("5. Back")
+            sub_choice = input("Enter choice (1-5): ")
+            if sub_choice == "1":
+                if metrics.enabled:
+                    metrics.disable()
+                else:
+                    metrics.enable()
+                print(f"Instrumentation {'enabled' if metrics.enabled else 'disabled'}.")
+            elif sub_choice == "2":
+                metrics.reset()
+                print("Counters reset.")
+            elif sub_choice == "3":
+                banking_system.export_metrics(input("Enter output file name: "), "json")
+            elif sub_choice == "4":
+                banking_system.export_metrics(input("Enter output file name: "), "prometheus")
+            elif sub_choice != "5":
+                print("Invalid choice!")
+        elif choice == "8":
             print("Admin logged out!")
             break
         else:
             print("Invalid choice!")
 
+def open_storage(kind, db_path, durability="flush", shards_dir="shards"):
+    if kind == "sqlite":
+        return SQLiteStorage(db_path, durability)
+    if kind == "sharded":
+        return ShardedStorage(shards_dir, durability=durability)
+    return CSVStorage(durability=durability)
+
+def run_command_line(argv=None):
+    parser = argparse.ArgumentParser(description="Online banking system. Runs the interactive menu without a command.")
+    parser.add_argument("--storage", choices=("csv", "sqlite", "sharded"), default="csv",
+                        help="storage engine (default: csv)")
+    parser.add_argument("--db", default="bank.db", help="database file for --storage sqlite")
+    parser.add_argument("--shards-dir", default="shards", help="directory for --storage sharded")
+    parser.add_argument("--durability", choices=("flush", "fsync"), default="flush")
+    parser.add_argument("--cache-size", type=int, help="hydrate customers on first use and keep at most this many "
+                                                       "(default: load all at startup)")
+    parser.add_argument("--cache-mb", type=float, help="like --cache-size, bounded by estimated memory instead")
+    parser.add_argument("--metrics-file", help="record instrumentation and write it here on exit "
+                                               "(Prometheus text for a .prom file, JSON otherwise)")
+    commands = parser.add_subparsers(dest="command")
+    batch = commands.add_parser("batch", help="apply a CSV file of postings non-interactively")
+    batch.add_argument("operations_file", help="CSV with operation,customer_id,account_type,amount,"
+                                               "to_customer_id,to_account_type,loan_duration")
+    batch.add_argument("--results", help="write per-row validation results to this CSV file")
+    server = commands.add_parser("serve", help="serve JSON-over-TCP sessions (see BankServer)")
+    server.add_argument("--host", default="127.0.0.1")
+    server.add_argument("--port", type=int, default=8765)
+    server.add_argument("--workers", type=int, default=16, help="threads for blocking work")
+    migrate = commands.add_parser("migrate", help="copy the CSV files into a SQLite database")
+    migrate.add_argument("--to", default="bank.db", help="database file to create or fill")
+    accrue = commands.add_parser("accrue", help="post month-end interest to every Savings and Loan account")
+    accrue.add_argument("--months", type=int, default=1, help="months of interest to post (default: 1)")
+    reshard = commands.add_parser("reshard", help="copy the CSV files (or another sharded layout) into a new "
+                                                  "sharded layout")
+    reshard.add_argument("--shards", type=int, default=8, help="number of shards (default: 8)")
+    reshard.add_argument("--to", default="shards", help="directory of the new layout, must not exist yet")
+    reshard.add_argument("--from", dest="source", help="existing sharded layout to read instead of the CSV files")
+    importer = commands.add_parser("import", help="register customers and opening accounts from a CSV file")
+    importer.add_argument("customers_file", help="CSV with " + ",".join(IMPORT_FIELDS))
+    importer.add_argument("--results", help="write the assigned id or the rejection of every row to this CSV file")
+    reconcile = commands.add_parser("reconcile", help="replay the ledger and compare it with the stored balances "
+                                                      "(exit status 1 when anything does not reconcile)")
+    reconcile.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+    if args.metrics_file:
+        metrics.enable()
+    try:
+        run_command(args)
+    finally:
+        if args.metrics_file:
+            metrics.export(args.metrics_file, "prometheus" if args.metrics_file.endswith(".prom") else "json")
+
+def run_command(args):
+    if args.command == "migrate":
+        source = CSVStorage()
+        target = SQLiteStorage(args.to, args.durability)
+        try:
+            # Copying into a populated database would duplicate every row
+            if target.iter_customers() or target.iter_accounts() or target.ledger_mark():
+                sys.exit(f"{args.to} already holds banking data")
+            customers, accounts, transactions = migrate_storage(source, target)
+            print(f"Migrated {customers} customers, {accounts} accounts and {transactions} transactions to {args.to}")
+        finally:
+            target.close()
+        return
+
+    if args.command == "reshard":
+        if os.path.exists(os.path.join(args.to, "manifest.json")):
+            sys.exit(f"{args.to} already holds a sharded layout")
+        source = ShardedStorage(args.source) if args.source else CSVStorage()
+        target = ShardedStorage(args.to, args.shards, args.durability)
+        try:
+            customers, accounts, transactions = migrate_storage(source, target)
+            print(f"Copied {customers} customers, {accounts} accounts and {transactions} transactions "
+                  f"into {args.shards} shards in {args.to}")
+        finally:
+            target.close()
+        return
+
+    storage = open_storage(args.storage, args.db, args.durability, args.shards_dir)
+    cache_bytes = None if args.cache_mb is None else int(args.cache_mb * 1e6)
+    if args.command == "reconcile":
+        try:
+            report = reconcile_ledger(storage, args.workers)
+        finally:
+            storage.close()
+        print_reconciliation(report)
+        if report['mismatches'] or report['breaks'] or report['unknown_accounts']:
+            sys.exit(1)
+        return
+    if args.command == "batch":
+        banking_system = BankingSystem(storage, cache_size=args.cache_size, cache_bytes=cache_bytes)
+        try:
+            banking_system.process_batch_file(args.operations_file, args.results)
+        finally:
+            banking_system.shutdown()
+    elif args.command == "import":
+        banking_system = BankingSystem(storage, cache_size=args.cache_size, cache_bytes=cache_bytes)
+        try:
+            banking_system.import_customers(args.customers_file, args.results)
+        finally:
+            banking_system.shutdown()
+    elif args.command == "accrue":
+        banking_system = BankingSystem(storage, cache_size=args.cache_size, cache_bytes=cache_bytes)
+        try:
+            posted, earned, charged = banking_system.accrue_interest(args.months)
+            print(f"Posted interest to {posted} accounts: {earned:.2f} earned, {charged:.2f} charged")
+        finally:
+            banking_system.shutdown()
+    elif args.command == "serve":
+        serve(args.host, args.port, args.workers, storage, args.cache_size, cache_bytes)
+    else:
+        main(storage, args.cache_size, cache_bytes)
+
 if __name__ == "__main__":
     # Create necessary CSV files if they don't exist
     if not os.path.exists("admin.csv"):
@@ -807,4 +5373,4 @@ if __name__ == "__main__":
             writer.writeheader()
             writer.writerow({'password': 'admin123'})
     
-    main()
\ No newline at end of file
+    run_command_line()
\ No newline at end of file
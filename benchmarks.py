@@ -0,0 +1,829 @@
+import argparse
+import asyncio
+import csv
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+import tracemalloc
+from datetime import datetime
+
+# banking-system.py is not an importable module name, load it by path
+def load_bank():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "banking-system.py")
+    spec = importlib.util.spec_from_file_location("banking_system", path)
+    bank = importlib.util.module_from_spec(spec)
+    sys.modules["banking_system"] = bank
+    spec.loader.exec_module(bank)
+    return bank
+
+class TempWorkdir:
+    # All data files are relative to the working directory
+    def __enter__(self):
+        self.old_cwd = os.getcwd()
+        self.path = tempfile.mkdtemp(prefix="bank-bench-")
+        os.chdir(self.path)
+        return self.path
+
+    def __exit__(self, *exc):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+# Every reported timing, written out by --json
+RESULTS = []
+
+def report(name, seconds, count):
+    RESULTS.append({'name': name, 'seconds': seconds, 'count': count, 'ops_per_sec': count / seconds})
+    print(f"{name:<40} {seconds:>9.3f}s {count / seconds:>12.0f} ops/s")
+
+def sample_transaction(i):
+    return {
+        'account_id': str(1000000 + i % 1000),
+        'transaction_type': 'deposit',
+        'amount': 10.0,
+        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'balance_after': 100.0 + i
+    }
+
+# The pre-journal implementation of Account.save_transaction, kept for comparison
+def legacy_save_transaction(transaction_data):
+    file_exists = os.path.exists("transactions.csv")
+    fieldnames = [
+        'account_id', 'transaction_type', 'amount', 'timestamp',
+        'balance_after', 'interest_earned', 'overdraft_fee',
+        'loan_duration', 'related_account'
+    ]
+    with open("transactions.csv", "a", newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        if not file_exists:
+            writer.writeheader()
+        for field in fieldnames:
+            if field not in transaction_data:
+                transaction_data[field] = ''
+        writer.writerow(transaction_data)
+
+def bench_posting(bank, count=20000):
+    rows = [sample_transaction(i) for i in range(count)]
+
+    def legacy():
+        for row in rows:
+            legacy_save_transaction(dict(row))
+
+    def journal(durability):
+        journal = bank.TransactionJournal(durability=durability)
+        for row in rows:
+            journal.append(row)
+        journal.close()
+
+    with TempWorkdir():
+        report("posting: open/append per row", timed(legacy), count)
+    with TempWorkdir():
+        report("posting: journal (flush)", timed(journal, "flush"), count)
+    with TempWorkdir():
+        report("posting: journal (fsync per group)", timed(journal, "fsync"), count)
+
+def write_dataset(customers):
+    # One customer per id, each with a Checking and a Savings account
+    with open("customers.csv", "w", newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['customer_id', 'password', 'first_name', 'last_name', 'address'])
+        for i in range(customers):
+            writer.writerow([str(1000000 + i), 'secret1', 'First', 'Last', 'Street 1'])
+    with open("accounts.csv", "w", newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['account_id', 'account_type', 'balance', 'interest_rate', 'credit_limit', 'overdraft_fee'])
+        for i in range(customers):
+            writer.writerow([str(1000000 + i), 'Checking', '100.0', '', '-50.0', '2.0'])
+            writer.writerow([str(1000000 + i), 'Savings', '100.0', '0.02', '', ''])
+
+def bench_load(bank, scales=(1000, 10000, 100000)):
+    for customers in scales:
+        with TempWorkdir():
+            write_dataset(customers)
+            system = bank.BankingSystem()
+            report(f"load_customers_from_file: {customers} customers", timed(system.load_customers_from_file), customers)
+
+def bench_lookup(bank, scales=(1000, 10000, 100000, 1000000), lookups=100000):
+    for customers in scales:
+        system = bank.BankingSystem.__new__(bank.BankingSystem)
+        system.cache = None
+        system.customers = []
+        system.customer_index = {}
+        for i in range(customers):
+            customer = bank.Customer(str(1000000 + i), 'secret1', 'First', 'Last', 'Street 1')
+            customer.add_account(bank.CheckingAccount(customer.id, 100.0))
+            system.add_customer(customer)
+        ids = [str(1000000 + random.randrange(customers)) for _ in range(lookups)]
+
+        def lookup():
+            for customer_id in ids:
+                system.select_customer_by_id(customer_id).get_account_by_type("Checking")
+
+        report(f"customer+account lookup: {customers} customers", timed(lookup), lookups)
+
+def bench_startup(bank, scales=(100000, 1000000)):
+    # Accounts per scale, two per customer
+    for accounts in scales:
+        with TempWorkdir():
+            write_dataset(accounts // 2)
+            report(f"startup from CSV: {accounts} accounts", timed(bank.BankingSystem), accounts)
+            system = bank.BankingSystem()
+            system.save_snapshot()
+            report(f"startup from snapshot: {accounts} accounts", timed(bank.BankingSystem), accounts)
+
+def bench_memory(bank, count=100000):
+    # Bytes per hydrated customer with one Checking and one Savings account
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    customers = []
+    for i in range(count):
+        customer = bank.Customer(str(1000000 + i), 'secret1', 'First', 'Last', 'Street 1')
+        customer.add_account(bank.CheckingAccount(customer.id, 100.0))
+        customer.add_account(bank.SavingsAccount(customer.id, 100.0))
+        customers.append(customer)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"{'memory per customer (2 accounts)':<40} {used / count:>9.0f} bytes")
+    print(f"{'memory per account (incl. customer share)':<40} {used / count / 2:>9.0f} bytes")
+
+def sample_operations(customers, count):
+    operations = []
+    for i in range(count):
+        customer_id = str(1000000 + random.randrange(customers))
+        kind = ("deposit", "withdraw", "transfer")[i % 3]
+        operations.append({
+            'operation': kind,
+            'customer_id': customer_id,
+            'account_type': "Checking",
+            'amount': "5",
+            'to_customer_id': str(1000000 + random.randrange(customers)) if kind == "transfer" else '',
+            'to_account_type': "Savings" if kind == "transfer" else ''
+        })
+    return operations
+
+def bench_cache(bank, customers=200000, lookups=200000, cache_size=20000):
+    # Every customer hydrated at startup against the LRU cache, on both
+    # engines: startup, lookups with 80% of them on a hot tenth of the
+    # customers, and the memory held afterwards
+    hot = customers // 10
+    ids = [str(1000000 + (random.randrange(hot) if random.random() < 0.8 else random.randrange(customers)))
+           for _ in range(lookups)]
+    with TempWorkdir():
+        write_dataset(customers)
+        bank.migrate_storage(bank.CSVStorage(), bank.SQLiteStorage("bank.db"))
+        for name, make_storage in (("csv", bank.CSVStorage), ("sqlite", lambda: bank.SQLiteStorage("bank.db"))):
+            for label, options in (("all loaded", {}), (f"cache {cache_size}", {'cache_size': cache_size})):
+                started = time.perf_counter()
+                system = bank.BankingSystem(make_storage(), **options)
+                report(f"{name} startup, {label}", time.perf_counter() - started, customers)
+
+                def lookup(system):
+                    for customer_id in ids:
+                        system.select_customer_by_id(customer_id)
+
+                report(f"{name} select_customer_by_id, {label}", timed(lookup, system), lookups)
+                system.storage.close()
+                del system
+                # Measured on a second run, tracemalloc would distort the timings
+                tracemalloc.start()
+                system = bank.BankingSystem(make_storage(), **options)
+                lookup(system)
+                used = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+                stats = system.cache_stats()
+                print(f"{'':<40} {used / 1e6:.1f} MB held" + ("" if stats is None else
+                      f", {stats['hit_rate']:.1%} hits, {stats['evictions']} evictions"))
+                system.storage.close()
+                del system
+
+def bench_batch(bank, customers=10000, count=100000):
+    with TempWorkdir():
+        write_dataset(customers)
+        system = bank.BankingSystem()
+        operations = sample_operations(customers, count)
+        start = time.perf_counter()
+        results = system.post_batch(operations)
+        seconds = time.perf_counter() - start
+        report(f"post_batch: {count} operations", seconds, count)
+        print(f"{'':<40} {count / seconds * 60:>9.0f} ops/minute, {sum(ok for ok, _ in results)} applied")
+
+def total_money(system):
+    return sum(account.balance for customer in system.customers for account in customer.accounts)
+
+def crash(system):
+    # The process dies: whatever is still buffered is lost, so the journal's
+    # flush timer must not write it later either, and its transfer log is
+    # no longer claimed
+    system.storage.journal.stop_timer()
+    system.storage.transfers.close()
+
+def bench_stress(bank, customers=200, count=50000, workers=8):
+    # Concurrent transfers must conserve the total money supply, in memory and on disk
+    sys.setswitchinterval(1e-5)  # switch threads often to provoke races
+    try:
+        with TempWorkdir():
+            write_dataset(customers)
+            system = bank.BankingSystem()
+            before = total_money(system)
+            operations = []
+            for _ in range(count):
+                source, target = random.sample(range(customers), 2)
+                operations.append({'operation': "transfer", 'customer_id': str(1000000 + source),
+                                   'account_type': random.choice(("Checking", "Savings")), 'amount': "7",
+                                   'to_customer_id': str(1000000 + target),
+                                   'to_account_type': random.choice(("Checking", "Savings"))})
+            start = time.perf_counter()
+            results = system.post_concurrently(operations, workers)
+            seconds = time.perf_counter() - start
+            applied = sum(ok for ok, _ in results)
+            system.shutdown()
+            on_disk = total_money(bank.BankingSystem())
+            with open("transactions.csv", newline='') as file:
+                ledger_rows = sum(1 for _ in csv.DictReader(file))
+            report(f"post_concurrently: {workers} workers", seconds, count)
+            print(f"{'':<40} total before {before}, after {total_money(system)}, on disk {on_disk}")
+            if not (before == total_money(system) == on_disk and ledger_rows == applied * 2):
+                raise RuntimeError("money supply not conserved under concurrent transfers")
+            print(f"{'':<40} conserved across {applied} transfers")
+    finally:
+        sys.setswitchinterval(0.005)
+
+# Account.transfer_funds as it was before the transfer log: each leg's
+# account row and ledger row written separately, kept for comparison
+def legacy_transfer(bank):
+    @bank.instrumented("transfer_funds")
+    def transfer_funds(self, recipient_account, amount):
+        if recipient_account is self:
+            print("Cannot transfer to the same account.")
+            return False
+        first, second = sorted((self, recipient_account), key=lambda account: (account.id, account.account_type, id(account)))
+        with first.lock, second.lock:
+            try:
+                amount = float(amount)
+                if self.balance >= amount:
+                    self.balance -= amount
+                    recipient_account.balance += amount
+                    with self.storage.atomic():
+                        self.save_account_info()
+                        recipient_account.save_account_info()
+                        self_transaction = {
+                            'account_id': self.id,
+                            'transaction_type': 'transfer_out',
+                            'amount': amount,
+                            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                            'balance_after': self.balance,
+                            'related_account': recipient_account.id
+                        }
+                        recipient_transaction = {
+                            'account_id': recipient_account.id,
+                            'transaction_type': 'transfer_in',
+                            'amount': amount,
+                            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                            'balance_after': recipient_account.balance,
+                            'related_account': self.id
+                        }
+                        self.save_transaction(self_transaction)
+                        recipient_account.save_transaction(recipient_transaction)
+                    print(f"Transferred {amount} to {recipient_account.id} successfully!")
+                    return True
+                else:
+                    print("Insufficient balance.")
+                    return False
+            except Exception as e:
+                print(f"Error during transfer: {e}")
+                return False
+    return transfer_funds
+
+def bench_transfers(bank, customers=10000, count=50000, crashed=500):
+    # Transfers/sec with separate leg writes (the code before the transfer
+    # log) and with the transfer log, in both durability modes. Then
+    # a process dies with transfers only in the log (and one torn record);
+    # the next startup has to complete them with money and ledger intact.
+    pairs = [random.sample(range(customers), 2) for _ in range(count)]
+    for durability in ("flush", "fsync"):
+        for name, transfer in (("separate legs", legacy_transfer(bank)), ("transfer log", bank.Account.transfer_funds)):
+            with TempWorkdir():
+                write_dataset(customers)
+                system = bank.BankingSystem(durability=durability)
+                checking = [customer.accounts[0] for customer in system.customers]
+
+                def transfers(checking):
+                    for source, target in pairs:
+                        transfer(checking[source], checking[target], 1.0)
+
+                report(f"transfer_funds: {name}, {durability}", timed_quietly(transfers, checking), count)
+                if transfer is bank.Account.transfer_funds:
+                    # Deposits alone fill the next group; once it is written
+                    # every logged transfer is, and the log has to be empty
+                    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                        for _ in range(system.storage.journal.batch_size):
+                            checking[0].deposit(1.0)
+                    if os.path.getsize(system.storage.transfers.path):
+                        raise RuntimeError("written transfers were left in the transfer log")
+                system.shutdown()
+    with TempWorkdir():
+        write_dataset(customers)
+        system = bank.BankingSystem()
+        before = total_money(system)
+        checking = [customer.accounts[0] for customer in system.customers]
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            for source, target in pairs[:crashed]:
+                checking[source].transfer_funds(checking[target], 1.0)
+        # Dies here: whatever is still staged in memory is lost
+        crash(system)
+        with open("transfers.log", "a") as file:
+            file.write('100.0,100.0,1000000,Checking,99.0')
+        del system, checking
+        started = time.perf_counter()
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            recovered = bank.BankingSystem()
+        report(f"startup replaying {crashed} logged transfers", time.perf_counter() - started, crashed)
+        result = bank.reconcile_ledger(recovered.storage, 1)
+        with open("transactions.csv", newline='') as file:
+            ledger_rows = sum(1 for _ in csv.DictReader(file))
+        if not (total_money(recovered) == before and ledger_rows == crashed * 2
+                and not (result['mismatches'] or result['breaks'])):
+            raise RuntimeError("logged transfers were not completed after the crash")
+        print(f"{'':<40} money and ledger intact after replaying {crashed} transfers")
+        recovered.shutdown()
+    for name, steps, rows, added in REPLAY_CASES:
+        with TempWorkdir():
+            write_dataset(3)
+            system = bank.BankingSystem()
+            before = total_money(system)
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                steps(system, *(customer.accounts[0] for customer in system.customers))
+            crash(system)
+            del system
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                recovered = bank.BankingSystem()
+            result = bank.reconcile_ledger(recovered.storage, 1)
+            with open("transactions.csv", newline='') as file:
+                ledger_rows = sum(1 for _ in csv.DictReader(file))
+            if not (total_money(recovered) == before + added and ledger_rows == rows
+                    and not (result['mismatches'] or result['breaks'])):
+                raise RuntimeError(f"wrong replay after the crash: {name}")
+            print(f"{'':<40} replayed right: {name}")
+            recovered.shutdown()
+
+def repeated_legs(system, a, b, c):
+    # A pays B, B pays A back and A pays C within one second, all three
+    # only in the log. A's first leg and its last have the same type, time
+    # and balance after.
+    a.transfer_funds(b, 1.0)
+    b.transfer_funds(a, 1.0)
+    a.transfer_funds(c, 1.0)
+
+def repeated_after_settling(system, a, b, c):
+    # As above, but the first transfer is written and dropped from the log
+    # before the others are logged
+    a.transfer_funds(b, 1.0)
+    system.storage.commit()
+    b.transfer_funds(a, 1.0)
+    a.transfer_funds(b, 1.0)
+
+def posting_after_transfer(system, a, b, c):
+    # A's balance returns to the one before a logged transfer, and that
+    # deposit reaches the files
+    a.transfer_funds(b, 50.0)
+    a.deposit(50.0)
+    system.storage.journal.commit()
+
+def transfer_after_deferred_posting(system, a, b, c):
+    # The transfer spends a deposit that is still deferred in memory
+    system.storage.set_deferred(True)
+    a.deposit(100.0)
+    a.transfer_funds(b, 150.0)
+
+# (name, steps, ledger rows, money added) for bench_transfers
+REPLAY_CASES = [
+    ("repeated legs", repeated_legs, 6, 0.0),
+    ("legs repeating settled ones", repeated_after_settling, 6, 0.0),
+    ("posting after a logged transfer", posting_after_transfer, 3, 50.0),
+    ("transfer after a deferred posting", transfer_after_deferred_posting, 0, 0.0),
+]
+
+def view_check(system):
+    # Total money, and whether every balance is the balance_after of the
+    # account's last ledger row (100.0 without one), as this thread reads them
+    balances = {(account.id, account.account_type): account.balance
+                for customer in system.iter_customers() for account in customer.accounts}
+    last = {}
+    for transaction in system.iter_ledger():
+        last[(transaction['account_id'], transaction['account_type'])] = float(transaction['balance_after'])
+    consistent = all(balance == last.get(key, 100.0) for key, balance in balances.items())
+    return sum(balances.values()), consistent
+
+def bench_views(bank, customers=1000, count=30000, workers=4):
+    # Reports on the report thread while transfers run on posting threads.
+    # In a read view every report must find the opening total and balances
+    # matching the ledger up to the view's mark; unviewed reads are shown
+    # for comparison. Posting throughput is timed with and without reports.
+    operations = []
+    for _ in range(count):
+        source, target = random.sample(range(customers), 2)
+        operations.append({'operation': "transfer", 'customer_id': str(1000000 + source),
+                           'account_type': random.choice(("Checking", "Savings")), 'amount': "7",
+                           'to_customer_id': str(1000000 + target),
+                           'to_account_type': random.choice(("Checking", "Savings"))})
+    for name, viewed in (("no reports", None), ("unviewed reports", False), ("reports in read views", True)):
+        with TempWorkdir():
+            write_dataset(customers)
+            system = bank.BankingSystem()
+            opening = total_money(system)
+            done = threading.Event()
+            results = []
+            pauses = []
+
+            def reporter():
+                while not done.is_set():
+                    if viewed:
+                        started = time.perf_counter()
+                        future = system.report_in_background(view_check, system)
+                        pauses.append(time.perf_counter() - started)
+                        results.append(future.result())
+                    else:
+                        results.append(view_check(system))
+
+            thread = threading.Thread(target=reporter)
+            if viewed is not None:
+                thread.start()
+            start = time.perf_counter()
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                applied = sum(ok for ok, _ in system.post_concurrently(operations, workers))
+            seconds = time.perf_counter() - start
+            done.set()
+            if viewed is not None:
+                thread.join()
+            report(f"transfers with {name}", seconds, count)
+            if viewed is not None:
+                bad = sum(1 for total, consistent in results if total != opening or not consistent)
+                print(f"{'':<40} {len(results)} reports, {bad} inconsistent")
+                if viewed:
+                    pauses.sort()
+                    print(f"{'':<40} postings held back {percentile(pauses, 0.5) * 1000:.2f} ms median, "
+                          f"{pauses[-1] * 1000:.2f} ms at most per view")
+                    if bad:
+                        raise RuntimeError("a report in a read view saw postings made after it opened")
+            if total_money(system) != opening or not view_check(system)[1]:
+                raise RuntimeError(f"money supply not conserved across {applied} transfers")
+            system.shutdown()
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+async def client_session(host, port, customer_id, customers, requests, latencies, failures):
+    reader, writer = await asyncio.open_connection(host, port)
+
+    async def call(request):
+        start = time.perf_counter()
+        writer.write(json.dumps(request).encode("utf-8") + b"\n")
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        latencies.append(time.perf_counter() - start)
+        if not response.get("ok") and "error" in response:
+            failures.append(response["error"])
+        return response
+
+    token = (await call({"op": "login", "customer_id": customer_id, "password": "secret1"}))["token"]
+    for i in range(requests):
+        kind = i % 4
+        if kind == 0:
+            await call({"op": "deposit", "token": token, "account_type": "Checking", "amount": 5})
+        elif kind == 1:
+            await call({"op": "balance", "token": token})
+        elif kind == 2:
+            await call({"op": "transfer", "token": token, "account_type": "Checking", "amount": 1,
+                        "to_customer_id": str(1000000 + random.randrange(customers)), "to_account_type": "Savings"})
+        else:
+            await call({"op": "history", "token": token, "limit": 10})
+    await call({"op": "logout", "token": token})
+    writer.close()
+
+async def run_load(bank, customers, sessions, requests):
+    system = bank.BankingSystem()
+    server = bank.BankServer(system, port=0)
+    await server.start()
+    latencies = []
+    failures = []
+    start = time.perf_counter()
+    await asyncio.gather(*(client_session("127.0.0.1", server.port, str(1000000 + i % customers), customers,
+                                          requests, latencies, failures) for i in range(sessions)))
+    seconds = time.perf_counter() - start
+    await server.close()
+    system.shutdown()
+    return seconds, sorted(latencies), failures
+
+def bench_server(bank, customers=10000, sessions=2000, requests=20):
+    # Load generator: many concurrent sessions against an in-process BankServer
+    with TempWorkdir():
+        write_dataset(customers)
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            seconds, latencies, failures = asyncio.run(run_load(bank, customers, sessions, requests))
+        report(f"server: {sessions} concurrent sessions", seconds, len(latencies))
+        print(f"{'':<40} p50 {percentile(latencies, 0.5) * 1000:.1f} ms, p99 {percentile(latencies, 0.99) * 1000:.1f} ms, "
+              f"{len(failures)} failed requests")
+
+def bench_storage(bank, customers=10000, count=30000):
+    # The same workload on both storage engines
+    operations = sample_operations(customers, count)
+    with TempWorkdir():
+        write_dataset(customers)
+        bank.migrate_storage(bank.CSVStorage(), bank.SQLiteStorage("bank.db"))
+        for name, make_storage in (("csv", bank.CSVStorage), ("sqlite", lambda: bank.SQLiteStorage("bank.db"))):
+            start = time.perf_counter()
+            system = bank.BankingSystem(make_storage())
+            report(f"{name}: load {customers} customers", time.perf_counter() - start, customers)
+            def postings():
+                for operation in operations:
+                    system.apply_operation_safely(operation)
+
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                seconds = timed(postings)
+            report(f"{name}: {count} postings, one commit each", seconds, count)
+            report(f"{name}: {count} postings, one batch", timed(system.post_batch, operations), count)
+            ids = [str(1000000 + random.randrange(customers)) for _ in range(2000)]
+
+            def history():
+                for customer_id in ids:
+                    system.get_transaction_history(customer_id, 0, 20)
+
+            report(f"{name}: history, 20 newest rows", timed(history), len(ids))
+            system.shutdown()
+
+def bench_accrual(bank, accounts=1000000, legacy_accounts=20000):
+    # Month-end interest over Savings and Loan accounts, half of each
+    customers = accounts // 2
+    with TempWorkdir():
+        write_dataset(0)
+        with open("accounts.csv", "a", newline='') as file:
+            writer = csv.writer(file)
+            for i in range(customers):
+                writer.writerow([str(1000000 + i), 'Savings', str(100.0 + i % 500), '0.02', '', ''])
+                writer.writerow([str(1000000 + i), 'Loan', str(1000.0 + i % 500), '0.08', '', ''])
+        with open("customers.csv", "a", newline='') as file:
+            writer = csv.writer(file)
+            for i in range(customers):
+                writer.writerow([str(1000000 + i), 'secret1', 'First', 'Last', 'Street 1'])
+        system = bank.BankingSystem()
+
+        def per_account():
+            # What a loop over deposit-style postings costs, one write per account
+            for customer in system.customers[:legacy_accounts // 2]:
+                for account in customer.accounts:
+                    account.balance += account.balance * account.interest_rate / 12
+                    account.save_transaction({'account_id': account.id, 'transaction_type': 'interest_accrual',
+                                              'amount': 0.0, 'timestamp': "", 'balance_after': account.balance})
+                    account.save_account_info()
+
+        report(f"accrual: per-account saves, {legacy_accounts} accounts", timed(per_account), legacy_accounts)
+        modes = [("pure Python", False)] + ([("NumPy", True)] if bank.np is not None else [])
+        for name, use_numpy in modes:
+            start = time.perf_counter()
+            posted, earned, charged = system.accrue_interest(1, use_numpy)
+            report(f"accrual: {name}, {posted} accounts", time.perf_counter() - start, posted)
+        if bank.np is None:
+            print("accrual: NumPy is not installed, only the fallback was measured")
+        system.shutdown()
+
+def write_synthetic_dataset(bank, customers, transactions, seed=0):
+    # N customers, each with a Checking account, every second one a Savings
+    # account and every fourth one a Loan account, plus K ledger rows spread
+    # over the last 90 days. Balances follow the ledger, so the dataset
+    # reconciles. Returns {account_type: [customer ids]}.
+    rng = random.Random(seed)
+    ids = {"Checking": [], "Savings": [], "Loan": []}
+    balances = {}
+    with open("customers.csv", "w", newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['customer_id', 'password', 'first_name', 'last_name', 'address'])
+        for i in range(customers):
+            writer.writerow([str(1000000 + i), 'secret1', f'First{i}', f'Last{i}', f'{i} Main Street'])
+    for i in range(customers):
+        customer_id = str(1000000 + i)
+        for account_type, balance, every in (("Checking", 1000.0, 1), ("Savings", 5000.0, 2), ("Loan", 20000.0, 4)):
+            if i % every == 0:
+                ids[account_type].append(customer_id)
+                balances[(customer_id, account_type)] = balance
+    start = time.time() - 90 * 86400
+    kinds = (('deposit', 1), ('withdrawal', -1), ('transfer_out', -1), ('transfer_in', 1))
+    with open("transactions.csv", "w", newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(bank.TRANSACTION_FIELDS)
+        for i in range(transactions):
+            timestamp = datetime.fromtimestamp(start + i * 90 * 86400 / max(transactions, 1))
+            customer = rng.randrange(customers)
+            account_type = "Checking" if customer % 2 else rng.choice(("Checking", "Savings"))
+            key = (str(1000000 + customer), account_type)
+            kind, sign = kinds[i % 4]
+            amount = float(rng.randrange(1, 500))
+            balances[key] += sign * amount
+            row = {'account_id': key[0], 'account_type': account_type, 'transaction_type': kind,
+                   'amount': str(amount), 'timestamp': timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+                   'balance_after': str(balances[key])}
+            writer.writerow([row.get(field, '') for field in bank.TRANSACTION_FIELDS])
+    with open("accounts.csv", "w", newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(bank.ACCOUNT_FIELDS)
+        for (customer_id, account_type), balance in balances.items():
+            if account_type == "Checking":
+                writer.writerow([customer_id, account_type, str(balance), '', '-500.0', '25.0'])
+            else:
+                rate = '0.02' if account_type == "Savings" else '0.08'
+                writer.writerow([customer_id, account_type, str(balance), rate, '', ''])
+    return ids
+
+def bench_import(bank, customers=1000000):
+    # Bulk registration with opening accounts, target under a minute for 1M customers
+    with TempWorkdir():
+        with open("import.csv", "w", newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(bank.IMPORT_FIELDS)
+            for i in range(customers):
+                writer.writerow([f'secret{i % 10}', f'First{i}', f'Last{i}', f'{i} Main Street', '1000.0',
+                                 '5000.0' if i % 2 == 0 else '', '20000.0' if i % 4 == 0 else ''])
+        system = bank.BankingSystem()
+        report(f"import_customers: {customers} customers", timed_quietly(system.import_customers, "import.csv"),
+               customers)
+        system.storage.close()
+
+def bench_reconcile(bank, customers=100000, transactions=1000000, workers=None):
+    # Reconciliation wall time by worker count; ideally it halves as the workers double
+    counts = workers or sorted({1, 2, 4, os.cpu_count() or 1})
+    with TempWorkdir():
+        write_synthetic_dataset(bank, customers, transactions)
+        storage = bank.CSVStorage()
+        storage.ledger_sources()  # splits the ledger into monthly segments once, outside the timing
+        baseline = None
+        for count in counts:
+            started = time.perf_counter()
+            result = bank.reconcile_ledger(storage, count)
+            elapsed = time.perf_counter() - started
+            assert not (result['mismatches'] or result['breaks']), "synthetic dataset should reconcile"
+            baseline = baseline or elapsed
+            report(f"reconcile {count} workers", elapsed, transactions)
+            print(f"{'':<40} speedup x{baseline / elapsed:.2f} over {counts[0]} worker(s)")
+        storage.close()
+
+def bench_shards(bank, customers=200000, transactions=1000000, shards=8):
+    # Startup from one set of files against the same data resharded, loaded serially and in parallel
+    with TempWorkdir():
+        write_synthetic_dataset(bank, customers, transactions)
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            bank.migrate_storage(bank.CSVStorage(), bank.ShardedStorage("shards", shards))
+        storage = bank.CSVStorage()
+        report(f"load {customers} single file", timed(storage.load), customers)
+        storage.close()
+        for workers in sorted({1, min(shards, os.cpu_count() or 1)}):
+            storage = bank.ShardedStorage("shards", load_workers=workers)
+            report(f"load {customers} {shards} shards, {workers} workers", timed(storage.load), customers)
+            storage.close()
+
+def timed_quietly(func, *args):
+    # The BankingSystem methods report to stdout, which would dominate the timing
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        return timed(func, *args)
+
+def bench_suite(bank, scales=((1000, 10000), (10000, 100000), (100000, 1000000)), calls=2000, logins=1000):
+    # Every BankingSystem hot path at several (customers, transactions) scales
+    for customers, transactions in scales:
+        with TempWorkdir():
+            ids = write_synthetic_dataset(bank, customers, transactions)
+            rng = random.Random(1)
+            label = f"{customers}c/{transactions}t"
+            system = bank.BankingSystem()
+            report(f"{label} load_customers_from_file", timed_quietly(system.load_customers_from_file), customers)
+
+            def login_all():
+                for customer_id in picked:
+                    system.customer_login(customer_id, 'secret1')
+
+            picked = [rng.choice(ids["Checking"]) for _ in range(logins)]
+            report(f"{label} customer_login", timed_quietly(login_all), logins)
+
+            def accounts(account_type):
+                return [system.select_customer_by_id(rng.choice(ids[account_type])).get_account_by_type(account_type)
+                        for _ in range(calls)]
+
+            checking = accounts("Checking")
+            savings = accounts("Savings")
+
+            def deposits():
+                for account in checking:
+                    account.deposit(10)
+
+            def withdrawals():
+                for account in checking:
+                    account.withdraw(10)
+
+            def transfers():
+                for source, target in zip(checking, savings):
+                    source.transfer_funds(target, 1)
+
+            # The first posting builds the ledger index and aggregates, time it apart
+            report(f"{label} first posting (cold ledger)", timed_quietly(checking[0].deposit, 10), 1)
+            report(f"{label} Account.deposit", timed_quietly(deposits), calls)
+            report(f"{label} CheckingAccount.withdraw", timed_quietly(withdrawals), calls)
+            report(f"{label} transfer_funds", timed_quietly(transfers), calls)
+            system.commit()
+
+            history_ids = [rng.choice(ids["Checking"]) for _ in range(calls // 10)]
+
+            def histories():
+                with open(os.devnull, "w") as out:
+                    for customer_id in history_ids:
+                        system.view_transaction_history(customer_id, 0, 20, out=out)
+
+            report(f"{label} view_transaction_history", timed_quietly(histories), len(history_ids))
+            report(f"{label} print_all_customers_info", timed_quietly(system.print_all_customers_info), customers)
+            report(f"{label} customer report top 10", timed_quietly(system.print_all_customers_info, 0, 10,
+                                                                    None, None, None, 10), customers)
+            report(f"{label} export_customer_report", timed_quietly(system.export_customer_report, "report.csv"),
+                   customers)
+            system.storage.close()
+
+BENCHMARKS = {
+    'posting': bench_posting,
+    'load': bench_load,
+    'lookup': bench_lookup,
+    'startup': bench_startup,
+    'memory': bench_memory,
+    'cache': bench_cache,
+    'batch': bench_batch,
+    'stress': bench_stress,
+    'transfers': bench_transfers,
+    'views': bench_views,
+    'server': bench_server,
+    'storage': bench_storage,
+    'accrual': bench_accrual,
+    'reconcile': bench_reconcile,
+    'import': bench_import,
+    'shards': bench_shards,
+    'suite': bench_suite,
+}
+
+def write_results(path):
+    with open(path, "w") as file:
+        json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+                   'timestamp': datetime.now().isoformat(timespec="seconds"), 'results': RESULTS}, file, indent=2)
+
+def compare(baseline_path, current_path, threshold):
+    # Flags every benchmark whose throughput dropped by more than threshold
+    with open(baseline_path) as file:
+        baseline = {result['name']: result for result in json.load(file)['results']}
+    with open(current_path) as file:
+        current = {result['name']: result for result in json.load(file)['results']}
+    slower = 0
+    for name, result in current.items():
+        if name not in baseline:
+            print(f"{name:<50} {'new':>10}")
+            continue
+        ratio = result['ops_per_sec'] / baseline[name]['ops_per_sec']
+        flag = ""
+        if ratio < 1 - threshold:
+            flag = "  SLOWER"
+            slower += 1
+        print(f"{name:<50} {ratio:>9.2f}x{flag}")
+    for name in baseline.keys() - current.keys():
+        print(f"{name:<50} {'missing':>10}")
+    print(f"{slower} of {len(current)} benchmarks slower by more than {threshold:.0%}")
+    return 1 if slower else 0
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks for banking-system.py")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    parser.add_argument("--json", help="write the timings to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="compare two --json files instead of running anything")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="throughput drop flagged as a slowdown by --compare (default: 0.25)")
+    args = parser.parse_args(argv)
+    if args.compare:
+        return compare(*args.compare, args.threshold)
+
+    names = args.names or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name}. Choose from: {', '.join(BENCHMARKS)}")
+            return 1
+    bank = load_bank()
+    for name in names:
+        BENCHMARKS[name](bank)
+    if args.json:
+        write_results(args.json)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))